@@ -77,23 +77,27 @@ with DAG(
         processed_count = 0
         supported_extensions = ('.csv', '.xlsx', '.xls')
         
-        for filename in os.listdir(input_dir):
-            if filename.lower().endswith(supported_extensions):
-                file_path = os.path.join(input_dir, filename)
-                try:
-                    # Clean data
-                    df = cleaner.clean(file_path)
+        try:
+            for filename in os.listdir(input_dir):
+                if filename.lower().endswith(supported_extensions):
+                    file_path = os.path.join(input_dir, filename)
+                    try:
+                        # Clean data
+                        df = cleaner.clean(file_path)
                     
-                    # Insert vào PostgreSQL
-                    pg.insert_transactions(df)
+                        # Insert vào PostgreSQL
+                        pg.insert_transactions(df)
                     
-                    # Move to processed
-                    os.rename(file_path, os.path.join(processed_dir, filename))
-                    processed_count += 1
+                        # Move to processed
+                        os.rename(file_path, os.path.join(processed_dir, filename))
+                        processed_count += 1
                     
-                except Exception as e:
-                    logger.error(f"Error processing {filename}: {e}")
-                    raise
+                    except Exception as e:
+                        logger.error(f"Error processing {filename}: {e}")
+                        raise
+        finally:
+            # Trả connection về pool dùng chung của process
+            pg.close()
         
         return f"Processed {processed_count} files into PostgreSQL"
 
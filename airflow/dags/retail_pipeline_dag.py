@@ -71,7 +71,11 @@ def sync_pg_to_ch(**context):
         WHERE t.thoi_gian >= CURRENT_DATE - INTERVAL '60 days'
     """
     
-    df = pg.execute_query(query)
+    try:
+        df = pg.execute_query(query)
+    finally:
+        # Trả connection về pool dùng chung của process
+        pg.close()
     
     if len(df) > 0:
         ch.insert_dataframe('fact_transactions', df)
@@ -113,9 +117,11 @@ def train_forecast_models(**context):
     sys.path.append('/opt/airflow/ml_pipeline')
     
     from xgboost_forecast import SalesForecaster
+    from connection_pool import log_connection_stats
     
     forecaster = SalesForecaster()
     metrics = forecaster.train_all_models()
+    log_connection_stats()
     
     return f"Trained models with metrics: {metrics}"
 
@@ -132,12 +138,14 @@ def generate_forecasts(**context):
     sys.path.append('/opt/airflow/ml_pipeline')
     
     from xgboost_forecast import SalesForecaster
+    from connection_pool import log_connection_stats
     
     forecaster = SalesForecaster()
     forecasts = forecaster.predict_next_week()
     
     # Lưu vào database
     forecaster.save_forecasts(forecasts)
+    log_connection_stats()
     
     return f"Generated {len(forecasts)} forecasts"
 
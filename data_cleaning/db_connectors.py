@@ -2,12 +2,65 @@
 Database connectors for PostgreSQL and ClickHouse
 """
 
+import os
+import time
 import pandas as pd
 import logging
-from typing import Optional
+import threading
+from typing import Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '1'))
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE', '5'))
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', '30'))  # seconds to wait for a free connection
+
+# Process-wide pools so connectors created per task/call reuse open connections
+_pool_lock = threading.Lock()
+_pg_pools: Dict[tuple, object] = {}
+# clickhouse_driver.Client is not thread-safe: one client per thread and connection parameters
+_ch_local = threading.local()
+
+
+def _get_pg_pool(host: str, database: str, user: str, password: str, port: int):
+    """Shared psycopg2 ThreadedConnectionPool for the given DSN"""
+    key = (host, port, database, user, password)
+    with _pool_lock:
+        pool = _pg_pools.get(key)
+        if pool is None:
+            try:
+                from psycopg2.pool import ThreadedConnectionPool
+            except ImportError:
+                logger.error("psycopg2 not installed. Run: pip install psycopg2-binary")
+                raise
+            pool = ThreadedConnectionPool(
+                PG_POOL_MIN, PG_POOL_SIZE,
+                host=host, database=database, user=user, password=password, port=port
+            )
+            _pg_pools[key] = pool
+        return pool
+
+
+def _getconn(pool):
+    """
+    Borrow a connection from the pool.
+
+    ThreadedConnectionPool raises PoolError as soon as PG_POOL_SIZE connections are
+    checked out; wait up to PG_POOL_TIMEOUT seconds for one to be returned instead.
+    """
+    from psycopg2.pool import PoolError
+
+    deadline = time.monotonic() + PG_POOL_TIMEOUT
+    while True:
+        try:
+            return pool.getconn()
+        except PoolError:
+            if pool.closed or time.monotonic() >= deadline:
+                logger.error(f"PostgreSQL pool exhausted ({PG_POOL_SIZE} connections in use "
+                             f"for {PG_POOL_TIMEOUT}s)")
+                raise
+            time.sleep(0.1)
+
 
 class PostgreSQLConnector:
     """Connector for PostgreSQL database"""
@@ -21,20 +74,13 @@ class PostgreSQLConnector:
         self.conn = None
         
     def _get_connection(self):
-        """Get database connection"""
+        """Get database connection (borrowed from the shared pool until close())"""
         if self.conn is None or self.conn.closed:
-            try:
-                import psycopg2
-            except ImportError:
-                logger.error("psycopg2 not installed. Run: pip install psycopg2-binary")
-                raise
-            self.conn = psycopg2.connect(
-                host=self.host,
-                database=self.database,
-                user=self.user,
-                password=self.password,
-                port=self.port
-            )
+            pool = _get_pg_pool(self.host, self.database, self.user, self.password, self.port)
+            if self.conn is not None:
+                # Connection closed by the server - drop it from the pool
+                pool.putconn(self.conn, close=True)
+            self.conn = _getconn(pool)
         return self.conn
     
     def execute_query(self, query: str) -> pd.DataFrame:
@@ -86,9 +132,13 @@ class PostgreSQLConnector:
             cursor.close()
     
     def close(self):
-        """Close connection"""
-        if self.conn and not self.conn.closed:
-            self.conn.close()
+        """Return connection to the shared pool"""
+        if self.conn is not None:
+            pool = _get_pg_pool(self.host, self.database, self.user, self.password, self.port)
+            if not self.conn.closed:
+                self.conn.rollback()
+            pool.putconn(self.conn, close=bool(self.conn.closed))
+            self.conn = None
 
 
 class ClickHouseConnector:
@@ -100,24 +150,29 @@ class ClickHouseConnector:
         self.user = user
         self.password = password
         self.port = port
-        self.client = None
         
     def _get_client(self):
-        """Get ClickHouse client"""
-        if self.client is None:
+        """Get ClickHouse client (one per thread and connection parameters, reused across calls)"""
+        clients = getattr(_ch_local, 'clients', None)
+        if clients is None:
+            clients = _ch_local.clients = {}
+        key = (self.host, self.port, self.database, self.user, self.password)
+        client = clients.get(key)
+        if client is None:
             try:
                 from clickhouse_driver import Client
             except ImportError:
                 logger.error("clickhouse_driver not installed. Run: pip install clickhouse-driver")
                 raise
-            self.client = Client(
+            client = Client(
                 host=self.host,
                 port=self.port,
                 database=self.database,
                 user=self.user,
                 password=self.password
             )
-        return self.client
+            clients[key] = client
+        return client
     
     def insert_dataframe(self, table: str, df: pd.DataFrame) -> int:
         """Insert DataFrame into ClickHouse table"""
@@ -154,6 +209,4 @@ class ClickHouseConnector:
             raise
     
     def close(self):
-        """Close connection"""
-        if self.client:
-            self.client.disconnect()
+        """No-op: the per-thread client stays open for reuse by later connectors"""
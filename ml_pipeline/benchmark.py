@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Benchmark các đường forecast/feature của ML pipeline trên dữ liệu giả lập
+
+Không cần kết nối DB: dữ liệu bán hàng được sinh ngẫu nhiên (có xu hướng tuần,
+ngày 0 và series ngắn) và models được train với params cố định (không tuning).
+
+Cách dùng:
+    python benchmark.py --case forecast-mode --series 500 --days 120 --horizon 14
+    python benchmark.py --case features --series 100000 --days 100   # 10M dòng
+    python benchmark.py --case purchase-order --series 5000          # 5k SKUs
+"""
+
+import time
+import argparse
+import logging
+import warnings
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from feature_kernels import grouped_rolling, grouped_ema
+from forecast_engine import (
+    BatchRecursiveForecaster, DirectMultiHorizonForecaster, build_direct_training_frame,
+    DIRECT_TARGET_COL
+)
+from purchase_order import rank_products, format_purchase_orders
+from xgboost_forecast import SalesForecaster, median_absolute_percentage_error
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Cột không dùng làm feature (giống exclude_cols của train_model_optuna)
+EXCLUDE_COLS = {'ngay', 'chi_nhanh', 'ma_hang', 'nhom_hang_cap_1', 'nhom_hang_cap_2',
+                'daily_quantity', 'daily_revenue', 'daily_profit', 'transaction_count',
+                DIRECT_TARGET_COL}
+
+
+def synthetic_sales(n_series: int = 500, n_days: int = 120, seed: int = 42,
+                    end_date: str = '2026-01-31') -> pd.DataFrame:
+    """Sinh lịch sử bán hàng (chi_nhanh, ma_hang) theo ngày với mùa vụ tuần"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=end_date, periods=n_days, freq='D')
+    series = np.arange(n_series)
+    base = rng.gamma(2.0, 3.0, size=n_series)
+    weekly = 1 + 0.3 * np.sin(2 * np.pi * dates.dayofweek.to_numpy() / 7)
+    trend = 1 + rng.normal(0, 0.002, size=n_series)[:, None] * np.arange(n_days)[None, :]
+    quantity = rng.poisson(np.clip(base[:, None] * weekly[None, :] * trend, 0, None)).astype(float)
+
+    df = pd.DataFrame({
+        'ngay': np.tile(dates, n_series),
+        'chi_nhanh': np.repeat([f'CN{s % 5}' for s in series], n_days),
+        'ma_hang': np.repeat([f'SP{s:05d}' for s in series], n_days),
+        'nhom_hang_cap_1': np.repeat([f'N{s % 8}' for s in series], n_days),
+        'nhom_hang_cap_2': np.repeat([f'M{s % 20}' for s in series], n_days),
+        'daily_quantity': quantity.ravel(),
+    })
+    df['daily_revenue'] = df['daily_quantity'] * rng.uniform(9000, 11000, size=len(df))
+    df['seasonal_factor'] = 1.0
+    df['is_peak_day'] = 0
+    return df
+
+
+def _fit(df: pd.DataFrame, target_col: str) -> xgb.XGBRegressor:
+    features = [c for c in df.columns if c not in EXCLUDE_COLS and c != target_col
+                and df[c].dtype != object]
+    model = xgb.XGBRegressor(n_estimators=200, max_depth=6, learning_rate=0.05,
+                             tree_method='hist', n_jobs=-1, random_state=42)
+    model.fit(df[features], df[target_col])
+    return model
+
+
+def bench_forecast_modes(n_series: int, n_days: int, horizon: int) -> pd.DataFrame:
+    """
+    So sánh recursive vs direct multi-horizon: latency dự báo và MdAPE trên
+    `horizon` ngày cuối được giữ lại làm holdout.
+    """
+    forecaster = SalesForecaster.__new__(SalesForecaster)  # chỉ dùng create_features
+    forecaster.encoders = None
+    sales = synthetic_sales(n_series, n_days)
+    cutoff = sales['ngay'].max() - pd.Timedelta(days=horizon)
+    history = sales[sales['ngay'] <= cutoff]
+    actual = sales[sales['ngay'] > cutoff].rename(columns={'ngay': 'forecast_date'})
+    future_dates = pd.date_range(cutoff + pd.Timedelta(days=1), periods=horizon, freq='D')
+
+    features = forecaster.create_features(history, fit_encoders=True)
+    recursive_model = _fit(features, 'daily_quantity')
+    direct_model = _fit(build_direct_training_frame(features, range(1, horizon + 1)), DIRECT_TARGET_COL)
+
+    engines = {
+        'recursive': BatchRecursiveForecaster(recursive_model, encoders=forecaster.encoders),
+        'direct': DirectMultiHorizonForecaster(direct_model, forecaster.create_features),
+    }
+    results = []
+    for mode, engine in engines.items():
+        start = time.perf_counter()
+        pred = engine.forecast(history, future_dates)
+        elapsed = time.perf_counter() - start
+        merged = pred.merge(actual, on=['chi_nhanh', 'ma_hang', 'forecast_date'])
+        results.append({
+            'mode': mode,
+            'series': n_series,
+            'horizon': horizon,
+            'seconds': round(elapsed, 3),
+            'mdape': round(median_absolute_percentage_error(
+                merged['daily_quantity'].to_numpy(), merged['predicted_quantity_raw'].to_numpy()), 4),
+            'mae': round(float(np.abs(merged['daily_quantity'] - merged['predicted_quantity_raw']).mean()), 4),
+        })
+    return pd.DataFrame(results)
+
+
+def _lambda_window_features(df: pd.DataFrame, windows) -> Dict[str, np.ndarray]:
+    """Cách tính cũ của create_features: 1 lambda transform cho mỗi series × statistic"""
+    grouped = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity']
+    result = {}
+    for window in windows:
+        for stat in ('mean', 'std', 'min', 'max'):
+            result[f'{stat}_{window}'] = grouped.transform(
+                lambda x: getattr(x.rolling(window, min_periods=1), stat)()).to_numpy()
+    for span in windows:
+        result[f'ema_{span}'] = grouped.transform(lambda x: x.ewm(span=span, adjust=False).mean()).to_numpy()
+    return result
+
+
+def _kernel_window_features(df: pd.DataFrame, windows) -> Dict[str, np.ndarray]:
+    """Grouped window kernels (feature_kernels.py)"""
+    group_ids = df.groupby(['chi_nhanh', 'ma_hang'], sort=False, dropna=False).ngroup().to_numpy()
+    quantity = df['daily_quantity'].to_numpy(dtype=np.float64)
+    result = grouped_rolling(quantity, group_ids, windows)
+    result.update({f'ema_{span}': v for span, v in grouped_ema(quantity, group_ids, windows).items()})
+    return result
+
+
+def bench_feature_kernels(n_series: int, n_days: int, windows=(7, 14, 30)) -> pd.DataFrame:
+    """So sánh thời gian rolling/EMA features: lambda transform vs grouped kernels"""
+    df = synthetic_sales(n_series, n_days).sort_values(['chi_nhanh', 'ma_hang', 'ngay']).reset_index(drop=True)
+    logger.info(f"   📊 {len(df):,} dòng, {n_series:,} series")
+
+    timings, outputs = {}, {}
+    for name, func in [('lambda_transform', _lambda_window_features), ('grouped_kernels', _kernel_window_features)]:
+        start = time.perf_counter()
+        outputs[name] = func(df, windows)
+        timings[name] = time.perf_counter() - start
+
+    reference, candidate = outputs['lambda_transform'], outputs['grouped_kernels']
+    max_diff = max(float(np.nanmax(np.abs(reference[k] - candidate[k]))) for k in reference)
+    nan_match = all(np.array_equal(np.isnan(reference[k]), np.isnan(candidate[k])) for k in reference)
+    return pd.DataFrame([{
+        'implementation': name,
+        'rows': len(df),
+        'seconds': round(seconds, 3),
+        'speedup': round(timings['lambda_transform'] / seconds, 1),
+        'max_abs_diff': max_diff if name == 'grouped_kernels' else 0.0,
+        'nan_match': nan_match if name == 'grouped_kernels' else True,
+    } for name, seconds in timings.items()])
+
+
+def synthetic_purchase_inputs(n_products: int = 5000, forecast_days: int = 14, seed: int = 42) -> Dict[str, pd.DataFrame]:
+    """Dữ liệu đầu vào generate_purchase_order_csv: dự báo, products, tồn kho, bán theo tuần/ngày"""
+    rng = np.random.default_rng(seed)
+    codes = np.array([f'SP{i:05d}' for i in range(n_products)])
+    base = rng.gamma(2.0, 3.0, size=n_products)
+    min_stock = rng.integers(0, 40, size=n_products).astype(float)
+
+    forecasts = pd.DataFrame({
+        'ma_hang': np.repeat(codes, forecast_days),
+        'ten_san_pham': np.repeat([f'San pham {c}' for c in codes], forecast_days),
+        'predicted_quantity': rng.poisson(np.repeat(base, forecast_days)).astype(float),
+        'last_week_sales': np.repeat(rng.poisson(base * 7), forecast_days).astype(float),
+        'ton_kho_nho_nhat': np.repeat(min_stock, forecast_days),
+    })
+    gia_von = rng.uniform(5000, 50000, size=n_products)
+    gia_von[rng.random(n_products) < 0.05] = 0
+    product_info = pd.DataFrame({
+        'ma_hang': codes,
+        'ma_vach': np.where(rng.random(n_products) < 0.1, None, [f'893{i:010d}' for i in range(n_products)]),
+        'ten_hang': np.where(rng.random(n_products) < 0.1, None, [f'Ten day du {c}' for c in codes]),
+        'gia_von_mac_dinh': gia_von,
+        'gia_ban_mac_dinh': gia_von * rng.uniform(1.0, 1.5, size=n_products),
+        'ton_nho_nhat': min_stock,
+    }).sample(frac=0.95, random_state=seed)      # 5% sản phẩm không có trong products
+    inventory = pd.DataFrame({'ma_hang': codes, 'ton_hien_tai': rng.integers(0, 200, size=n_products)}
+                             ).sample(frac=0.9, random_state=seed)
+
+    # Bán theo ngày 28 ngày (bỏ ngày không bán) → bán theo tuần
+    daily_qty = rng.poisson(np.repeat(base, 28) * (rng.random(n_products * 28) < 0.6))
+    daily = pd.DataFrame({'ma_hang': np.repeat(codes, 28), 'day': np.tile(np.arange(28), n_products),
+                          'daily_sold': daily_qty.astype(float)})
+    daily = daily[daily['daily_sold'] > 0].reset_index(drop=True)
+    daily['revenue'] = daily['daily_sold'] * 10000
+    weekly = (daily.assign(week_num=daily['day'] // 7).groupby(['ma_hang', 'week_num'], as_index=False)
+              .agg(weekly_sold=('daily_sold', 'sum'), weekly_revenue=('revenue', 'sum')))
+    return {'forecasts': forecasts, 'product_info_df': product_info, 'inventory_df': inventory,
+            'weekly_df': weekly, 'daily_df': daily[['ma_hang', 'daily_sold']]}
+
+
+def _loop_purchase_orders(forecasts, product_info_df, inventory_df, weekly_df, daily_df, top_n,
+                          lead_time_max=14, lead_time_avg=10, forecast_days=14) -> pd.DataFrame:
+    """Cách tính cũ của generate_purchase_order_csv: lọc/iterrows theo từng sản phẩm"""
+    product_list = forecasts['ma_hang'].unique().tolist()
+    product_info = {}
+    for _, row in product_info_df.iterrows():
+        product_info[row['ma_hang']] = {
+            'ma_vach': row['ma_vach'] or row['ma_hang'],
+            'ten_hang': row['ten_hang'],
+            'ton_nho_nhat': row['ton_nho_nhat'] or 0,
+            'margin': ((row['gia_ban_mac_dinh'] - row['gia_von_mac_dinh']) / row['gia_von_mac_dinh'] * 100)
+                      if row['gia_von_mac_dinh'] and row['gia_von_mac_dinh'] > 0 else 0
+        }
+    current_stock_map = dict(zip(inventory_df['ma_hang'], inventory_df['ton_hien_tai']))
+
+    optimal_inventory_map, sales_map, safety_stock_map = {}, {}, {}
+    for ma_hang in product_list:
+        product_weekly = weekly_df[weekly_df['ma_hang'] == ma_hang]
+        ton_nho_nhat = product_info.get(ma_hang, {}).get('ton_nho_nhat', 0)
+        if len(product_weekly) > 0:
+            weekly_optimal = [(week_row['weekly_sold'] or 0) + ton_nho_nhat * 0.75
+                              for _, week_row in product_weekly.iterrows()]
+            optimal_inventory_map[ma_hang] = round(np.median(weekly_optimal))
+            sales_map[ma_hang] = {'quantity_sold': product_weekly['weekly_sold'].sum() or 0,
+                                  'revenue': product_weekly['weekly_revenue'].sum() or 0}
+        product_daily = daily_df[daily_df['ma_hang'] == ma_hang]
+        if len(product_daily) >= 7:
+            daily_sold_list = product_daily['daily_sold'].tolist()
+            safety = max(daily_sold_list) * lead_time_max - sum(daily_sold_list) / len(daily_sold_list) * lead_time_avg
+            safety_stock_map[ma_hang] = max(0, round(safety))
+        else:
+            safety_stock_map[ma_hang] = round(ton_nho_nhat * 0.5)
+
+    forecast_col = f'forecast_{forecast_days}d'
+    summary = forecasts.groupby(['ma_hang', 'ten_san_pham']).agg({
+        'predicted_quantity': 'sum', 'last_week_sales': 'first', 'ton_kho_nho_nhat': 'first'}).reset_index()
+    summary.columns = ['ma_hang', 'ten_san_pham', forecast_col, 'last_week_sales', 'ton_kho_nho_nhat']
+    summary['ma_vach'] = summary['ma_hang'].map(lambda x: product_info.get(x, {}).get('ma_vach', x))
+    summary['ten_hang_day_du'] = summary['ma_hang'].map(lambda x: product_info.get(x, {}).get('ten_hang', ''))
+    summary['ton_nho_nhat'] = summary['ma_hang'].map(lambda x: product_info.get(x, {}).get('ton_nho_nhat', 0))
+    summary['ton_hien_tai'] = summary['ma_hang'].map(lambda x: current_stock_map.get(x, 0))
+    summary['ton_kho_toi_uu'] = summary['ma_hang'].map(lambda x: optimal_inventory_map.get(x, 0))
+    summary['ton_an_toan'] = summary['ma_hang'].map(lambda x: safety_stock_map.get(x, 0))
+    summary['da_ban_4tuan'] = summary['ma_hang'].map(lambda x: sales_map.get(x, {}).get('quantity_sold', 0))
+    summary['doanh_thu_4tuan'] = summary['ma_hang'].map(lambda x: sales_map.get(x, {}).get('revenue', 0))
+    summary['margin_pct'] = summary['ma_hang'].map(lambda x: product_info.get(x, {}).get('margin', 0))
+    summary['tong_ton_kho_muc_tieu'] = summary['ton_kho_toi_uu'] + summary['ton_an_toan']
+    summary['luong_can_nhap'] = (summary[forecast_col] * 1.5 - summary['last_week_sales']
+                                 - summary['ton_kho_nho_nhat']).clip(lower=0).round()
+    top = summary.sort_values(['luong_can_nhap', 'da_ban_4tuan', 'doanh_thu_4tuan'],
+                              ascending=[False, False, False]).head(top_n).copy()
+    top['is_high_margin'] = top['margin_pct'] > 20
+    top['is_high_value'] = top['doanh_thu_4tuan'] >= top['doanh_thu_4tuan'].quantile(0.8)
+
+    purchase_orders = []
+    for _, row in top.iterrows():
+        if row['luong_can_nhap'] > row['ton_hien_tai'] * 2:
+            uu_tien = '🔴 Cần gấp'
+        elif row['luong_can_nhap'] > 0:
+            uu_tien = '🟡 Cần đủ'
+        else:
+            uu_tien = '🟢 Đủ hàng'
+        ghi_chu = ''
+        if row['is_high_margin'] and row['is_high_value']:
+            ghi_chu = '⭐ HIGH MARGIN + HIGH VALUE'
+        elif row['is_high_margin']:
+            ghi_chu = '💰 HIGH MARGIN'
+        elif row['is_high_value']:
+            ghi_chu = '💎 HIGH VALUE'
+        purchase_orders.append({
+            'stt': len(purchase_orders) + 1,
+            'ma_hang': row['ma_hang'],
+            'ma_vach': row['ma_vach'],
+            'ten_san_pham': row['ten_hang_day_du'] or row['ten_san_pham'],
+            'luong_can_nhap': round(row['luong_can_nhap']),
+            'ton_kho_toi_uu': round(row['ton_kho_toi_uu']),
+            'ton_an_toan': round(row['ton_an_toan']),
+            'tong_muc_tieu': round(row['tong_ton_kho_muc_tieu']),
+            'ton_nho_nhat': round(row['ton_nho_nhat']),
+            'ton_hien_tai': round(row['ton_hien_tai']),
+            f'du_bao_{forecast_days}ngay': round(row[forecast_col]),
+            'da_ban_4tuan': round(row['da_ban_4tuan']),
+            'doanh_thu_4tuan': round(row['doanh_thu_4tuan']),
+            'margin_pct': round(row['margin_pct'], 1),
+            'uu_tien': uu_tien,
+            'ghi_chu': ghi_chu
+        })
+    return pd.DataFrame(purchase_orders)
+
+
+def _engine_purchase_orders(forecasts, product_info_df, inventory_df, weekly_df, daily_df, top_n,
+                            lead_time_max=14, lead_time_avg=10, forecast_days=14) -> pd.DataFrame:
+    """Engine groupby/merge (purchase_order.py)"""
+    top_products = rank_products(forecasts, product_info_df, inventory_df, weekly_df, daily_df, top_n,
+                                 lead_time_max, lead_time_avg, forecast_days)
+    return format_purchase_orders(top_products, forecast_days)
+
+
+def bench_purchase_orders(n_products: int, forecast_days: int = 14) -> pd.DataFrame:
+    """So sánh thời gian tạo đơn hàng cho toàn bộ catalog: vòng lặp theo sản phẩm vs groupby/merge"""
+    inputs = synthetic_purchase_inputs(n_products, forecast_days)
+    logger.info(f"   📊 {n_products:,} SKUs, {len(inputs['weekly_df']):,} dòng tuần, "
+                f"{len(inputs['daily_df']):,} dòng ngày")
+
+    timings, outputs = {}, {}
+    for name, func in [('per_product_loop', _loop_purchase_orders), ('groupby_engine', _engine_purchase_orders)]:
+        start = time.perf_counter()
+        outputs[name] = func(**inputs, top_n=n_products, forecast_days=forecast_days)
+        timings[name] = time.perf_counter() - start
+
+    reference, candidate = outputs['per_product_loop'], outputs['groupby_engine']
+    numeric_cols = reference.select_dtypes('number').columns
+    max_diff = float(np.abs(reference[numeric_cols].to_numpy(float) - candidate[numeric_cols].to_numpy(float)).max())
+    text_match = reference.drop(columns=numeric_cols).astype(str).equals(candidate.drop(columns=numeric_cols).astype(str))
+    return pd.DataFrame([{
+        'implementation': name,
+        'skus': n_products,
+        'seconds': round(seconds, 3),
+        'speedup': round(timings['per_product_loop'] / seconds, 1),
+        'max_abs_diff': max_diff if name == 'groupby_engine' else 0.0,
+        'text_match': text_match if name == 'groupby_engine' else True,
+    } for name, seconds in timings.items()])
+
+
+CASES = {
+    'forecast-mode': lambda args: bench_forecast_modes(args.series, args.days, args.horizon),
+    'features': lambda args: bench_feature_kernels(args.series, args.days),
+    'purchase-order': lambda args: bench_purchase_orders(args.series, args.horizon),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ML pipeline trên dữ liệu giả lập')
+    parser.add_argument('--case', choices=list(CASES), default='forecast-mode',
+                        help='Benchmark cần chạy (default: forecast-mode)')
+    parser.add_argument('--series', type=int, default=500, help='Số series (chi_nhanh, ma_hang) / số SKU cho purchase-order')
+    parser.add_argument('--days', type=int, default=120, help='Số ngày lịch sử mỗi series')
+    parser.add_argument('--horizon', type=int, default=14, help='Số ngày dự báo')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    logger.info(f"⏱️  Benchmark: {args.case}")
+    result = CASES[args.case](args)
+    logger.info("\n" + result.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
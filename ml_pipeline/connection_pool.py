@@ -0,0 +1,225 @@
+"""
+Quản lý connection dùng chung cho PostgreSQL và ClickHouse
+
+Trước đây mỗi PostgreSQLConnector tạo engine riêng (pool mặc định) và mỗi
+ClickHouseConnector giữ một native Client; SalesForecaster, PipelineMonitor và
+các task Airflow trong cùng process đều handshake lại từ đầu. Module này:
+    - get_pg_engine(): một SQLAlchemy engine cho mỗi URL trong process, pool cấu hình
+      qua env (PG_POOL_SIZE, PG_MAX_OVERFLOW, PG_POOL_RECYCLE, PG_POOL_PRE_PING)
+    - get_clickhouse_pool(): pool nhỏ các native Client (CLICKHOUSE_POOL_SIZE) cho query
+      song song - một Client không thread-safe nên mỗi thread checkout một client
+    - connection_stats(): số lần connect/handshake, tổng thời gian handshake và số
+      checkout dùng lại connection có sẵn
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE', '5'))
+PG_MAX_OVERFLOW = int(os.getenv('PG_MAX_OVERFLOW', '5'))
+PG_POOL_RECYCLE = int(os.getenv('PG_POOL_RECYCLE', '1800'))  # giây
+PG_POOL_PRE_PING = os.getenv('PG_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+CLICKHOUSE_POOL_SIZE = int(os.getenv('CLICKHOUSE_POOL_SIZE', '4'))
+CLICKHOUSE_POOL_TIMEOUT = float(os.getenv('CLICKHOUSE_POOL_TIMEOUT', '60'))  # giây chờ client rảnh
+
+
+class ConnectionMetrics:
+    """Bộ đếm connect/handshake và checkout theo backend (postgres, clickhouse)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _backend(self, backend: str) -> Dict[str, float]:
+        return self._stats.setdefault(backend, {'connects': 0, 'connect_seconds': 0.0, 'checkouts': 0})
+
+    def record_connect(self, backend: str, seconds: float):
+        with self._lock:
+            stats = self._backend(backend)
+            stats['connects'] += 1
+            stats['connect_seconds'] += seconds
+
+    def record_checkout(self, backend: str):
+        with self._lock:
+            self._backend(backend)['checkouts'] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            result = {}
+            for backend, stats in self._stats.items():
+                connects, checkouts = int(stats['connects']), int(stats['checkouts'])
+                result[backend] = {
+                    'connects': connects,
+                    'checkouts': checkouts,
+                    # Checkout không phải handshake mới = connection được dùng lại
+                    'reused': max(checkouts - connects, 0),
+                    'connect_seconds': round(stats['connect_seconds'], 4),
+                    'avg_connect_ms': round(stats['connect_seconds'] / connects * 1000, 2) if connects else 0.0,
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+METRICS = ConnectionMetrics()
+
+_lock = threading.Lock()
+_pg_engines: Dict[str, Engine] = {}
+_ch_pools: Dict[tuple, 'ClickHousePool'] = {}
+
+
+def _instrument_engine(engine: Engine):
+    """Đo thời gian connect DBAPI (do_connect → connect) và đếm checkout của pool"""
+
+    @event.listens_for(engine, 'do_connect')
+    def _mark_connect_start(dialect, conn_rec, cargs, cparams):
+        conn_rec.info['connect_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'connect')
+    def _record_connect(dbapi_connection, conn_rec):
+        started = conn_rec.info.pop('connect_started', None)
+        METRICS.record_connect('postgres', time.perf_counter() - started if started else 0.0)
+
+    @event.listens_for(engine, 'checkout')
+    def _record_checkout(dbapi_connection, conn_rec, conn_proxy):
+        METRICS.record_checkout('postgres')
+
+
+def get_pg_engine(url: str, pool_size: int = PG_POOL_SIZE, max_overflow: int = PG_MAX_OVERFLOW,
+                  pool_recycle: int = PG_POOL_RECYCLE, pool_pre_ping: bool = PG_POOL_PRE_PING) -> Engine:
+    """
+    SQLAlchemy engine dùng chung cho URL (tạo lần đầu, các lần sau trả về engine có sẵn)
+
+    Args:
+        pool_size: Số connection giữ trong pool
+        max_overflow: Số connection tạm thêm khi pool hết
+        pool_recycle: Tạo lại connection sau N giây (tránh server/proxy cắt connection idle)
+        pool_pre_ping: Kiểm tra connection trước khi checkout
+    """
+    with _lock:
+        engine = _pg_engines.get(url)
+        if engine is None:
+            engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                   pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+            _instrument_engine(engine)
+            _pg_engines[url] = engine
+        return engine
+
+
+class ClickHousePool:
+    """
+    Pool các clickhouse_driver.Client (tạo lazy, tối đa size client)
+
+    Mỗi client giữ một native connection; handshake được đo khi client mới connect.
+    Client bị lỗi vẫn được trả lại pool - driver tự reconnect ở lần execute sau.
+    """
+
+    def __init__(self, size: int = CLICKHOUSE_POOL_SIZE, timeout: float = CLICKHOUSE_POOL_TIMEOUT,
+                 **client_kwargs):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.client_kwargs = client_kwargs
+        self._idle: 'queue.LifoQueue' = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def new_client(self):
+        """
+        Client mới ngoài pool (cùng cấu hình, handshake được đo) - caller tự quản lý
+        và disconnect; dùng khi cần giữ client lâu dài thay vì checkout theo query
+        """
+        from clickhouse_driver import Client
+
+        client = Client(**self.client_kwargs)
+        started = time.perf_counter()
+        try:
+            client.connection.force_connect()
+        except Exception as e:
+            # Chưa connect được (server chưa sẵn sàng) - driver connect lại khi execute
+            logger.warning(f"⚠️ ClickHouse handshake thất bại, sẽ thử lại khi query: {e}")
+        else:
+            METRICS.record_connect('clickhouse', time.perf_counter() - started)
+        return client
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self.new_client()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=self.timeout)
+
+    @contextmanager
+    def client(self) -> Iterator:
+        """Checkout một client cho thread hiện tại, trả lại pool khi xong"""
+        client = self._acquire()
+        METRICS.record_checkout('clickhouse')
+        try:
+            yield client
+        finally:
+            self._idle.put(client)
+
+    def disconnect_all(self):
+        while True:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            client.disconnect()
+            with self._lock:
+                self._created -= 1
+
+
+def get_clickhouse_pool(size: int = CLICKHOUSE_POOL_SIZE, **client_kwargs) -> ClickHousePool:
+    """Pool ClickHouse dùng chung theo (host, port, database, user, settings)"""
+    key = tuple(sorted((k, repr(v)) for k, v in client_kwargs.items()))
+    with _lock:
+        pool = _ch_pools.get(key)
+        if pool is None:
+            pool = ClickHousePool(size=size, **client_kwargs)
+            _ch_pools[key] = pool
+        return pool
+
+
+def connection_stats() -> Dict[str, Dict[str, float]]:
+    return METRICS.snapshot()
+
+
+def log_connection_stats(prefix: str = "🔌 Connections"):
+    for backend, stats in connection_stats().items():
+        logger.info(f"{prefix} [{backend}]: {stats['connects']} handshakes "
+                    f"({stats['connect_seconds']:.3f}s, avg {stats['avg_connect_ms']:.1f}ms), "
+                    f"{stats['checkouts']} checkouts, {stats['reused']} reused")
+
+
+def dispose_all():
+    """Đóng toàn bộ connections (cuối process / test)"""
+    with _lock:
+        for engine in _pg_engines.values():
+            engine.dispose()
+        _pg_engines.clear()
+        for pool in _ch_pools.values():
+            pool.disconnect_all()
+        _ch_pools.clear()
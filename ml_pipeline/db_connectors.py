@@ -2,13 +2,22 @@
 Database connectors cho PostgreSQL, ClickHouse
 """
 
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import date
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from clickhouse_driver import Client as ClickHouseClient
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any
+from itertools import islice
 import logging
 from contextlib import contextmanager
 
+from connection_pool import get_pg_engine, get_clickhouse_pool
+
 logger = logging.getLogger(__name__)
 
 
@@ -29,7 +38,8 @@ class PostgreSQLConnector:
         self.connection_string = (
             f"postgresql://{user}:{password}@{host}:{port}/{database}"
         )
-        self.engine = create_engine(self.connection_string)
+        # Engine dùng chung trong process (pool size/pre-ping/recycle theo env PG_POOL_*)
+        self.engine = get_pg_engine(self.connection_string)
     
     @contextmanager
     def get_connection(self):
@@ -227,6 +237,129 @@ class PostgreSQLConnector:
             return pd.read_sql(text(query), conn, params=params)
 
 
+CLICKHOUSE_COLUMNAR = os.getenv('CLICKHOUSE_COLUMNAR', 'true').lower() in ('1', 'true', 'yes')
+# Số dòng mỗi block khi stream kết quả lớn (iter_blocks)
+CLICKHOUSE_BLOCK_ROWS = int(os.getenv('CLICKHOUSE_BLOCK_ROWS', '100000'))
+# Đọc query training theo block dòng (iter_blocks) thay vì columnar query(): ít bộ nhớ hơn
+# nhưng chậm hơn (driver trả tuple từng dòng) - chỉ bật khi kết quả không vừa bộ nhớ
+CLICKHOUSE_STREAM_BLOCKS = os.getenv('CLICKHOUSE_STREAM_BLOCKS', 'false').lower() in ('1', 'true', 'yes')
+
+# Query cache (cached_query): LRU + TTL, xoá toàn bộ khi data version đổi
+QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE', 'true').lower() in ('1', 'true', 'yes')
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '600'))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '128'))
+# Khoảng (giây) giữa hai lần kiểm tra data version - tối đa một round-trip mỗi khoảng
+QUERY_CACHE_VERSION_INTERVAL = float(os.getenv('QUERY_CACHE_VERSION_INTERVAL', '30'))
+DATA_VERSION_QUERY = """
+SELECT toString(max(transaction_date)) as max_date, toString(max(etl_timestamp)) as etl_timestamp
+FROM retail_dw.fct_regular_sales
+"""
+
+
+def _column_values(values, ch_type: str):
+    """
+    Cột numpy từ driver → giá trị cho DataFrame với dtype đúng:
+    Date/DateTime → datetime64[ns], LowCardinality → category, Nullable số → float (NaN).
+    """
+    base_type = ch_type
+    for wrapper in ('LowCardinality(', 'Nullable('):
+        if base_type.startswith(wrapper):
+            base_type = base_type[len(wrapper):-1]
+    if base_type.startswith('Date'):
+        return pd.to_datetime(values).as_unit('ns')
+    if ch_type.startswith('LowCardinality('):
+        return values if isinstance(values, pd.Categorical) else pd.Categorical(values)
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        # Nullable số: [1.0, None] → float64 NaN (giống suy luận dtype của đường theo dòng)
+        return pd.Series(values, copy=False).infer_objects().to_numpy()
+    return values
+
+
+def key_set_table(name: str, column: str, values) -> Dict[str, Any]:
+    """
+    External table (clickhouse-driver external_tables) chứa một tập mã (sản phẩm, category)
+    
+    Tập mã được gửi cùng query dưới dạng block Native (binary) thay cho chuỗi IN ('a', 'b', ...):
+    ClickHouse không phải parse literal dài, không có injection qua mã. Query dùng:
+        WHERE f.product_code IN (SELECT {column} FROM {name})
+    Client luôn bật use_numpy nên data là DataFrame theo cột.
+    """
+    codes = pd.unique(pd.Series(list(values), dtype=object).astype(str))
+    return {'name': name, 'structure': [(column, 'String')], 'data': pd.DataFrame({column: codes})}
+
+
+def product_set_table(product_codes) -> Dict[str, Any]:
+    """Tập mã sản phẩm: external table product_set(product_code String)"""
+    return key_set_table('product_set', 'product_code', product_codes)
+
+
+class QueryCache:
+    """
+    Cache kết quả query nhỏ (kiểm tra bảng, seasonal factors, danh sách sản phẩm...)
+    
+    - LRU theo số entries, mỗi entry hết hạn sau ttl giây
+    - set_version(): data version (max ngày + etl_timestamp) đổi → xoá toàn bộ cache
+    - Trả về bản copy để caller sửa DataFrame không làm hỏng cache
+    """
+    
+    _UNSET = object()
+    
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES, ttl: float = QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = self._UNSET
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key → (expires_at, DataFrame)
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1].copy()
+    
+    def put(self, key: str, df: pd.DataFrame, ttl: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), df.copy())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def set_version(self, version) -> bool:
+        """Cập nhật data version; True nếu version đổi (cache đã bị xoá)"""
+        with self._lock:
+            if version == self.version:
+                return False
+            changed = self.version is not self._UNSET
+            self.version = version
+            if changed:
+                self._entries.clear()
+                self.invalidations += 1
+            return changed
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'entries': len(self._entries),
+            'invalidations': self.invalidations,
+        }
+
+
 class ClickHouseConnector:
     """Connector cho ClickHouse (Data Warehouse) sử dụng Native Driver"""
     
@@ -235,7 +368,6 @@ class ClickHouseConnector:
                  password: str = None):
         # Lấy từ env vars nếu không được truyền
         import os
-        from clickhouse_driver import Client
         
         self.host = host or os.getenv('CLICKHOUSE_HOST', 'clickhouse')
         self.port = port or int(os.getenv('CLICKHOUSE_PORT', '9000'))
@@ -243,8 +375,9 @@ class ClickHouseConnector:
         self.user = user or os.getenv('CLICKHOUSE_USER', 'default')
         self.password = password or os.getenv('CLICKHOUSE_PASSWORD', 'clickhouse_password')
         
-        # Khởi tạo native client
-        self.client = Client(
+        # Pool native clients dùng chung trong process (CLICKHOUSE_POOL_SIZE): mỗi query
+        # checkout một client nên các thread có thể query song song
+        self.pool = get_clickhouse_pool(
             host=self.host,
             port=self.port,
             database=self.database,
@@ -252,10 +385,135 @@ class ClickHouseConnector:
             password=self.password,
             settings={'use_numpy': True}
         )
+        self._direct_client = None
+        self.query_cache = QueryCache()
+        self._version_checked_at = None
+    
+    @property
+    def client(self):
+        """Client riêng (ngoài pool) cho code gọi trực tiếp client.execute, vd. PipelineMonitor"""
+        if self._direct_client is None:
+            self._direct_client = self.pool.new_client()
+        return self._direct_client
+    
+    def query(self, query: str, columnar: Optional[bool] = None,
+              external_tables: Optional[List[Dict]] = None) -> pd.DataFrame:
+        """
+        Execute query và trả về DataFrame sử dụng native driver
+        
+        Mặc định fetch columnar: driver (use_numpy) trả về từng cột dạng numpy array và
+        DataFrame được dựng trực tiếp từ các cột, không qua tuple cho từng dòng.
+        CLICKHOUSE_COLUMNAR=false (hoặc columnar=False) → đường cũ theo dòng.
+        
+        Args:
+            external_tables: Bảng tạm gửi kèm query (key_set_table / product_set_table)
+        """
+        if columnar is None:
+            columnar = CLICKHOUSE_COLUMNAR
+        if not columnar:
+            return self._query_rows(query, external_tables)
+        
+        with self.pool.client() as client:
+            data, columns_info = client.execute(query, with_column_types=True, columnar=True,
+                                                external_tables=external_tables)
+        columns = [col[0] for col in columns_info]
+        if not data or len(data[0]) == 0:
+            return pd.DataFrame(columns=columns)
+        
+        # Dựng theo vị trí rồi gán tên (giữ nguyên cột trùng tên như đường theo dòng)
+        df = pd.DataFrame({i: _column_values(values, ch_type)
+                           for i, (values, (_, ch_type)) in enumerate(zip(data, columns_info))})
+        df.columns = columns
+        return df
+    
+    def cached_query(self, query: str, ttl: Optional[float] = None) -> pd.DataFrame:
+        """
+        query() qua QueryCache - chỉ dùng cho query nhỏ, lặp lại nhiều lần trong một lần chạy
+        
+        Cache bị xoá khi data version của fct_regular_sales đổi (kiểm tra tối đa một lần mỗi
+        QUERY_CACHE_VERSION_INTERVAL giây). Query dùng today() có key theo ngày.
+        """
+        if not QUERY_CACHE_ENABLED:
+            return self.query(query)
+        self._refresh_data_version()
+        key = ' '.join(query.split())
+        if 'today()' in key:
+            key = f'{date.today().isoformat()}|{key}'
+        df = self.query_cache.get(key)
+        if df is not None:
+            return df
+        df = self.query(query)
+        self.query_cache.put(key, df, ttl)
+        return df
+    
+    def _refresh_data_version(self):
+        now = time.monotonic()
+        if self._version_checked_at is not None and now - self._version_checked_at < QUERY_CACHE_VERSION_INTERVAL:
+            return
+        self._version_checked_at = now
+        try:
+            with self.pool.client() as client:
+                rows = client.execute(DATA_VERSION_QUERY)
+            version = tuple(rows[0]) if rows else None
+        except Exception as e:
+            # Chưa có fct_regular_sales (DBT chưa chạy) → version None, cache vẫn theo TTL
+            logger.debug(f"Không lấy được data version: {e}")
+            version = None
+        if self.query_cache.set_version(version):
+            logger.info(f"🔄 Data version đổi → {version}, xoá query cache")
     
-    def query(self, query: str) -> pd.DataFrame:
-        """Execute query và trả về DataFrame sử dụng native driver"""
-        result = self.client.execute(query, with_column_types=True)
+    def iter_blocks(self, query: str, block_rows: int = CLICKHOUSE_BLOCK_ROWS,
+                    external_tables: Optional[List[Dict]] = None) -> Iterator[pd.DataFrame]:
+        """
+        Stream kết quả query thành các DataFrame block tối đa block_rows dòng (execute_iter)
+        
+        Mỗi block có cùng dtype như query() (Date → datetime64[ns], LowCardinality → category,
+        Nullable số → float). Bộ nhớ khi đọc chỉ giữ một block; caller lọc/tổng hợp từng block
+        rồi mới ghép. Kết quả rỗng vẫn yield một block rỗng có đủ cột (giữ schema).
+        
+        execute_iter của driver chỉ trả dòng (tuple) nên đường này chậm hơn query() columnar -
+        chỉ dùng khi cần giới hạn bộ nhớ (CLICKHOUSE_STREAM_BLOCKS).
+        """
+        with self.pool.client() as client:
+            completed = False
+            try:
+                rows = client.execute_iter(query, with_column_types=True, external_tables=external_tables,
+                                           settings={'max_block_size': block_rows})
+                columns_info = next(rows, None)
+                if columns_info is None:
+                    completed = True
+                    return
+                columns = [col[0] for col in columns_info]
+                
+                n_blocks = 0
+                while True:
+                    batch = list(islice(rows, block_rows))
+                    if not batch:
+                        break
+                    n_blocks += 1
+                    yield self._rows_to_block(batch, columns_info)
+                    del batch
+                completed = True
+                if n_blocks == 0:
+                    yield pd.DataFrame(columns=columns)
+            finally:
+                # Caller dừng giữa chừng: connection còn dở kết quả → ngắt trước khi trả về pool
+                if not completed:
+                    client.disconnect()
+    
+    @staticmethod
+    def _rows_to_block(batch: List[tuple], columns_info: List[tuple]) -> pd.DataFrame:
+        """Chuyển batch dòng → DataFrame theo cột (dtype theo kiểu ClickHouse)"""
+        values = [np.fromiter(col, dtype=object, count=len(batch)) for col in zip(*batch)]
+        df = pd.DataFrame({i: _column_values(col, ch_type)
+                           for i, (col, (_, ch_type)) in enumerate(zip(values, columns_info))})
+        df.columns = [col[0] for col in columns_info]
+        return df
+    
+    def _query_rows(self, query: str, external_tables: Optional[List[Dict]] = None) -> pd.DataFrame:
+        """Fetch theo dòng (tuple) - giữ làm fallback"""
+        with self.pool.client() as client:
+            result = client.execute(query, with_column_types=True, external_tables=external_tables)
         
         if not result[0]:
             # Empty result - create DataFrame with correct columns
@@ -273,14 +531,15 @@ class ClickHouseConnector:
         columns = df.columns.tolist()
         
         # Insert theo batch
-        for i in range(0, len(df), batch_size):
-            batch_df = df.iloc[i:i+batch_size]
-            
-            # Convert to records
-            data = [tuple(row) for row in batch_df.values]
-            
-            query = f"INSERT INTO {self.database}.{table} ({', '.join(columns)}) VALUES"
-            self.client.execute(query, data)
+        with self.pool.client() as client:
+            for i in range(0, len(df), batch_size):
+                batch_df = df.iloc[i:i+batch_size]
+                
+                # Convert to records
+                data = [tuple(row) for row in batch_df.values]
+                
+                query = f"INSERT INTO {self.database}.{table} ({', '.join(columns)}) VALUES"
+                client.execute(query, data)
         
         logger.info(f"Inserted {len(df)} rows into {table}")
 
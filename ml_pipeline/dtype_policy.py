@@ -0,0 +1,98 @@
+"""
+Dtype policy cho training frame
+
+create_features trước đây để mọi cột ở float64/int64 (kể cả cờ 0/1, ngày trong
+tháng, code categorical) và làm sạch NaN/inf từng cột một. Policy ở đây:
+    - int8/int16 cho calendar, cờ và code categorical (theo khoảng giá trị thực tế)
+    - float32 cho lag/rolling/EMA/growth/seasonal factors - XGBoost vốn build
+      DMatrix ở float32 nên không mất độ chính xác khi train, lại tránh một bản
+      copy float64 → float32 bên trong xgboost
+    - target/metrics gốc (daily_quantity, daily_revenue, ...) giữ float64 để
+      metrics và tổng hợp không đổi
+    - NaN/inf → 0 trong một pass vectorized trên block float32
+    - category dtype cho string keys (chỉ dùng cho training frame: các groupby
+      trên keys cần observed=True)
+"""
+
+import logging
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Cột giữ float64 (target + metrics gốc)
+TARGET_COLUMNS = ('daily_quantity', 'daily_revenue', 'daily_profit', 'transaction_count',
+                  'category_daily_quantity')
+# Dtype cố định (không phụ thuộc dữ liệu) để schema feature store ổn định giữa các lần refresh
+INT_COLUMN_DTYPES = {
+    'day_of_week': np.int8, 'day_of_month': np.int8, 'month': np.int8, 'quarter': np.int8,
+    'week_of_year': np.int8, 'day_of_year': np.int16, 'is_weekend': np.int8,
+    'is_month_start': np.int8, 'is_month_end': np.int8, 'is_holiday': np.int8,
+    'is_peak_day': np.int8, 'peak_level': np.int8,
+}
+# Code categorical: dtype theo số category (cột này không lưu trong feature store)
+ENCODED_COLUMNS = ('branch_encoded', 'category1_encoded', 'category2_encoded', 'brand_encoded', 'abc_encoded')
+CATEGORICAL_KEY_COLUMNS = ('chi_nhanh', 'ma_hang', 'nhom_hang_cap_1', 'nhom_hang_cap_2')
+
+
+def smallest_int_dtype(values: np.ndarray) -> np.dtype:
+    """int8/int16/int32/int64 nhỏ nhất chứa được khoảng giá trị"""
+    if len(values) == 0:
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _clean_block(df: pd.DataFrame, columns: list, dtype) -> None:
+    """Ép kiểu + NaN/inf → 0 cho cả block cột trong một pass"""
+    if not columns:
+        return
+    # Column-major: mỗi cột gán lại là một view liên tục của block
+    block = np.empty((len(df), len(columns)), dtype=dtype, order='F')
+    for i, col in enumerate(columns):
+        block[:, i] = df[col].to_numpy()
+    block[~np.isfinite(block)] = 0
+    for i, col in enumerate(columns):
+        df[col] = block[:, i]
+
+
+def apply_dtype_policy(df: pd.DataFrame, keep_float64: Iterable[str] = TARGET_COLUMNS) -> pd.DataFrame:
+    """
+    Áp dụng dtype policy tại chỗ (df bị sửa và được trả về).
+
+    Args:
+        df: Frame features (output của create_features)
+        keep_float64: Các cột float giữ nguyên float64 (chỉ làm sạch NaN/inf)
+    """
+    keep_float64 = set(keep_float64)
+    float_cols = [c for c in df.columns if pd.api.types.is_float_dtype(df[c].dtype)]
+    _clean_block(df, [c for c in float_cols if c not in keep_float64], np.float32)
+    _clean_block(df, [c for c in float_cols if c in keep_float64], np.float64)
+
+    for col, dtype in INT_COLUMN_DTYPES.items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    for col in ENCODED_COLUMNS:
+        if col in df.columns:
+            dtype = smallest_int_dtype(df[col].to_numpy())
+            if df[col].dtype != dtype:
+                df[col] = df[col].astype(dtype)
+    return df
+
+
+def categorize_keys(df: pd.DataFrame, columns: Iterable[str] = CATEGORICAL_KEY_COLUMNS) -> pd.DataFrame:
+    """String keys → category dtype (tại chỗ)"""
+    for col in columns:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def frame_memory_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
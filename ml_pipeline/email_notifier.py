@@ -327,6 +327,7 @@ class EmailNotifier:
         # Sử dụng Validation metrics làm primary (chỉ báo validation cho end user)
         model_info_map = {
             'daily_quantity': ('Product Quantity (Model 1)', 'cv_mdape', 'val_mdape', 'MdAPE'),
+            'daily_quantity_shards': ('Product Quantity (Model 1, sharded)', 'cv_mdape', 'val_mdape', 'MdAPE'),
             'profit_margin': ('Profit Margin (Model 2)', 'cv_mae', 'val_mae', 'MAE'),
             'category_daily_quantity': ('Category Trend (Model 2)', 'cv_mape', 'val_mape', 'MAPE')
         }
@@ -0,0 +1,98 @@
+"""
+Categorical encoders cố định cho training và prediction
+
+Trước đây create_features tính code bằng pd.Categorical(...).codes trên frame được
+truyền vào, nên code phụ thuộc tập giá trị của frame: khi predict một sản phẩm,
+mọi code đều về 0 và khác code lúc training.
+
+CategoricalEncoders được fit một lần lúc training, lưu cạnh product_quantity_model.pkl
+(categorical_encoders.pkl) và chỉ được tra cứu (vectorized) khi predict.
+Giá trị chưa gặp lúc fit được gán UNKNOWN_CODE.
+"""
+
+import os
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import joblib
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+ENCODERS_FILENAME = 'categorical_encoders.pkl'
+UNKNOWN_CODE = -1
+
+# feature → (cột gốc, giá trị fill cho NA); fill None: NA rơi vào UNKNOWN_CODE
+ENCODED_COLUMNS = {
+    'branch_encoded': ('chi_nhanh', None),
+    'category1_encoded': ('nhom_hang_cap_1', None),
+    'category2_encoded': ('nhom_hang_cap_2', None),
+    'brand_encoded': ('thuong_hieu', 'Unknown'),
+    'abc_encoded': ('abc_class', 'C'),
+}
+_FILL_VALUES = {column: fill_value for column, fill_value in ENCODED_COLUMNS.values()}
+
+
+class CategoricalEncoders:
+    """Registry mapping giá trị → code cho các cột categorical"""
+
+    def __init__(self, categories: Optional[Dict[str, List[str]]] = None):
+        # {cột gốc: danh sách giá trị đã sort}, code = vị trí trong danh sách
+        self.categories = categories or {}
+        self._indexes = {col: pd.Index(values) for col, values in self.categories.items()}
+
+    @property
+    def is_fitted(self) -> bool:
+        return bool(self.categories)
+
+    def fit(self, df: pd.DataFrame) -> 'CategoricalEncoders':
+        """Fit trên dữ liệu training: code = thứ tự sort của giá trị (giống pd.Categorical)"""
+        return self.fit_chunks([df])
+
+    def fit_chunks(self, frames: Iterable[pd.DataFrame]) -> 'CategoricalEncoders':
+        """Fit trên nhiều frame (streaming training): categories = hợp các giá trị của mọi chunk"""
+        seen: Dict[str, set] = {}
+        for df in frames:
+            for _, (column, fill_value) in ENCODED_COLUMNS.items():
+                if column not in df.columns:
+                    continue
+                values = df[column] if fill_value is None else df[column].fillna(fill_value)
+                seen.setdefault(column, set()).update(values.dropna().astype(str).unique().tolist())
+        for column, values in seen.items():
+            self.categories[column] = sorted(values)
+            self._indexes[column] = pd.Index(self.categories[column])
+        logger.info("🔤 Fitted categorical encoders: " +
+                    ", ".join(f"{col}={len(values)}" for col, values in self.categories.items()))
+        return self
+
+    def encode(self, column: str, values) -> np.ndarray:
+        """Tra cứu code cho một cột (giá trị lạ/NA → UNKNOWN_CODE)"""
+        if column not in self._indexes:
+            return np.full(len(values), UNKNOWN_CODE, dtype=int)
+        fill_value = _FILL_VALUES.get(column)
+        values = pd.Series(values)
+        if fill_value is not None:
+            values = values.fillna(fill_value)
+        codes = self._indexes[column].get_indexer(values.astype(str).where(values.notna(), None))
+        return codes.astype(int)
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Thêm các cột *_encoded cho những cột gốc có trong df"""
+        for feature, (column, _) in ENCODED_COLUMNS.items():
+            if column in df.columns:
+                df[feature] = self.encode(column, df[column].to_numpy())
+        return df
+
+    def save(self, model_dir: str) -> str:
+        path = os.path.join(model_dir, ENCODERS_FILENAME)
+        joblib.dump(self.categories, path)
+        return path
+
+    @classmethod
+    def load(cls, model_dir: str) -> Optional['CategoricalEncoders']:
+        """Load encoders đã lưu; None nếu chưa có (model train trước khi có encoders)"""
+        path = os.path.join(model_dir, ENCODERS_FILENAME)
+        if not os.path.exists(path):
+            return None
+        return cls(joblib.load(path))
@@ -0,0 +1,182 @@
+"""
+Out-of-core training cho Model 1 trên toàn bộ lịch sử
+
+Với --days 0, train_all_models giữ toàn bộ fct_regular_sales + features trong
+pandas. Streaming mode giới hạn bộ nhớ theo kích thước chunk:
+    1. Feature store được materialize theo từng cụm EXTERNAL_MEMORY_CHUNK_DAYS ngày
+       (FeatureStore.refresh với lookback đọc lại từ chính store)
+    2. FeatureChunkIter (xgb.DataIter) đọc lần lượt từng cụm partition, trả block
+       float32 cho XGBoost; XGBoost ghi cache pages (quantized) ra đĩa ở cache_prefix
+    3. Train trên ExtMemQuantileDMatrix (xgboost >= 3.0), fallback DMatrix(DataIter)
+
+Không chạy Optuna trong streaming mode: params lấy từ study lần train trước
+(tuning.load_previous_study) hoặc DEFAULT_PARAMS, số rounds chọn bằng early stopping
+trên các ngày cuối (validation chunks).
+"""
+
+import os
+import shutil
+import logging
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+logger = logging.getLogger(__name__)
+
+EXTERNAL_MEMORY_CHUNK_DAYS = int(os.getenv('EXTERNAL_MEMORY_CHUNK_DAYS', '30'))
+# Lookback khi materialize theo chunk: chỉ scan keys của N ngày trước chunk
+STREAMING_LOOKBACK_DAYS = int(os.getenv('STREAMING_LOOKBACK_DAYS', '365'))
+# Chunk đầu khi rebuild store: create_features cần > 30 ngày để tạo lag_30/rolling_30
+MIN_FIRST_CHUNK_DAYS = 31
+VALIDATION_FRACTION = 0.2
+EXTMEM_QUANTILE_AVAILABLE = hasattr(xgb, 'ExtMemQuantileDMatrix')
+
+DEFAULT_PARAMS = {
+    'objective': 'reg:squarederror',
+    'max_depth': 6,
+    'learning_rate': 0.05,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'min_child_weight': 3,
+}
+
+
+def date_chunks(dates: Sequence[date], chunk_days: int = EXTERNAL_MEMORY_CHUNK_DAYS,
+                first_chunk_days: Optional[int] = None) -> List[Tuple[date, date]]:
+    """Cụm [start, end) gồm tối đa chunk_days ngày có dữ liệu (chunk đầu ít nhất first_chunk_days)"""
+    dates = sorted(dates)
+    if not dates:
+        return []
+    bounds = [0]
+    size = max(chunk_days, first_chunk_days or 0)
+    while bounds[-1] + size < len(dates):
+        bounds.append(bounds[-1] + size)
+        size = chunk_days
+    chunks = []
+    for i, lo in enumerate(bounds):
+        end = dates[bounds[i + 1]] if i + 1 < len(bounds) else dates[-1] + timedelta(days=1)
+        chunks.append((dates[lo], end))
+    return chunks
+
+
+def split_chunks(dates: Sequence[date], chunk_days: int = EXTERNAL_MEMORY_CHUNK_DAYS,
+                 validation_fraction: float = VALIDATION_FRACTION) -> Tuple[List[Tuple[date, date]], List[Tuple[date, date]]]:
+    """(train chunks, validation chunks): validation = validation_fraction số ngày cuối"""
+    dates = sorted(dates)
+    n_val = max(1, int(round(len(dates) * validation_fraction))) if len(dates) > 1 else 0
+    split = len(dates) - n_val
+    return date_chunks(dates[:split], chunk_days), date_chunks(dates[split:], chunk_days)
+
+
+class FeatureChunkIter(xgb.DataIter):
+    """
+    Duyệt feature store theo cụm ngày, mỗi lần next() đưa một block (X float32, y)
+    cho XGBoost. Chỉ một chunk nằm trong bộ nhớ tại một thời điểm.
+    """
+
+    def __init__(self, load_chunk: Callable[[date, date], pd.DataFrame], chunks: List[Tuple[date, date]],
+                 feature_cols: List[str], target_col: str, cache_prefix: Optional[str] = None):
+        """
+        Args:
+            load_chunk: (start, end) → DataFrame features đã encode (FeatureStore.load_range)
+            chunks: Các cụm [start, end)
+            feature_cols: Thứ tự cột features của model
+            target_col: Cột target
+            cache_prefix: Thư mục/prefix cho cache pages của XGBoost
+        """
+        self.load_chunk = load_chunk
+        self.chunks = chunks
+        self.feature_cols = feature_cols
+        self.target_col = target_col
+        self.n_rows = 0
+        self._it = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def read(self, index: int) -> Tuple[pd.DataFrame, np.ndarray]:
+        df = self.load_chunk(*self.chunks[index])
+        df = df[df[self.target_col].notna()] if len(df) else df
+        X = df.reindex(columns=self.feature_cols, fill_value=0).astype(np.float32).fillna(0)
+        return X, df[self.target_col].to_numpy(dtype=np.float32) if len(df) else np.empty(0, np.float32)
+
+    def next(self, input_data: Callable) -> bool:
+        while self._it < len(self.chunks):
+            X, y = self.read(self._it)
+            self._it += 1
+            if len(X):
+                self.n_rows += len(X)
+                input_data(data=X, label=y)
+                return True
+        return False
+
+    def reset(self) -> None:
+        self._it = 0
+        self.n_rows = 0
+
+
+def external_dmatrix(data_iter: FeatureChunkIter, max_bin: int, ref: Optional[xgb.DMatrix] = None) -> xgb.DMatrix:
+    """ExtMemQuantileDMatrix (cache quantized pages) hoặc DMatrix external memory với xgboost cũ"""
+    if EXTMEM_QUANTILE_AVAILABLE:
+        return xgb.ExtMemQuantileDMatrix(data_iter, max_bin=max_bin, ref=ref, missing=np.nan)
+    return xgb.DMatrix(data_iter, missing=np.nan)
+
+
+def train_external_memory(load_chunk: Callable, train_chunks: List, val_chunks: List,
+                          feature_cols: List[str], target_col: str, params: Dict, cache_dir: str,
+                          max_bin: int, num_boost_round: int, early_stopping_rounds: int
+                          ) -> Tuple[xgb.XGBRegressor, Dict]:
+    """
+    Train booster từ iterator, trả về XGBRegressor (giống các model khác khi lưu/predict)
+    và predictions trên validation chunks để tính metrics.
+
+    Args:
+        params: Params kiểu XGBRegressor (tên giống study.best_params)
+    """
+    booster_params = xgb.XGBRegressor(**params).get_xgb_params()
+    booster_params['max_bin'] = max_bin
+    os.makedirs(cache_dir, exist_ok=True)
+    train_iter = dtrain = val_iter = dval = None
+    evals = []
+    try:
+        train_iter = FeatureChunkIter(load_chunk, train_chunks, feature_cols, target_col,
+                                      cache_prefix=os.path.join(cache_dir, 'train'))
+        dtrain = external_dmatrix(train_iter, max_bin)
+        if val_chunks:
+            val_iter = FeatureChunkIter(load_chunk, val_chunks, feature_cols, target_col,
+                                        cache_prefix=os.path.join(cache_dir, 'validation'))
+            dval = external_dmatrix(val_iter, max_bin, ref=dtrain)
+            evals = [(dval, 'validation')]
+        logger.info(f"💽 External memory DMatrix: {dtrain.num_row():,} dòng train, "
+                    f"{dval.num_row() if dval is not None else 0:,} dòng validation "
+                    f"({len(train_chunks)} + {len(val_chunks)} chunks, cache {cache_dir})")
+
+        booster = xgb.train(booster_params, dtrain, num_boost_round=num_boost_round, evals=evals,
+                            early_stopping_rounds=early_stopping_rounds if evals else None,
+                            verbose_eval=False)
+        best_iteration = getattr(booster, 'best_iteration', None)
+        n_rounds = (best_iteration + 1) if best_iteration is not None else booster.num_boosted_rounds()
+
+        # Predict validation theo từng chunk (chỉ giữ y và pred)
+        y_val, pred_val = [], []
+        if val_chunks:
+            reader = FeatureChunkIter(load_chunk, val_chunks, feature_cols, target_col)
+            for i in range(len(val_chunks)):
+                X, y = reader.read(i)
+                if len(X):
+                    y_val.append(y)
+                    pred_val.append(booster.predict(xgb.DMatrix(X, missing=np.nan), iteration_range=(0, n_rounds)))
+    finally:
+        # Giải phóng DMatrix/iterators (đang giữ cache pages) trước khi xoá cache_dir
+        del evals, dval, dtrain, val_iter, train_iter
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    booster = booster[:n_rounds]
+    model = xgb.XGBRegressor(**{**params, 'n_estimators': n_rounds})
+    model.load_model(bytearray(booster.save_raw(raw_format='ubj')))
+    return model, {
+        'n_rounds': int(n_rounds),
+        'y_val': np.concatenate(y_val) if y_val else np.empty(0),
+        'pred_val': np.concatenate(pred_val) if pred_val else np.empty(0),
+    }
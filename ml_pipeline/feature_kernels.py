@@ -0,0 +1,82 @@
+"""
+Grouped window kernels cho create_features
+
+Thay cho groupby(...).transform(lambda x: x.rolling(...)) - gọi một Python lambda
+cho MỖI (chi_nhanh, ma_hang) - các kernel ở đây chạy một pass native (Cython) trên
+toàn bộ cột đã sort theo series:
+    - GroupWindowIndexer: cửa sổ [max(i - w + 1, đầu group), i] cho từng dòng,
+      dùng với Series.rolling → mean/std/min/max reset đúng tại ranh giới group
+    - grouped_ema: groupby().ewm(adjust=False) native của pandas
+
+Kết quả giống hệt rolling(window, min_periods=1) / ewm(span, adjust=False)
+chạy riêng trên từng series.
+"""
+
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+from pandas.api.indexers import BaseIndexer
+
+ROLLING_STATS = ('mean', 'std', 'min', 'max')
+
+
+def group_starts(group_ids: np.ndarray) -> np.ndarray:
+    """Vị trí dòng đầu tiên của group chứa mỗi dòng (group_ids liên tiếp theo dòng)"""
+    group_ids = np.asarray(group_ids)
+    n = len(group_ids)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_start = np.empty(n, dtype=bool)
+    is_start[0] = True
+    is_start[1:] = group_ids[1:] != group_ids[:-1]
+    return np.maximum.accumulate(np.where(is_start, np.arange(n), 0)).astype(np.int64)
+
+
+class GroupWindowIndexer(BaseIndexer):
+    """Cửa sổ trượt `window_size` dòng, không vượt qua đầu group của dòng hiện tại"""
+
+    def __init__(self, starts: np.ndarray, window_size: int):
+        super().__init__(window_size=window_size)
+        self.starts = starts
+
+    def get_window_bounds(self, num_values: int = 0, min_periods=None, center=None,
+                          closed=None, step=None):
+        end = np.arange(1, num_values + 1, dtype=np.int64)
+        start = np.maximum(end - self.window_size, self.starts[:num_values])
+        return start, end
+
+
+def grouped_rolling(values: np.ndarray, group_ids: np.ndarray, windows: Sequence[int],
+                    stats: Sequence[str] = ROLLING_STATS) -> Dict[str, np.ndarray]:
+    """
+    Rolling statistics (min_periods=1) theo group cho tất cả windows.
+
+    Args:
+        values: Giá trị đã sort theo (group, thời gian)
+        group_ids: Id group của mỗi dòng (các dòng cùng group nằm liền nhau)
+        windows: Các window cần tính
+        stats: Các thống kê ('mean', 'std', 'min', 'max')
+
+    Returns:
+        {'{stat}_{window}': array} - std của cửa sổ 1 phần tử là NaN như pandas
+    """
+    series = pd.Series(np.asarray(values, dtype=np.float64))
+    starts = group_starts(group_ids)
+    result = {}
+    for window in windows:
+        rolling = series.rolling(GroupWindowIndexer(starts, window), min_periods=1)
+        for stat in stats:
+            result[f'{stat}_{window}'] = getattr(rolling, stat)().to_numpy()
+    return result
+
+
+def grouped_ema(values: np.ndarray, group_ids: np.ndarray, spans: Sequence[int]) -> Dict[int, np.ndarray]:
+    """EMA (adjust=False) theo group cho tất cả spans, giữ nguyên thứ tự dòng"""
+    series = pd.Series(np.asarray(values, dtype=np.float64))
+    grouped = series.groupby(np.asarray(group_ids), sort=False)
+    result = {}
+    for span in spans:
+        ema = grouped.ewm(span=span, adjust=False).mean()
+        result[span] = ema.droplevel(0).sort_index().to_numpy()
+    return result
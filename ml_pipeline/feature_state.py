@@ -0,0 +1,202 @@
+"""
+Incremental feature state cho recursive forecasting
+
+SeriesFeatureState giữ trạng thái gọn cho mỗi series (mỗi dòng = 1 series):
+    - Ring buffer 30 giá trị quantity/revenue gần nhất (đủ cho lag_30 và window 30)
+    - Running sum và sum of squares cho từng window rolling
+    - EMA accumulator cho từng span
+Mỗi lần push một giá trị dự báo mới chỉ tốn O(1) cho mỗi series, và state phát ra
+đúng các giá trị lag/rolling/EMA/growth mà create_features(prediction_mode=True)
+tạo ra cho dòng dự báo (dòng hiện tại có daily_quantity = 0, daily_revenue = 0).
+
+Kiểm tra tương đương với create_features:
+    pytest tests/test_feature_state.py
+"""
+
+import logging
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LAGS = (1, 3, 7, 14, 21, 30)
+DEFAULT_WINDOWS = (7, 14, 30)
+PREDICTION_MIN_LAG = 7
+RING_SIZE = 30
+
+
+class SeriesFeatureState:
+    """
+    Trạng thái feature của một batch series, cập nhật O(1) sau mỗi giá trị mới.
+
+    Quy ước giống create_features trên frame (lịch sử + dòng hiện tại):
+        - n_rows = số dòng lịch sử + 1
+        - lag L lấy giá trị cách dòng hiện tại L dòng
+        - rolling window w gồm (w - 1) giá trị lịch sử gần nhất + giá trị 0 của dòng hiện tại
+        - EMA (adjust=False) cập nhật thêm giá trị 0 của dòng hiện tại
+    """
+
+    def __init__(self, n_series: int, lags: Sequence[int] = DEFAULT_LAGS,
+                 windows: Sequence[int] = DEFAULT_WINDOWS):
+        self.lags = tuple(lags)
+        self.windows = tuple(windows)
+        self.prediction_lags = tuple(lag for lag in self.lags if lag >= PREDICTION_MIN_LAG) or (PREDICTION_MIN_LAG,)
+        # Fallback window khi dữ liệu ít (create_features dùng min(3, n_rows))
+        self.spans = tuple(sorted(set(self.windows) | {1, 2, 3}))
+        self.ring_size = max(RING_SIZE, max(self.lags), max(self.windows))
+
+        self.n_series = n_series
+        self.length = np.zeros(n_series, dtype=np.int64)
+        self.quantity = np.zeros((n_series, self.ring_size), dtype=np.float64)
+        self.revenue = np.zeros((n_series, self.ring_size), dtype=np.float64)
+        # Tổng (w - 1) giá trị lịch sử gần nhất cho mỗi window
+        self.sums = {w: np.zeros(n_series) for w in self.spans}
+        self.sumsq = {w: np.zeros(n_series) for w in self.spans}
+        self.ema = {w: np.zeros(n_series) for w in self.spans}
+        self._rows = np.arange(n_series)
+
+    def __len__(self) -> int:
+        return self.n_series
+
+    @classmethod
+    def from_history(cls, quantity: np.ndarray, revenue: np.ndarray, lengths: np.ndarray,
+                     lags: Sequence[int] = DEFAULT_LAGS,
+                     windows: Sequence[int] = DEFAULT_WINDOWS) -> 'SeriesFeatureState':
+        """
+        Khởi tạo state từ lịch sử căn trái (n_series × T) với độ dài từng series.
+
+        Sums được tính trực tiếp trên các giá trị cuối (không cộng dồn cả lịch sử)
+        để tránh sai số tích lũy; EMA được chạy qua lịch sử một lần.
+        """
+        quantity = np.asarray(quantity, dtype=np.float64)
+        revenue = np.asarray(revenue, dtype=np.float64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        state = cls(len(lengths), lags=lags, windows=windows)
+        rows = state._rows
+
+        # Ring buffer: giá trị ở vị trí t của series nằm ở slot t % ring_size
+        for k in range(1, state.ring_size + 1):
+            pos = lengths - k
+            has = pos >= 0
+            src = np.clip(pos, 0, None)
+            slot = src % state.ring_size
+            state.quantity[rows[has], slot[has]] = quantity[rows[has], src[has]]
+            state.revenue[rows[has], slot[has]] = revenue[rows[has], src[has]]
+
+        for w in state.spans:
+            idx = lengths[:, None] - np.arange(1, w)[None, :]
+            valid = idx >= 0
+            values = np.where(valid, np.take_along_axis(quantity, np.clip(idx, 0, None), axis=1), 0.0)
+            state.sums[w] = values.sum(axis=1)
+            state.sumsq[w] = (values ** 2).sum(axis=1)
+
+            alpha = 2.0 / (w + 1.0)
+            ema = quantity[:, 0].copy()
+            for t in range(1, int(lengths.max(initial=0))):
+                ema = np.where(t < lengths, (1 - alpha) * ema + alpha * quantity[:, t], ema)
+            state.ema[w] = ema
+
+        state.length = lengths.copy()
+        return state
+
+    # ------------------------------------------------------------------
+    # Cập nhật
+    # ------------------------------------------------------------------
+    def _value_at(self, buffer: np.ndarray, back: int) -> np.ndarray:
+        """Giá trị cách dòng hiện tại `back` dòng (0 nếu không tồn tại)"""
+        pos = self.length - back
+        values = buffer[self._rows, np.clip(pos, 0, None) % self.ring_size]
+        return np.where(pos >= 0, values, 0.0)
+
+    def push(self, quantity: np.ndarray, revenue=0.0):
+        """Nối một giá trị mới vào cuối mỗi series - O(1) mỗi series"""
+        quantity = np.broadcast_to(np.asarray(quantity, dtype=np.float64), (self.n_series,))
+        revenue = np.broadcast_to(np.asarray(revenue, dtype=np.float64), (self.n_series,))
+        first = self.length == 0
+
+        for w in self.spans:
+            # Giá trị rời khỏi window (w - 1) giá trị lịch sử
+            outgoing = self._value_at(self.quantity, w - 1) if w > 1 else np.zeros(self.n_series)
+            if w > 1:
+                self.sums[w] += quantity - outgoing
+                self.sumsq[w] += quantity ** 2 - outgoing ** 2
+            alpha = 2.0 / (w + 1.0)
+            self.ema[w] = np.where(first, quantity, (1 - alpha) * self.ema[w] + alpha * quantity)
+
+        slot = self.length % self.ring_size
+        self.quantity[self._rows, slot] = quantity
+        self.revenue[self._rows, slot] = revenue
+        self.length = self.length + 1
+
+    # ------------------------------------------------------------------
+    # Features cho dòng hiện tại
+    # ------------------------------------------------------------------
+    @property
+    def n_rows(self) -> np.ndarray:
+        return self.length + 1
+
+    def lag_mask(self, lag: int) -> np.ndarray:
+        """Series nào có feature lag_{lag} (quy tắc available_lags của create_features)"""
+        n_rows = self.n_rows
+        mask = (n_rows > lag) if lag in self.prediction_lags else np.zeros(self.n_series, dtype=bool)
+        fallback = np.where(n_rows > 1, np.minimum(7, n_rows - 1), 1)
+        return mask | ((n_rows <= min(self.prediction_lags)) & (fallback == lag))
+
+    def window_mask(self, window: int) -> np.ndarray:
+        """Series nào có feature rolling/EMA với window này"""
+        n_rows = self.n_rows
+        mask = (n_rows >= window) if window in self.windows else np.zeros(self.n_series, dtype=bool)
+        return mask | ((n_rows < min(self.windows)) & (np.minimum(3, n_rows) == window))
+
+    def lag(self, lag: int, column: str = 'quantity') -> np.ndarray:
+        buffer = self.quantity if column == 'quantity' else self.revenue
+        if lag > self.ring_size:
+            return np.zeros(self.n_series)
+        return np.where(self.lag_mask(lag), self._value_at(buffer, lag), 0.0)
+
+    def rolling(self, window: int) -> Dict[str, np.ndarray]:
+        """mean/std/min/max/range của window kết thúc ở dòng hiện tại"""
+        zeros = np.zeros(self.n_series)
+        if window not in self.sums:
+            return {stat: zeros for stat in ('mean', 'std', 'min', 'max', 'range')}
+        count = np.minimum(window, self.n_rows).astype(np.float64)
+        mean = self.sums[window] / count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (self.sumsq[window] - self.sums[window] * mean) / (count - 1)
+        std = np.where(count > 1, np.sqrt(np.clip(var, 0, None)), 0.0)
+
+        # Min/max trên tối đa 29 giá trị trong ring buffer + giá trị 0 hiện tại
+        back = np.arange(1, window)[None, :]
+        pos = self.length[:, None] - back
+        valid = pos >= 0
+        values = self.quantity[self._rows[:, None], np.clip(pos, 0, None) % self.ring_size]
+        vmin = np.minimum(np.where(valid, values, np.inf).min(axis=1, initial=np.inf), 0.0)
+        vmax = np.maximum(np.where(valid, values, -np.inf).max(axis=1, initial=-np.inf), 0.0)
+
+        mask = self.window_mask(window)
+        return {
+            'mean': np.where(mask, mean, 0.0),
+            'std': np.where(mask, std, 0.0),
+            'min': np.where(mask, vmin, 0.0),
+            'max': np.where(mask, vmax, 0.0),
+            'range': np.where(mask, vmax - vmin, 0.0),
+        }
+
+    def ema_value(self, span: int) -> np.ndarray:
+        """EMA tại dòng hiện tại = (1 - alpha) × EMA lịch sử + alpha × 0"""
+        if span not in self.ema:
+            return np.zeros(self.n_series)
+        alpha = 2.0 / (span + 1.0)
+        value = np.where(self.length > 0, (1 - alpha) * self.ema[span], 0.0)
+        return np.where(self.window_mask(span), value, 0.0)
+
+    def quantity_growth(self) -> np.ndarray:
+        """pct_change của dòng hiện tại (0) so với dòng trước: -1, riêng 0/0 → 0"""
+        return np.where(self._value_at(self.quantity, 1) != 0, -1.0, 0.0)
+
+    def price_change(self) -> np.ndarray:
+        """pct_change của avg_price: dòng hiện tại có avg_price = 0"""
+        prev_price = self._value_at(self.revenue, 1) / (self._value_at(self.quantity, 1) + 1e-8)
+        return np.where(prev_price != 0, -1.0, 0.0)
@@ -0,0 +1,276 @@
+"""
+Feature Store cho training features (Parquet, partition theo ngày)
+
+Lưu output của create_features thành Parquet dataset:
+    {root}/partition_date=YYYY-MM-DD/part-0.parquet
+    {root}/_metadata.json
+
+- rebuild(): materialize toàn bộ lịch sử một lần
+- refresh(): chỉ tính lại các partition có dữ liệu mới; lag/rolling lấy thêm
+  30 dòng gần nhất của mỗi series trước đó từ chính store (không query lại DB),
+  EMA được nối tiếp từ giá trị EMA đã lưu của dòng trước đó
+- load(): columnar scan các partition cần thiết rồi encode categorical trên frame
+  được load (giống create_features chạy trên cùng frame)
+
+Store giữ cột categorical gốc (chi_nhanh, nhom_hang_cap_*, thuong_hieu, abc_class)
+thay cho *_encoded; code được gán lúc load bằng encoders fit trên dữ liệu training.
+"""
+
+import os
+import json
+import shutil
+import logging
+from datetime import datetime, date
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from feature_kernels import grouped_ema
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SERIES_KEYS = ['chi_nhanh', 'ma_hang']
+PARTITION_COL = 'partition_date'
+RAW_CATEGORICAL_COLUMNS = ['thuong_hieu', 'abc_class']
+ENCODED_COLUMNS = ['branch_encoded', 'category1_encoded', 'category2_encoded', 'brand_encoded', 'abc_encoded']
+# lag_30 / rolling_30: cần 30 dòng trước partition đầu tiên được tính lại
+DEFAULT_LOOKBACK_ROWS = 30
+
+
+def _dtypes(df: pd.DataFrame) -> Dict[str, str]:
+    return {col: str(dtype) for col, dtype in df.dtypes.items()}
+
+
+class FeatureStore:
+    """Parquet feature store partition theo ngày cho dữ liệu training Model 1"""
+
+    def __init__(self, root_dir: str, lookback_rows: int = DEFAULT_LOOKBACK_ROWS):
+        """
+        Args:
+            root_dir: Thư mục chứa Parquet dataset
+            lookback_rows: Số dòng lịch sử mỗi series trước partition đầu tiên cần
+                           tính lại (lag/rolling của create_features tính theo dòng,
+                           nên series thưa cần lookback xa hơn 30 ngày lịch)
+        """
+        if not PYARROW_AVAILABLE:
+            raise ImportError("pyarrow chưa được cài đặt - cần cho feature store (pip install pyarrow)")
+        self.root_dir = root_dir
+        self.lookback_rows = lookback_rows
+        self.metadata_path = os.path.join(root_dir, '_metadata.json')
+        self._partitioning = ds.partitioning(pa.schema([(PARTITION_COL, pa.string())]), flavor='hive')
+
+    # ------------------------------------------------------------------
+    # Metadata
+    # ------------------------------------------------------------------
+    @property
+    def metadata(self) -> Dict:
+        if not os.path.exists(self.metadata_path):
+            return {}
+        with open(self.metadata_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def exists(self) -> bool:
+        return bool(self.metadata.get('last_date'))
+
+    @property
+    def last_date(self) -> Optional[date]:
+        last = self.metadata.get('last_date')
+        return date.fromisoformat(last) if last else None
+
+    @property
+    def winsorization_cap(self) -> Optional[float]:
+        return self.metadata.get('winsorization_cap')
+
+    def _save_metadata(self, first_date, last_date, columns: List[str], raw_columns: List[str],
+                       winsorization_cap: Optional[float], dtypes: Dict[str, str]):
+        metadata = {
+            'last_date': str(pd.Timestamp(last_date).date()),
+            'first_date': str(pd.Timestamp(first_date).date()),
+            'columns': columns,
+            'dtypes': dtypes,
+            'raw_columns': raw_columns,
+            'winsorization_cap': winsorization_cap,
+            'lookback_rows': self.lookback_rows,
+            'updated_at': datetime.now().isoformat(),
+        }
+        with open(self.metadata_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2, ensure_ascii=False)
+
+    # ------------------------------------------------------------------
+    # Ghi
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _materialize(raw_df: pd.DataFrame, create_features: Callable) -> pd.DataFrame:
+        """create_features + giữ cột categorical gốc thay cho *_encoded"""
+        raw_df = raw_df.reset_index(drop=True)
+        features = create_features(raw_df)
+        for col in RAW_CATEGORICAL_COLUMNS:
+            if col in raw_df.columns:
+                features[col] = raw_df.loc[features.index, col].to_numpy()
+        features = features.drop(columns=[c for c in ENCODED_COLUMNS if c in features.columns])
+        return features.reset_index(drop=True)
+
+    def _write_partitions(self, features: pd.DataFrame, start_date: Optional[date] = None):
+        """Ghi đè các partition từ start_date (None = toàn bộ store)"""
+        if start_date is None and os.path.exists(self.root_dir):
+            shutil.rmtree(self.root_dir)
+        os.makedirs(self.root_dir, exist_ok=True)
+        if start_date is not None:
+            for name in os.listdir(self.root_dir):
+                if name.startswith(f'{PARTITION_COL}=') and name.split('=', 1)[1] >= str(start_date):
+                    shutil.rmtree(os.path.join(self.root_dir, name))
+
+        features = features.copy()
+        features[PARTITION_COL] = features['ngay'].dt.strftime('%Y-%m-%d')
+        table = pa.Table.from_pandas(features, preserve_index=False)
+        pq.write_to_dataset(table, self.root_dir, partitioning=self._partitioning,
+                            basename_template='part-{i}.parquet',
+                            existing_data_behavior='delete_matching')
+
+    def rebuild(self, raw_df: pd.DataFrame, create_features: Callable,
+                winsorization_cap: Optional[float] = None) -> pd.DataFrame:
+        """Materialize toàn bộ lịch sử (lần đầu hoặc khi schema features thay đổi)"""
+        features = self._materialize(raw_df, create_features)
+        self._write_partitions(features)
+        self._save_metadata(features['ngay'].min(), features['ngay'].max(), list(features.columns),
+                            list(raw_df.columns), winsorization_cap, _dtypes(features))
+        logger.info(f"💾 Feature store rebuilt: {len(features):,} dòng, "
+                    f"{features['ngay'].nunique()} partitions → {self.root_dir}")
+        return features
+
+    def refresh(self, new_raw_df: pd.DataFrame, create_features: Callable,
+                lookback_days: Optional[int] = None) -> bool:
+        """
+        Tính lại các partition từ ngày nhỏ nhất trong new_raw_df.
+
+        Args:
+            lookback_days: Chỉ tìm lookback trong N ngày trước partition đầu tiên
+                           (None = toàn bộ store; dùng khi materialize theo chunk)
+
+        Returns:
+            False nếu không thể cập nhật incremental (schema features khác) → cần rebuild
+        """
+        if new_raw_df.empty:
+            logger.info("✅ Feature store: không có dữ liệu mới")
+            return True
+
+        metadata = self.metadata
+        start = pd.Timestamp(new_raw_df['ngay'].min()).normalize()
+        raw_columns = [c for c in metadata['raw_columns'] if c in metadata['columns'] + RAW_CATEGORICAL_COLUMNS]
+
+        lookback = self._lookback(start, lookback_days)
+        combined = pd.concat([lookback[raw_columns], new_raw_df[raw_columns]], ignore_index=True)
+        features = self._materialize(combined, create_features)
+        # Partitions cũ và mới phải cùng schema (cả dtype) để scan được cả dataset
+        if list(features.columns) != metadata['columns'] or _dtypes(features) != metadata.get('dtypes'):
+            logger.warning("⚠️ Feature store: schema features thay đổi - cần rebuild toàn bộ")
+            return False
+
+        features = features[features['ngay'] >= start].reset_index(drop=True)
+        self._continue_ema(features, lookback)
+        self._write_partitions(features, start_date=start.date())
+        self._save_metadata(min(pd.Timestamp(metadata['first_date']), start), features['ngay'].max(),
+                            metadata['columns'], metadata['raw_columns'], metadata.get('winsorization_cap'),
+                            metadata['dtypes'])
+        logger.info(f"🔄 Feature store refreshed: {features['ngay'].nunique()} partitions từ {start.date()} "
+                    f"(lookback {len(lookback):,} dòng, {len(features):,} dòng mới)")
+        return True
+
+    def _lookback(self, start: pd.Timestamp, lookback_days: Optional[int] = None) -> pd.DataFrame:
+        """lookback_rows dòng cuối của mỗi series trước `start`"""
+        # Scan nhẹ (chỉ keys + ngay) để tìm ngày bắt đầu lookback của từng series
+        scan_start = (start - pd.Timedelta(days=lookback_days)).date() if lookback_days else None
+        keys = self._scan(scan_start, start.date(), columns=SERIES_KEYS + ['ngay'])
+        if keys.empty:
+            return keys
+        cutoffs = keys.groupby(SERIES_KEYS, sort=False).tail(self.lookback_rows) \
+            .groupby(SERIES_KEYS, sort=False)['ngay'].min().rename('_cutoff').reset_index()
+        lookback = self._scan(cutoffs['_cutoff'].min().date(), start.date(), columns=None)
+        lookback = lookback.merge(cutoffs, on=SERIES_KEYS, how='inner')
+        return lookback[lookback['ngay'] >= lookback['_cutoff']].drop(columns=['_cutoff']).reset_index(drop=True)
+
+    @staticmethod
+    def _continue_ema(features: pd.DataFrame, lookback: pd.DataFrame):
+        """
+        EMA (adjust=False) phụ thuộc toàn bộ lịch sử: nối tiếp từ EMA đã lưu ở dòng
+        cuối cùng trước partition được tính lại của mỗi series.
+        """
+        ema_cols = [c for c in features.columns if c.startswith('ema_') and c.endswith('_quantity')]
+        if not ema_cols or lookback.empty:
+            return
+        seeds = lookback.sort_values(SERIES_KEYS + ['ngay']).groupby(SERIES_KEYS, sort=False).tail(1)
+        seeds = seeds[SERIES_KEYS + ema_cols]
+        # Dòng seed (_pos = -1) mang giá trị EMA cũ, ewm(adjust=False) bắt đầu từ chính giá trị đó
+        new_rows = features[SERIES_KEYS + ['daily_quantity']].assign(_pos=np.arange(len(features)))
+        frame = pd.concat([seeds.assign(_pos=-1), new_rows], ignore_index=True)
+        frame = frame.sort_values(SERIES_KEYS + ['_pos'], kind='mergesort').reset_index(drop=True)
+        group_ids = frame.groupby(SERIES_KEYS, sort=False).ngroup().to_numpy()
+        is_new = frame['_pos'].to_numpy() >= 0
+        positions = frame.loc[is_new, '_pos'].to_numpy(dtype=np.int64)
+        for col in ema_cols:
+            span = int(col.split('_')[1])
+            values = np.where(is_new, frame['daily_quantity'].to_numpy(dtype=np.float64),
+                              frame[col].to_numpy(dtype=np.float64))
+            ema = grouped_ema(values, group_ids, [span])[span]
+            features.loc[positions, col] = ema[is_new].astype(features[col].dtype)
+
+    # ------------------------------------------------------------------
+    # Đọc
+    # ------------------------------------------------------------------
+    def _scan(self, start_date: Optional[date] = None, end_date: Optional[date] = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Columnar scan các partition trong [start_date, end_date)"""
+        if not os.path.exists(self.root_dir):
+            return pd.DataFrame(columns=columns or [])
+        dataset = ds.dataset(self.root_dir, format='parquet', partitioning=self._partitioning)
+        condition = None
+        if start_date is not None:
+            condition = ds.field(PARTITION_COL) >= str(start_date)
+        if end_date is not None:
+            end_condition = ds.field(PARTITION_COL) < str(end_date)
+            condition = end_condition if condition is None else condition & end_condition
+        table = dataset.to_table(columns=columns, filter=condition)
+        df = table.to_pandas()
+        if PARTITION_COL in df.columns:
+            df = df.drop(columns=[PARTITION_COL])
+        if len(df) > 0 and set(SERIES_KEYS + ['ngay']).issubset(df.columns):
+            df = df.sort_values(SERIES_KEYS + ['ngay'], kind='mergesort').reset_index(drop=True)
+        return df
+
+    def load(self, encode_categoricals: Callable, days: int = 0) -> pd.DataFrame:
+        """
+        Load features cho training.
+
+        Args:
+            encode_categoricals: SalesForecaster.encode_categoricals
+            days: Số ngày gần nhất cần load (0 = toàn bộ store)
+        """
+        start_date = None
+        if days > 0:
+            start_date = (pd.Timestamp(date.today()) - pd.Timedelta(days=days)).date()
+        return self.load_range(encode_categoricals, start_date)
+
+    def load_range(self, encode_categoricals: Optional[Callable], start_date: Optional[date] = None,
+                   end_date: Optional[date] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Load các partition trong [start_date, end_date) (streaming training đọc theo chunk)"""
+        df = self._scan(start_date, end_date, columns=columns or self.metadata.get('columns'))
+        if df.empty or encode_categoricals is None:
+            return df
+        return encode_categoricals(df)
+
+    def partition_dates(self) -> List[date]:
+        """Các ngày có partition, tăng dần"""
+        if not os.path.exists(self.root_dir):
+            return []
+        prefix = f'{PARTITION_COL}='
+        return sorted(date.fromisoformat(name[len(prefix):]) for name in os.listdir(self.root_dir)
+                      if name.startswith(prefix))
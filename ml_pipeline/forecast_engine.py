@@ -0,0 +1,396 @@
+"""
+Batch Recursive Forecaster cho Model 1 (product_quantity)
+
+Thay vì lặp từng (chi_nhanh, ma_hang) × từng ngày và gọi lại create_features
+trên toàn bộ lịch sử, engine này giữ lịch sử của TẤT CẢ series trong một ma trận
+numpy và tiến từng bước horizon cho tất cả series cùng lúc:
+    - 1 feature matrix (n_series × n_features) cho mỗi ngày dự báo
+    - 1 lần gọi model.predict cho mỗi ngày dự báo
+Số lần predict = số ngày dự báo, không phụ thuộc số sản phẩm.
+
+Lag/rolling/EMA được cập nhật O(1) mỗi bước qua SeriesFeatureState (feature_state.py)
+thay vì tính lại trên toàn bộ lịch sử.
+
+DirectMultiHorizonForecaster là chế độ thay thế (direct multi-horizon): một model
+với feature `horizon` dự báo trực tiếp t+1…t+H từ features tại ngày gốc, nên toàn bộ
+series × horizon được dự báo trong MỘT lần predict, không có lỗi cộng dồn.
+
+Features được tính theo đúng quy tắc của SalesForecaster.create_features
+(prediction_mode=True) áp dụng trên lịch sử của từng series.
+"""
+
+import re
+import logging
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from feature_state import DEFAULT_LAGS, DEFAULT_WINDOWS, PREDICTION_MIN_LAG, SeriesFeatureState
+
+logger = logging.getLogger(__name__)
+
+SERIES_KEYS = ['chi_nhanh', 'ma_hang']
+
+_LAG_RE = re.compile(r'^lag_(\d+)_(quantity|revenue)$')
+_ROLLING_RE = re.compile(r'^rolling_(mean|std|min|max|range)_(\d+)_quantity$')
+_EMA_RE = re.compile(r'^ema_(\d+)_quantity$')
+
+# Cột categorical và giá trị create_features gán cho các dòng không có dữ liệu gốc
+# (dòng dự báo được nối thêm vào lịch sử không có thuong_hieu/abc_class)
+CATEGORICAL_FEATURES = {
+    'branch_encoded': ('chi_nhanh', None),
+    'category1_encoded': ('nhom_hang_cap_1', None),
+    'category2_encoded': ('nhom_hang_cap_2', None),
+    'brand_encoded': ('thuong_hieu', 'Unknown'),
+    'abc_encoded': ('abc_class', 'C'),
+}
+
+# Chế độ forecast cho Model 1
+FORECAST_MODES = ('recursive', 'direct')
+DIRECT_TARGET_COL = 'direct_daily_quantity'
+
+# Features phụ thuộc ngày được dự báo (không phải ngày gốc) trong chế độ direct
+CALENDAR_COLUMNS = ['day_of_week', 'day_of_month', 'month', 'quarter', 'day_of_year', 'week_of_year',
+                    'is_weekend', 'is_month_start', 'is_month_end', 'is_holiday']
+SEASONAL_COLUMNS = ['is_peak_day', 'peak_level', 'seasonal_factor', 'revenue_factor', 'quantity_factor']
+
+
+def available_lags(n_rows: int, lags: Sequence[int] = DEFAULT_LAGS,
+                   prediction_mode: bool = True) -> List[int]:
+    """Danh sách lag create_features tạo ra cho một frame có n_rows ngày"""
+    all_lags = list(lags)
+    if prediction_mode:
+        all_lags = [lag for lag in all_lags if lag >= PREDICTION_MIN_LAG] or [PREDICTION_MIN_LAG]
+    result = [lag for lag in all_lags if lag < n_rows]
+    if not result:
+        result = [min(7, n_rows - 1)] if n_rows > 1 else [1]
+    return result
+
+
+def available_windows(n_rows: int, windows: Sequence[int] = DEFAULT_WINDOWS) -> List[int]:
+    """Danh sách window rolling/EMA create_features tạo ra cho frame có n_rows ngày"""
+    result = [w for w in windows if w <= n_rows]
+    if not result:
+        result = [min(3, n_rows)]
+    return result
+
+
+def calendar_features(day: pd.Timestamp) -> Dict[str, float]:
+    """Time-based features cho một ngày, giống create_features"""
+    day = pd.Timestamp(day)
+    day_of_week = day.dayofweek + 1
+    month = day.month
+    day_of_month = day.day
+    return {
+        'day_of_week': day_of_week,
+        'day_of_month': day_of_month,
+        'month': month,
+        'quarter': day.quarter,
+        'day_of_year': day.dayofyear,
+        'week_of_year': int(day.isocalendar()[1]),
+        'is_weekend': int(day_of_week >= 6),
+        'is_month_start': int(day_of_month == 1),
+        'is_month_end': int(day_of_month == day.days_in_month),
+        'is_holiday': int(
+            (month == 1 and day_of_month <= 5) or
+            (month == 4 and day_of_month == 30) or
+            (month == 5 and day_of_month == 1) or
+            (month == 9 and day_of_month == 2)
+        ),
+    }
+
+
+def seasonal_features(day: pd.Timestamp, seasonal_map: Optional[Dict] = None) -> Dict[str, float]:
+    """Seasonal features cho ngày tương lai (peak_level không có ở ngày tương lai → 0)"""
+    sf = (seasonal_map or {}).get(pd.Timestamp(day).month, {})
+    return {
+        'is_peak_day': 1 if sf.get('peak_reason') else 0,
+        'peak_level': 0,
+        'seasonal_factor': sf.get('seasonal_factor', 1.0),
+        'revenue_factor': sf.get('revenue_factor', 1.0),
+        'quantity_factor': sf.get('quantity_factor', 1.0),
+    }
+
+
+class BatchRecursiveForecaster:
+    """
+    Recursive forecast cho nhiều series cùng lúc.
+
+    Lịch sử được nạp một lần vào SeriesFeatureState (ring buffer + running sums
+    + EMA accumulator cho từng series). Mỗi bước dự báo:
+        1. Dòng hiện tại (daily_quantity = 0) nằm ngay sau lịch sử của mỗi series
+        2. Lấy features của dòng hiện tại từ state (numpy theo trục series)
+        3. Gọi model.predict một lần
+        4. Push giá trị dự báo vào state - O(1) mỗi series
+    """
+
+    def __init__(self, model, feature_names: Optional[Sequence[str]] = None,
+                 lags: Sequence[int] = DEFAULT_LAGS, windows: Sequence[int] = DEFAULT_WINDOWS,
+                 encoders=None):
+        self.model = model
+        # CategoricalEncoders lúc training; None → code theo frame một series (models cũ)
+        self.encoders = encoders
+        if feature_names is None:
+            feature_names = list(model.feature_names_in_)
+        self.feature_names = list(feature_names)
+        self.lags = tuple(lags)
+        self.windows = tuple(windows)
+
+    # ------------------------------------------------------------------
+    # Chuẩn bị dữ liệu
+    # ------------------------------------------------------------------
+    def _build_batch(self, history_df: pd.DataFrame):
+        """Chuyển history_df (long format) thành SeriesFeatureState theo series"""
+        history_df = history_df.sort_values(SERIES_KEYS + ['ngay'], kind='mergesort')
+        keys = history_df[SERIES_KEYS].drop_duplicates().reset_index(drop=True)
+
+        series_idx = history_df.groupby(SERIES_KEYS, sort=False).ngroup().to_numpy()
+        lengths = np.bincount(series_idx, minlength=len(keys)).astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        positions = np.arange(len(history_df)) - offsets[series_idx]
+
+        capacity = int(lengths.max())
+        quantity = np.zeros((len(keys), capacity), dtype=np.float64)
+        revenue = np.zeros((len(keys), capacity), dtype=np.float64)
+        quantity[series_idx, positions] = history_df['daily_quantity'].to_numpy(dtype=np.float64)
+        revenue[series_idx, positions] = history_df['daily_revenue'].to_numpy(dtype=np.float64)
+
+        codes = self._categorical_codes(history_df, series_idx, keys)
+        state = SeriesFeatureState.from_history(quantity, revenue, lengths,
+                                                lags=self.lags, windows=self.windows)
+        return keys, state, codes
+
+    def _categorical_codes(self, history_df: pd.DataFrame, series_idx: np.ndarray,
+                           keys: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """
+        Code categorical của dòng dự báo. Có encoders → tra cứu trực tiếp; không có
+        (models cũ) → giống pd.Categorical(...).codes trên frame một series: vị trí
+        của giá trị dòng dự báo trong các giá trị đã sắp xếp.
+        """
+        codes = {}
+        first_rows = history_df.groupby(series_idx).head(1).reset_index(drop=True)
+        for feature, (column, fill_value) in CATEGORICAL_FEATURES.items():
+            if feature not in self.feature_names or column not in history_df.columns:
+                continue
+            if self.encoders is not None:
+                # Encoders cố định: tra cứu giá trị thật của series
+                codes[feature] = self.encoders.encode(column, first_rows[column].to_numpy()).astype(np.float64)
+                continue
+            if fill_value is None:
+                # Dòng dự báo dùng cùng giá trị với series (chi_nhanh/nhom_hang)
+                current = first_rows[column].astype(str).to_numpy()
+            else:
+                current = np.full(len(keys), fill_value, dtype=object)
+            values = history_df[column].fillna(fill_value if fill_value is not None else 'Unknown').astype(str)
+            pairs = pd.DataFrame({'s': series_idx, 'v': values.to_numpy()}).drop_duplicates()
+            pairs = pd.concat([pairs, pd.DataFrame({'s': np.arange(len(keys)), 'v': current})]).drop_duplicates()
+            result = np.zeros(len(keys), dtype=np.float64)
+            for s, group in pairs.groupby('s'):
+                result[s] = sorted(group['v']).index(current[s])
+            codes[feature] = result
+        return codes
+
+    # ------------------------------------------------------------------
+    # Features
+    # ------------------------------------------------------------------
+    def _feature_matrix(self, day: pd.Timestamp, state: SeriesFeatureState,
+                        codes: Dict[str, np.ndarray], seasonal_map: Optional[Dict]) -> pd.DataFrame:
+        scalars = {**calendar_features(day), **seasonal_features(day, seasonal_map)}
+
+        X = np.zeros((len(state), len(self.feature_names)), dtype=np.float64)
+        window_cache = {}
+        for j, name in enumerate(self.feature_names):
+            if name in scalars:
+                X[:, j] = scalars[name]
+            elif name in codes:
+                X[:, j] = codes[name]
+            elif (m := _LAG_RE.match(name)):
+                X[:, j] = state.lag(int(m.group(1)), m.group(2))
+            elif (m := _ROLLING_RE.match(name)):
+                stat, window = m.group(1), int(m.group(2))
+                if window not in window_cache:
+                    window_cache[window] = state.rolling(window)
+                X[:, j] = window_cache[window][stat]
+            elif (m := _EMA_RE.match(name)):
+                X[:, j] = state.ema_value(int(m.group(1)))
+            elif name == 'quantity_growth':
+                X[:, j] = state.quantity_growth()
+            elif name == 'price_change':
+                X[:, j] = state.price_change()
+            # avg_price của dòng hiện tại = 0 / (0 + 1e-8) = 0; feature lạ → 0
+        return pd.DataFrame(X, columns=self.feature_names)
+
+    # ------------------------------------------------------------------
+    # Forecast
+    # ------------------------------------------------------------------
+    def forecast(self, history_df: pd.DataFrame, future_dates: Sequence,
+                 seasonal_map: Optional[Dict] = None) -> pd.DataFrame:
+        """
+        Dự báo recursive cho tất cả series trong history_df.
+
+        Args:
+            history_df: Lịch sử (ngay, chi_nhanh, ma_hang, daily_quantity, daily_revenue, ...)
+            future_dates: Các ngày cần dự báo (liên tiếp, tăng dần)
+            seasonal_map: {month: {seasonal_factor, revenue_factor, quantity_factor, peak_reason}}
+
+        Returns:
+            DataFrame (chi_nhanh, ma_hang, forecast_date, predicted_quantity_raw)
+        """
+        future_dates = list(pd.to_datetime(future_dates))
+        if history_df.empty or not future_dates:
+            return pd.DataFrame(columns=SERIES_KEYS + ['forecast_date', 'predicted_quantity_raw'])
+
+        keys, state, codes = self._build_batch(history_df)
+        predictions = np.zeros((len(keys), len(future_dates)), dtype=np.float64)
+
+        for step, day in enumerate(future_dates):
+            X = self._feature_matrix(day, state, codes, seasonal_map)
+            pred = np.clip(np.asarray(self.model.predict(X), dtype=np.float64), 0, None)
+            predictions[:, step] = pred
+            # Nối giá trị dự báo vào lịch sử (revenue = 0 như dòng dự báo cũ)
+            state.push(pred, revenue=0.0)
+
+        logger.info(f"   ⚡ Batch recursive: {len(keys)} series × {len(future_dates)} ngày "
+                    f"= {len(future_dates)} lần predict")
+
+        result = keys.loc[keys.index.repeat(len(future_dates))].reset_index(drop=True)
+        result['forecast_date'] = np.tile(np.array(future_dates, dtype='datetime64[ns]'), len(keys))
+        result['predicted_quantity_raw'] = predictions.ravel()
+        return result
+
+
+def build_direct_training_frame(df_features: pd.DataFrame, horizons: Sequence[int] = range(1, 15),
+                                origin_days: Optional[int] = None) -> pd.DataFrame:
+    """
+    Tạo dữ liệu train cho chế độ direct multi-horizon từ output của create_features.
+
+    Horizon tính theo ngày lịch (giống DirectMultiHorizonForecaster.forecast): mỗi dòng
+    gốc (ngày t) được nhân bản cho từng horizon h với t + h ≤ ngày cuối của dữ liệu:
+        - Lag/rolling/EMA/growth giữ nguyên giá trị tại ngày gốc t
+        - Calendar features tính theo ngày t + h, seasonal features theo tháng của t + h
+        - horizon = h, target DIRECT_TARGET_COL = daily_quantity của series tại ngày t + h,
+          bằng 0 nếu ngày đó không có dòng (frame training chỉ giữ ngày có bán)
+
+    Args:
+        df_features: Output của create_features
+        horizons: Các horizon cần train (mặc định 1…14)
+        origin_days: Chỉ dùng ngày gốc trong N ngày cuối (None = toàn bộ lịch sử) để
+            frame không lớn gấp len(horizons) lần toàn bộ lịch sử
+
+    Returns:
+        DataFrame với cột `horizon` và target DIRECT_TARGET_COL
+    """
+    horizons = list(horizons)
+    empty = pd.DataFrame(columns=list(df_features.columns) + ['horizon', DIRECT_TARGET_COL])
+    if df_features.empty or not horizons:
+        return empty
+
+    dates = pd.to_datetime(df_features['ngay'])
+    cutoff = dates.max()
+    origin_mask = dates < cutoff
+    if origin_days is not None:
+        origin_mask &= dates > cutoff - pd.Timedelta(days=origin_days)
+    origin_pos = np.flatnonzero(origin_mask.to_numpy())
+    origin_dates = dates.to_numpy()[origin_pos]
+
+    # Vị trí dòng gốc × horizon (chỉ những cặp có t + h trong dữ liệu) → copy frame một lần
+    positions, horizon_values = [], []
+    for h in horizons:
+        valid = origin_dates + np.timedelta64(h, 'D') <= cutoff.to_datetime64()
+        positions.append(origin_pos[valid])
+        horizon_values.append(np.full(int(valid.sum()), h, dtype=np.int64))
+    positions = np.concatenate(positions)
+    if len(positions) == 0:
+        return empty
+
+    result = df_features.iloc[positions].reset_index(drop=True)
+    result['horizon'] = np.concatenate(horizon_values)
+    target_dates = pd.to_datetime(result['ngay']) + pd.to_timedelta(result['horizon'], unit='D')
+
+    # Target theo ngày: daily_quantity của cùng series tại t + h, không có dòng → 0
+    actuals = df_features[SERIES_KEYS].copy()
+    actuals['_target_date'] = dates.to_numpy()
+    actuals[DIRECT_TARGET_COL] = df_features['daily_quantity'].to_numpy()
+    actuals = actuals.groupby(SERIES_KEYS + ['_target_date'], sort=False, observed=True,
+                              as_index=False)[DIRECT_TARGET_COL].sum()
+    keys = result[SERIES_KEYS].copy()
+    keys['_target_date'] = target_dates.to_numpy()
+    result[DIRECT_TARGET_COL] = keys.merge(actuals, on=SERIES_KEYS + ['_target_date'], how='left')[
+        DIRECT_TARGET_COL].fillna(0).to_numpy()
+
+    # Calendar của ngày t + h
+    calendar_cols = [c for c in CALENDAR_COLUMNS if c in result.columns]
+    if calendar_cols:
+        unique_dates = pd.DatetimeIndex(target_dates.unique())
+        calendar = pd.DataFrame([calendar_features(day) for day in unique_dates], index=unique_dates)
+        for col in calendar_cols:
+            result[col] = calendar[col].reindex(target_dates).to_numpy()
+
+    # Seasonal theo tháng (dữ liệu join int_dynamic_seasonal_factor theo tháng); tháng
+    # không có trong frame → giá trị trung tính như seasonal_features
+    seasonal_cols = [c for c in SEASONAL_COLUMNS if c in result.columns]
+    if seasonal_cols:
+        by_month = df_features[seasonal_cols].groupby(dates.dt.month.to_numpy()).first()
+        defaults = seasonal_features(cutoff)
+        target_months = target_dates.dt.month.to_numpy()
+        for col in seasonal_cols:
+            result[col] = by_month[col].reindex(target_months).fillna(defaults[col]).to_numpy()
+
+    return result.sort_values(SERIES_KEYS + ['ngay', 'horizon'], kind='mergesort').reset_index(drop=True)
+
+
+class DirectMultiHorizonForecaster:
+    """
+    Direct multi-horizon forecast: features tại ngày cuối lịch sử của mỗi series
+    + calendar/seasonal của ngày dự báo + horizon → 1 lần predict cho tất cả
+    (n_series × n_horizons) dòng.
+    """
+
+    def __init__(self, model, create_features, feature_names: Optional[Sequence[str]] = None):
+        self.model = model
+        self.create_features = create_features
+        if feature_names is None:
+            feature_names = list(model.feature_names_in_)
+        self.feature_names = list(feature_names)
+
+    def forecast(self, history_df: pd.DataFrame, future_dates: Sequence,
+                 seasonal_map: Optional[Dict] = None) -> pd.DataFrame:
+        """
+        Dự báo direct cho tất cả series trong history_df.
+
+        Args:
+            history_df: Lịch sử (ngay, chi_nhanh, ma_hang, daily_quantity, daily_revenue, ...)
+            future_dates: Các ngày cần dự báo; ngày thứ k dùng horizon = k
+            seasonal_map: {month: {seasonal_factor, revenue_factor, quantity_factor, peak_reason}}
+
+        Returns:
+            DataFrame (chi_nhanh, ma_hang, forecast_date, predicted_quantity_raw)
+        """
+        future_dates = list(pd.to_datetime(future_dates))
+        if history_df.empty or not future_dates:
+            return pd.DataFrame(columns=SERIES_KEYS + ['forecast_date', 'predicted_quantity_raw'])
+
+        features = self.create_features(history_df, prediction_mode=False)
+        origins = features.sort_values(SERIES_KEYS + ['ngay'], kind='mergesort') \
+            .groupby(SERIES_KEYS, sort=False).tail(1).reset_index(drop=True)
+        n_series, n_horizons = len(origins), len(future_dates)
+
+        # Mỗi series lặp lại n_horizons lần, thứ tự (series, horizon)
+        batch = origins.loc[origins.index.repeat(n_horizons)].reset_index(drop=True)
+        day_rows = pd.DataFrame([
+            {**calendar_features(day), **seasonal_features(day, seasonal_map), 'horizon': k}
+            for k, day in enumerate(future_dates, start=1)
+        ])
+        for col in day_rows.columns:
+            batch[col] = np.tile(day_rows[col].to_numpy(), n_series)
+
+        X = batch.reindex(columns=self.feature_names, fill_value=0).astype(np.float64).fillna(0)
+        pred = np.clip(np.asarray(self.model.predict(X), dtype=np.float64), 0, None)
+
+        logger.info(f"   ⚡ Direct multi-horizon: {n_series} series × {n_horizons} ngày = 1 lần predict")
+
+        result = batch[SERIES_KEYS].copy()
+        result['forecast_date'] = np.tile(np.array(future_dates, dtype='datetime64[ns]'), n_series)
+        result['predicted_quantity_raw'] = pred
+        return result
@@ -0,0 +1,130 @@
+"""
+Cập nhật incremental cho Model 1 (product_quantity) bằng continued training
+
+Khi chỉ có vài ngày dữ liệu mới và phân phối target ít thay đổi, thay vì chạy lại
+toàn bộ Optuna search:
+    1. Booster đã lưu được cắt tại best_iteration
+    2. Boost thêm tối đa INCREMENTAL_BOOST_ROUNDS rounds (xgb_model=) trên các ngày
+       mới + replay window INCREMENTAL_REPLAY_DAYS ngày trước đó, giữ params đã tune
+    3. Gate: MdAPE trên holdout (các ngày mới nhất) không được tệ hơn model cũ quá
+       INCREMENTAL_MAX_DEGRADATION, nếu không → full retrain
+    4. Fit lại với số rounds đã chọn trên toàn bộ ngày mới + replay
+"""
+
+import os
+import logging
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from tuning import median_absolute_percentage_error, population_stability_index
+
+logger = logging.getLogger(__name__)
+
+INCREMENTAL_MAX_NEW_DAYS = int(os.getenv('INCREMENTAL_MAX_NEW_DAYS', '7'))
+INCREMENTAL_REPLAY_DAYS = int(os.getenv('INCREMENTAL_REPLAY_DAYS', '28'))
+INCREMENTAL_BOOST_ROUNDS = int(os.getenv('INCREMENTAL_BOOST_ROUNDS', '200'))
+INCREMENTAL_EARLY_STOPPING = 20
+INCREMENTAL_MAX_DRIFT = float(os.getenv('INCREMENTAL_MAX_DRIFT', '0.1'))  # PSI
+INCREMENTAL_MAX_DEGRADATION = float(os.getenv('INCREMENTAL_MAX_DEGRADATION', '0.1'))  # +10% MdAPE
+HOLDOUT_FRACTION = 0.2
+# Lịch sử cần load thêm trước replay window để tính lag/rolling 30
+FEATURE_LOOKBACK_DAYS = 60
+
+
+def base_booster(model: xgb.XGBRegressor) -> Tuple[xgb.Booster, int]:
+    """Booster của model đã cắt tại best_iteration (bỏ các cây sau early stopping)"""
+    booster = model.get_booster()
+    n_rounds = booster.num_boosted_rounds()
+    best_iteration = getattr(booster, 'best_iteration', None)
+    if best_iteration is not None and best_iteration + 1 < n_rounds:
+        booster = booster[:best_iteration + 1]
+        n_rounds = best_iteration + 1
+    return booster, n_rounds
+
+
+def continue_training(model: xgb.XGBRegressor, X: pd.DataFrame, y: pd.Series, n_rounds: int,
+                      eval_set=None) -> xgb.XGBRegressor:
+    """Boost thêm n_rounds cây từ booster hiện tại với params đã tune"""
+    booster, _ = base_booster(model)
+    params = model.get_params()
+    params.update({
+        'n_estimators': n_rounds,
+        'early_stopping_rounds': INCREMENTAL_EARLY_STOPPING if eval_set else None,
+        'callbacks': None,
+    })
+    updated = xgb.XGBRegressor(**params)
+    updated.fit(X, y, xgb_model=booster, eval_set=eval_set, verbose=False)
+    return updated
+
+
+def incremental_update(model: xgb.XGBRegressor, df_features: pd.DataFrame, last_train_date,
+                       target_profile: Optional[Dict] = None,
+                       target_col: str = 'daily_quantity') -> Tuple[Optional[xgb.XGBRegressor], Dict]:
+    """
+    Continued training trên ngày mới + replay window.
+
+    Args:
+        model: Model product_quantity đã train
+        df_features: Output của create_features, bao phủ replay window và các ngày mới
+        last_train_date: Ngày train gần nhất; các dòng sau ngày này là dữ liệu mới
+        target_profile: Profile target lúc full training (study user attrs) để đo drift
+
+    Returns:
+        (model đã cập nhật hoặc None nếu cần full retrain, thông tin/metrics)
+    """
+    feature_names = model.get_booster().feature_names
+    last_train = pd.Timestamp(last_train_date)
+    replay_start = last_train - pd.Timedelta(days=INCREMENTAL_REPLAY_DAYS)
+
+    df = df_features.dropna(subset=[target_col])
+    df = df[df['ngay'] > replay_start].sort_values('ngay', kind='mergesort')
+    new_days = np.sort(df.loc[df['ngay'] > last_train, 'ngay'].unique())
+    info = {'new_days': int(len(new_days)), 'replay_days': INCREMENTAL_REPLAY_DAYS}
+    if len(new_days) == 0:
+        info['reason'] = 'Không có dòng dữ liệu mới sau lần train cuối'
+        return None, info
+
+    # Drift của target trên các ngày mới so với lúc full training
+    if target_profile is not None:
+        drift = population_stability_index(target_profile, df.loc[df['ngay'] > last_train, target_col])
+        info['psi'] = drift
+        if drift > INCREMENTAL_MAX_DRIFT:
+            info['reason'] = f"Drift lớn (PSI={drift:.4f} > {INCREMENTAL_MAX_DRIFT})"
+            return None, info
+
+    X = df.reindex(columns=feature_names).fillna(0)
+    y = df[target_col]
+
+    # Holdout = các ngày mới nhất (ít nhất 1 ngày) để gate chất lượng
+    n_holdout = max(1, int(np.ceil(len(new_days) * HOLDOUT_FRACTION)))
+    holdout_mask = (df['ngay'] >= new_days[-n_holdout]).to_numpy()
+    X_fit, y_fit = X[~holdout_mask], y[~holdout_mask]
+    X_hold, y_hold = X[holdout_mask], y[holdout_mask]
+
+    old_mdape = median_absolute_percentage_error(y_hold, model.predict(X_hold))
+    candidate = continue_training(model, X_fit, y_fit, INCREMENTAL_BOOST_ROUNDS, eval_set=[(X_hold, y_hold)])
+    new_mdape = median_absolute_percentage_error(y_hold, candidate.predict(X_hold))
+
+    _, base_rounds = base_booster(model)
+    best_iteration = getattr(candidate.get_booster(), 'best_iteration', None)
+    extra_rounds = (best_iteration + 1 - base_rounds) if best_iteration is not None else INCREMENTAL_BOOST_ROUNDS
+    info.update({'holdout_days': n_holdout, 'holdout_mdape_before': float(old_mdape),
+                 'holdout_mdape_after': float(new_mdape), 'extra_rounds': int(max(extra_rounds, 0))})
+
+    if np.isfinite(old_mdape) and np.isfinite(new_mdape) and \
+            new_mdape > old_mdape * (1 + INCREMENTAL_MAX_DEGRADATION):
+        info['reason'] = (f"MdAPE holdout tăng {old_mdape:.2f}% → {new_mdape:.2f}% "
+                          f"(> {INCREMENTAL_MAX_DEGRADATION * 100:.0f}%)")
+        return None, info
+
+    if extra_rounds <= 0:
+        info['reason'] = 'Boost thêm không cải thiện holdout - giữ nguyên model'
+        return model, info
+
+    # Fit lại trên toàn bộ ngày mới + replay với số rounds đã chọn
+    updated = continue_training(model, X, y, extra_rounds)
+    info['reason'] = f"Boost thêm {extra_rounds} rounds trên {len(df):,} dòng"
+    return updated, info
@@ -0,0 +1,382 @@
+"""
+Engine tính đơn hàng cần đặt (Purchase Order) bằng groupby/merge
+
+generate_purchase_order_csv trước đây lọc weekly_df/daily_df theo từng sản phẩm
+(O(sản phẩm × dòng)), iterrows từng tuần, map lambda vào các dict và iterrows lần
+cuối để tạo dòng đơn hàng. Ở đây mọi bước là phép toán trên cột:
+    - optimal_inventory(): median(bán tuần + tồn nhỏ nhất × 0.75) = median(bán tuần)
+      + tồn nhỏ nhất × 0.75, tính bằng một groupby
+    - safety_stock(): (Nhu cầu max × Lead time max) - (Nhu cầu TB × Lead time TB) từ
+      groupby max/mean/count theo ngày; < 7 ngày dữ liệu → 50% tồn nhỏ nhất
+    - rank_products(): merge toàn bộ thông tin theo ma_hang, lượng cần nhập, sắp xếp
+      ưu tiên, cờ HIGH MARGIN / HIGH VALUE
+    - format_purchase_orders(): mức ưu tiên và ghi chú bằng np.select
+
+File Excel (generate_purchase_order_excel) cho toàn bộ catalog được ghi streaming:
+    - product_order_quantities() / branch_order_quantities(): lượng cần nhập theo sản
+      phẩm và phân bổ về từng chi nhánh theo tỷ trọng dự báo
+    - write_order_workbook(): openpyxl write-only workbook, từng sheet (tổng hợp + mỗi
+      chi nhánh) được append dòng và flush ra đĩa trước khi sang sheet sau; độ rộng cột
+      tính từ max độ dài chuỗi theo cột (vectorized), không duyệt lại từng cell
+
+Không truy cập DB: các hàm nhận DataFrame đã query (products, inventory_transactions,
+bán theo tuần/ngày từ ClickHouse) nên chạy được cho toàn bộ catalog và benchmark
+(benchmark.py --case purchase-order).
+"""
+
+import logging
+from typing import Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+OPTIMAL_MIN_STOCK_FACTOR = 0.75   # tồn kho tối ưu tuần = bán tuần + tồn nhỏ nhất × 0.75
+FALLBACK_SAFETY_FACTOR = 0.5      # thiếu dữ liệu ngày → Safety Stock = 50% tồn nhỏ nhất
+MIN_SAFETY_DAYS = 7               # số ngày có bán tối thiểu để tính Safety Stock
+ORDER_FORECAST_MULTIPLIER = 1.5   # lượng cần nhập = dự báo × 1.5 - bán tuần qua - tồn kho
+HIGH_MARGIN_PCT = 20
+HIGH_VALUE_QUANTILE = 0.8
+
+PURCHASE_ORDER_COLUMNS = ['stt', 'ma_hang', 'ma_vach', 'ten_san_pham', 'luong_can_nhap', 'ton_kho_toi_uu',
+                          'ton_an_toan', 'tong_muc_tieu', 'ton_nho_nhat', 'ton_hien_tai', 'du_bao',
+                          'da_ban_4tuan', 'doanh_thu_4tuan', 'margin_pct', 'uu_tien', 'ghi_chu']
+
+# File Excel đơn giản cho người đặt hàng: Tên sản phẩm, Mã vạch, Số lượng cần nhập
+EXCEL_COLUMNS = {'ten_san_pham': 'Tên sản phẩm', 'ma_vach': 'Mã vạch', 'luong_can_nhap': 'Số lượng cần nhập'}
+EXCEL_SUMMARY_SHEET = 'Đơn hàng cần nhập'
+EXCEL_MAX_COLUMN_WIDTH = 50
+EXCEL_HEADER_COLOR = '4472C4'
+_SHEET_NAME_MAX = 31
+_SHEET_NAME_INVALID = '[]:*?/\\'
+
+
+def _numeric(values: pd.Series) -> pd.Series:
+    return pd.to_numeric(values, errors='coerce').astype(float)
+
+
+def _keyed(df: Optional[pd.DataFrame], columns) -> pd.DataFrame:
+    """DataFrame rỗng có đủ cột khi query lỗi (None), ma_hang dạng str"""
+    if df is None or df.empty:
+        return pd.DataFrame({col: pd.Series(dtype=object if col == 'ma_hang' else float) for col in columns})
+    df = df.copy()
+    df['ma_hang'] = df['ma_hang'].astype(str)
+    return df
+
+
+def product_attributes(product_info_df: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Thông tin sản phẩm từ bảng products theo ma_hang: ma_vach, ten_hang, ton_nho_nhat
+    và margin % = (giá bán - giá vốn) / giá vốn × 100 (0 khi không có giá vốn)
+    """
+    df = _keyed(product_info_df, ['ma_hang', 'ma_vach', 'ten_hang', 'gia_von_mac_dinh',
+                                  'gia_ban_mac_dinh', 'ton_nho_nhat'])
+    # Mã trùng: giữ dòng cuối (giống dict trước đây)
+    df = df.drop_duplicates('ma_hang', keep='last').set_index('ma_hang')
+    gia_von = _numeric(df['gia_von_mac_dinh']).fillna(0)
+    gia_ban = _numeric(df['gia_ban_mac_dinh']).fillna(0)
+    ma_vach = df['ma_vach'].where(df['ma_vach'].notna() & (df['ma_vach'].astype(str) != ''))
+    return pd.DataFrame({
+        'ma_vach': ma_vach.fillna(pd.Series(df.index, index=df.index)),
+        'ten_hang': df['ten_hang'],
+        'ton_nho_nhat': _numeric(df['ton_nho_nhat']).fillna(0),
+        'margin_pct': np.where(gia_von > 0, (gia_ban - gia_von) / gia_von.where(gia_von > 0, 1) * 100, 0.0),
+    }, index=df.index)
+
+
+def optimal_inventory(weekly_df: Optional[pd.DataFrame], min_stock: pd.Series) -> pd.DataFrame:
+    """
+    Tồn kho tối ưu = median qua các tuần của (bán tuần + tồn nhỏ nhất × 0.75), làm tròn.
+    Cộng một hằng số cho mọi tuần của sản phẩm không đổi thứ tự nên bằng
+    median(bán tuần) + tồn nhỏ nhất × 0.75.
+
+    Args:
+        weekly_df: ma_hang, weekly_sold, weekly_revenue (một dòng mỗi sản phẩm × tuần)
+        min_stock: Tồn nhỏ nhất theo ma_hang (thiếu → 0)
+
+    Returns:
+        DataFrame theo ma_hang: ton_kho_toi_uu, da_ban_4tuan, doanh_thu_4tuan
+    """
+    df = _keyed(weekly_df, ['ma_hang', 'weekly_sold', 'weekly_revenue'])
+    sold = _numeric(df['weekly_sold'])
+    grouped = pd.DataFrame({
+        'ma_hang': df['ma_hang'],
+        'sold': sold.fillna(0),
+        'sold_raw': sold,
+        'revenue': _numeric(df['weekly_revenue']),
+    }).groupby('ma_hang', sort=False)
+    stats = grouped.agg(median_sold=('sold', 'median'), da_ban_4tuan=('sold_raw', 'sum'),
+                        doanh_thu_4tuan=('revenue', 'sum'))
+    min_stock = min_stock.reindex(stats.index).fillna(0)
+    stats['ton_kho_toi_uu'] = np.round(stats['median_sold'] + min_stock * OPTIMAL_MIN_STOCK_FACTOR)
+    return stats[['ton_kho_toi_uu', 'da_ban_4tuan', 'doanh_thu_4tuan']]
+
+
+def safety_stock(daily_df: Optional[pd.DataFrame], min_stock: pd.Series, products: pd.Index,
+                 lead_time_max: int = 14, lead_time_avg: int = 10) -> pd.Series:
+    """
+    Safety Stock = max(0, round(Nhu cầu max × Lead time max - Nhu cầu TB × Lead time TB))
+    cho sản phẩm có >= MIN_SAFETY_DAYS ngày dữ liệu, ngược lại round(tồn nhỏ nhất × 0.5)
+
+    Args:
+        daily_df: ma_hang, daily_sold (một dòng mỗi sản phẩm × ngày có bán)
+        min_stock: Tồn nhỏ nhất theo ma_hang
+        products: Danh sách ma_hang cần tính
+    """
+    df = _keyed(daily_df, ['ma_hang', 'daily_sold'])
+    daily = pd.DataFrame({'ma_hang': df['ma_hang'], 'sold': _numeric(df['daily_sold'])})
+    stats = daily.groupby('ma_hang', sort=False)['sold'].agg(['max', 'mean', 'size']).reindex(products)
+    days = stats['size'].fillna(0)
+    demand_based = np.maximum(0, np.round(stats['max'] * lead_time_max - stats['mean'] * lead_time_avg))
+    fallback = np.round(min_stock.reindex(products).fillna(0) * FALLBACK_SAFETY_FACTOR)
+    return pd.Series(np.where(days >= MIN_SAFETY_DAYS, demand_based, fallback), index=products,
+                     name='ton_an_toan')
+
+
+def rank_products(forecasts: pd.DataFrame, product_info_df: Optional[pd.DataFrame] = None,
+                  inventory_df: Optional[pd.DataFrame] = None, weekly_df: Optional[pd.DataFrame] = None,
+                  daily_df: Optional[pd.DataFrame] = None, top_n: int = 50, lead_time_max: int = 14,
+                  lead_time_avg: int = 10, forecast_days: int = 14) -> pd.DataFrame:
+    """
+    Tổng hợp dự báo + thông tin sản phẩm, tính lượng cần nhập và lấy top_n sản phẩm ưu tiên
+
+    Lượng cần nhập = max(0, round(Dự báo × 1.5 - Bán tuần qua - Tồn kho))
+    Ưu tiên: lượng cần nhập ↓, đã bán 4 tuần ↓, doanh thu 4 tuần ↓
+
+    Args:
+        forecasts: DataFrame từ predict_next_week (ma_hang, ten_san_pham, predicted_quantity,
+                   last_week_sales, ton_kho_nho_nhat)
+        product_info_df: Bảng products (ma_hang, ma_vach, ten_hang, gia_von_mac_dinh,
+                         gia_ban_mac_dinh, ton_nho_nhat)
+        inventory_df: Tồn kho hiện tại (ma_hang, ton_hien_tai)
+        weekly_df / daily_df: Bán theo tuần / ngày 28 ngày gần nhất
+        None hoặc rỗng = không có dữ liệu (các giá trị liên quan = 0)
+
+    Returns:
+        top_n dòng đã sắp xếp, cột forecast_{forecast_days}d, ton_kho_toi_uu, ton_an_toan,
+        tong_ton_kho_muc_tieu, is_high_margin, is_high_value, ...
+    """
+    forecast_col = f'forecast_{forecast_days}d'
+    summary = forecasts.assign(ma_hang=forecasts['ma_hang'].astype(str)).groupby(
+        ['ma_hang', 'ten_san_pham']).agg(**{
+            forecast_col: ('predicted_quantity', 'sum'),
+            'last_week_sales': ('last_week_sales', 'first'),
+            'ton_kho_nho_nhat': ('ton_kho_nho_nhat', 'first'),
+        }).reset_index()
+    products = pd.Index(summary['ma_hang'].unique())
+
+    info = product_attributes(product_info_df)
+    inventory = _keyed(inventory_df, ['ma_hang', 'ton_hien_tai']).drop_duplicates('ma_hang', keep='last')
+    optimal = optimal_inventory(weekly_df, info['ton_nho_nhat'])
+    safety = safety_stock(daily_df, info['ton_nho_nhat'], products, lead_time_max, lead_time_avg)
+
+    summary = (summary
+               .merge(info, left_on='ma_hang', right_index=True, how='left')
+               .merge(inventory[['ma_hang', 'ton_hien_tai']], on='ma_hang', how='left')
+               .merge(optimal, left_on='ma_hang', right_index=True, how='left')
+               .merge(safety, left_on='ma_hang', right_index=True, how='left'))
+    summary['ma_vach'] = summary['ma_vach'].fillna(summary['ma_hang'])
+    summary['ten_hang_day_du'] = summary['ten_hang'].fillna('')
+    summary['ton_hien_tai'] = _numeric(summary['ton_hien_tai'])
+    for col in ('ton_nho_nhat', 'ton_hien_tai', 'ton_kho_toi_uu', 'ton_an_toan',
+                'da_ban_4tuan', 'doanh_thu_4tuan', 'margin_pct'):
+        summary[col] = summary[col].fillna(0)
+    # Tổng mục tiêu = tồn kho tối ưu (nhu cầu) + tồn kho an toàn (dao động nhu cầu/lead time)
+    summary['tong_ton_kho_muc_tieu'] = summary['ton_kho_toi_uu'] + summary['ton_an_toan']
+
+    # Unified formula: forecast_14_days * 1.5 - last_week_sales - ton_kho (đồng bộ với email notifier)
+    summary['luong_can_nhap'] = (
+        summary[forecast_col] * ORDER_FORECAST_MULTIPLIER
+        - summary['last_week_sales']
+        - summary['ton_kho_nho_nhat']
+    ).clip(lower=0).round()
+
+    top_products = summary.sort_values(['luong_can_nhap', 'da_ban_4tuan', 'doanh_thu_4tuan'],
+                                       ascending=[False, False, False]).head(top_n).copy()
+    top_products['is_high_margin'] = top_products['margin_pct'] > HIGH_MARGIN_PCT
+    top_products['is_high_value'] = (top_products['doanh_thu_4tuan']
+                                     >= top_products['doanh_thu_4tuan'].quantile(HIGH_VALUE_QUANTILE))
+    return top_products.drop(columns=['ten_hang'])
+
+
+def format_purchase_orders(top_products: pd.DataFrame, forecast_days: int = 14) -> pd.DataFrame:
+    """
+    Dòng đơn hàng cho file CSV/Excel:
+        uu_tien: 🔴 Cần gấp (cần nhập > 2 × tồn hiện tại), 🟡 Cần đủ (> 0), 🟢 Đủ hàng
+        ghi_chu: ⭐ HIGH MARGIN + HIGH VALUE / 💰 HIGH MARGIN / 💎 HIGH VALUE
+    """
+    need = top_products['luong_can_nhap']
+    high_margin = top_products['is_high_margin'].to_numpy(dtype=bool)
+    high_value = top_products['is_high_value'].to_numpy(dtype=bool)
+    name = top_products['ten_hang_day_du'].where(top_products['ten_hang_day_du'] != '',
+                                                 top_products['ten_san_pham'])
+
+    def _int(col):
+        return np.round(top_products[col].to_numpy(dtype=float)).astype(np.int64)
+
+    po_df = pd.DataFrame({
+        'stt': np.arange(1, len(top_products) + 1),
+        'ma_hang': top_products['ma_hang'].to_numpy(),
+        'ma_vach': top_products['ma_vach'].to_numpy(),
+        'ten_san_pham': name.to_numpy(),
+        'luong_can_nhap': _int('luong_can_nhap'),
+        'ton_kho_toi_uu': _int('ton_kho_toi_uu'),
+        'ton_an_toan': _int('ton_an_toan'),
+        'tong_muc_tieu': _int('tong_ton_kho_muc_tieu'),
+        'ton_nho_nhat': _int('ton_nho_nhat'),
+        'ton_hien_tai': _int('ton_hien_tai'),
+        'du_bao': _int(f'forecast_{forecast_days}d'),
+        'da_ban_4tuan': _int('da_ban_4tuan'),
+        'doanh_thu_4tuan': _int('doanh_thu_4tuan'),
+        'margin_pct': np.round(top_products['margin_pct'].to_numpy(dtype=float), 1),
+        'uu_tien': np.select([need > top_products['ton_hien_tai'] * 2, need > 0],
+                             ['🔴 Cần gấp', '🟡 Cần đủ'], '🟢 Đủ hàng'),
+        'ghi_chu': np.select([high_margin & high_value, high_margin, high_value],
+                             ['⭐ HIGH MARGIN + HIGH VALUE', '💰 HIGH MARGIN', '💎 HIGH VALUE'], ''),
+    }, columns=PURCHASE_ORDER_COLUMNS)
+    return po_df.rename(columns={'du_bao': f'du_bao_{forecast_days}ngay'})
+
+
+def product_order_quantities(forecasts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Lượng cần nhập theo sản phẩm (ma_hang, ten_san_pham, predicted_quantity, suggested_order),
+    sắp xếp giảm dần.
+
+    suggested_order do save_forecasts gán cho từng dòng dự báo là giá trị của cả sản phẩm
+    nên lấy 'first' (không cộng dồn qua chi nhánh × ngày). Forecasts chưa có cột này
+    (predict_next_week trực tiếp) → công thức thống nhất: dự báo × 1.5 - bán tuần qua - tồn kho,
+    khi đó bắt buộc có last_week_sales và ton_kho_nho_nhat.
+    
+    Raises:
+        ValueError: Không có suggested_order và thiếu last_week_sales/ton_kho_nho_nhat
+    """
+    if 'suggested_order' not in forecasts.columns:
+        missing = [col for col in ('last_week_sales', 'ton_kho_nho_nhat') if col not in forecasts.columns]
+        if missing:
+            raise ValueError(f"Forecasts thiếu cột {missing} để tính lượng cần nhập "
+                             f"(cần suggested_order hoặc last_week_sales + ton_kho_nho_nhat)")
+    df = forecasts.assign(ma_hang=forecasts['ma_hang'].astype(str))
+    agg = {'ten_san_pham': ('ten_san_pham', 'first'), 'predicted_quantity': ('predicted_quantity', 'sum')}
+    for col in ('suggested_order', 'last_week_sales', 'ton_kho_nho_nhat'):
+        if col in df.columns:
+            agg[col] = (col, 'first')
+    orders = df.groupby('ma_hang').agg(**agg)
+    if 'suggested_order' not in orders.columns:
+        orders['suggested_order'] = (
+            orders['predicted_quantity'] * ORDER_FORECAST_MULTIPLIER
+            - orders['last_week_sales']
+            - orders['ton_kho_nho_nhat']
+        ).clip(lower=0).round()
+    orders['suggested_order'] = _numeric(orders['suggested_order']).fillna(0)
+    orders = orders.reset_index().sort_values('suggested_order', ascending=False, kind='mergesort')
+    return orders[['ma_hang', 'ten_san_pham', 'predicted_quantity', 'suggested_order']].reset_index(drop=True)
+
+
+def branch_order_quantities(forecasts: pd.DataFrame, orders: pd.DataFrame) -> pd.DataFrame:
+    """
+    Phân bổ lượng cần nhập của sản phẩm về các chi nhánh theo tỷ trọng dự báo
+    (chi_nhanh, ma_hang, luong_can_nhap).
+
+    Làm tròn theo largest remainder: phần nguyên trước, các đơn vị còn thiếu cho chi nhánh
+    có phần lẻ lớn nhất → tổng các chi nhánh bằng đúng lượng cần nhập của sản phẩm.
+    """
+    branch = (forecasts.assign(ma_hang=forecasts['ma_hang'].astype(str))
+              .groupby(['chi_nhanh', 'ma_hang'], as_index=False)['predicted_quantity'].sum()
+              .merge(orders[['ma_hang', 'suggested_order']], on='ma_hang', how='inner'))
+    product_total = branch.groupby('ma_hang')['predicted_quantity'].transform('sum')
+    share = (branch['predicted_quantity'] / product_total.where(product_total > 0)).fillna(0)
+    raw = branch['suggested_order'] * share
+    base = np.floor(raw)
+    missing = (branch['suggested_order'] - base.groupby(branch['ma_hang']).transform('sum')).round()
+    rank = (raw - base).groupby(branch['ma_hang']).rank(method='first', ascending=False)
+    branch['luong_can_nhap'] = (base + ((rank <= missing) & (product_total > 0))).astype(np.int64)
+    return branch[['chi_nhanh', 'ma_hang', 'luong_can_nhap']]
+
+
+def excel_order_rows(orders: pd.DataFrame, product_info: Optional[pd.DataFrame] = None,
+                     quantity_col: str = 'suggested_order') -> pd.DataFrame:
+    """
+    Dòng file Excel: Tên sản phẩm (dự báo, fallback tên trong products), Mã vạch
+    (fallback ma_hang), Số lượng cần nhập
+
+    Args:
+        orders: ma_hang, quantity_col (+ ten_san_pham nếu có)
+        product_info: Bảng products (ma_hang, ma_vach, ten_hang); None = không có mã vạch
+    """
+    info = _keyed(product_info, ['ma_hang', 'ma_vach', 'ten_hang']).drop_duplicates('ma_hang', keep='last')
+    df = orders.merge(info[['ma_hang', 'ma_vach', 'ten_hang']], on='ma_hang', how='left')
+    name = df['ten_san_pham'] if 'ten_san_pham' in df.columns else pd.Series(np.nan, index=df.index)
+    name = name.where(name.notna() & (name.astype(str) != ''), df['ten_hang']).fillna('')
+    barcode = df['ma_vach'].where(df['ma_vach'].notna() & (df['ma_vach'].astype(str) != ''), df['ma_hang'])
+    return pd.DataFrame({
+        EXCEL_COLUMNS['ten_san_pham']: name.to_numpy(),
+        EXCEL_COLUMNS['ma_vach']: barcode.to_numpy(),
+        EXCEL_COLUMNS['luong_can_nhap']: np.round(_numeric(df[quantity_col]).fillna(0).to_numpy()).astype(np.int64),
+    })
+
+
+def column_widths(df: pd.DataFrame, max_width: int = EXCEL_MAX_COLUMN_WIDTH) -> List[int]:
+    """Độ rộng cột = max(độ dài header, độ dài chuỗi dài nhất của cột) + 2, tối đa max_width"""
+    widths = []
+    for col in df.columns:
+        longest = df[col].astype(str).str.len().max() if len(df) else 0
+        widths.append(min(max(len(str(col)), int(longest or 0)) + 2, max_width))
+    return widths
+
+
+def excel_sheet_name(name, used: Set[str]) -> str:
+    """Tên sheet hợp lệ (<= 31 ký tự, bỏ []:*?/\\) và không trùng sheet đã có"""
+    base = ''.join('_' if ch in _SHEET_NAME_INVALID else ch for ch in str(name)).strip() or 'Sheet'
+    candidate, i = base[:_SHEET_NAME_MAX], 1
+    while candidate.lower() in used:
+        suffix = f' ({i})'
+        candidate, i = base[:_SHEET_NAME_MAX - len(suffix)] + suffix, i + 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def write_order_workbook(path: str, sheets: Iterable[Tuple[str, pd.DataFrame]]) -> int:
+    """
+    Ghi các sheet đơn hàng bằng openpyxl write-only workbook (streaming)
+
+    Mỗi sheet: đặt độ rộng cột trước, header in đậm nền xanh, sau đó append từng dòng;
+    `sheets` có thể là generator nên chỉ DataFrame của sheet đang ghi nằm trong bộ nhớ.
+
+    Returns:
+        Tổng số dòng dữ liệu đã ghi
+    """
+    if not OPENPYXL_AVAILABLE:
+        raise ImportError("openpyxl chưa được cài đặt")
+    wb = Workbook(write_only=True)
+    header_font = Font(bold=True, color='FFFFFF')
+    header_fill = PatternFill(patternType='solid', fgColor=EXCEL_HEADER_COLOR)
+    used: Set[str] = set()
+    total_rows = 0
+    for name, df in sheets:
+        ws = wb.create_sheet(title=excel_sheet_name(name, used))
+        for idx, width in enumerate(column_widths(df), start=1):
+            ws.column_dimensions[get_column_letter(idx)].width = width
+        header = []
+        for col in df.columns:
+            cell = WriteOnlyCell(ws, value=str(col))
+            cell.font = header_font
+            cell.fill = header_fill
+            header.append(cell)
+        ws.append(header)
+        for row in df.itertuples(index=False, name=None):
+            ws.append(row)
+        total_rows += len(df)
+    if not wb.worksheets:
+        wb.create_sheet(title=EXCEL_SUMMARY_SHEET)
+    wb.save(path)
+    return total_rows
@@ -0,0 +1,127 @@
+"""
+Sharding Model 1 (product_quantity) theo segment
+
+Thay vì một model global cho mọi series (chi_nhanh, ma_hang), sharded mode train
+một model cho mỗi segment (abc_class hoặc nhom_hang_cap_1) trong các worker
+processes song song, mỗi shard nhận số trials tỉ lệ với số dòng của nó.
+Segment có ít hơn SHARD_MIN_ROWS dòng được gộp vào shard OTHER_SHARD, shard này
+cũng nhận các segment chưa gặp lúc predict.
+
+ShardedModel được lưu như các model khác (product_quantity_shards_model.pkl) và
+route từng series đến model của segment khi predict.
+"""
+
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SHARD_COLUMNS = ('abc_class', 'nhom_hang_cap_1')
+OTHER_SHARD = '__other__'
+SHARD_MIN_ROWS = int(os.getenv('SHARD_MIN_ROWS', '5000'))
+SHARD_MIN_TRIALS = int(os.getenv('SHARD_MIN_TRIALS', '5'))
+
+
+def segment_labels(df: pd.DataFrame, shard_by: str, encoders=None) -> pd.Series:
+    """
+    Segment của mỗi dòng. Features training không còn cột abc_class (đã encode
+    thành abc_encoded) nên giải mã ngược qua CategoricalEncoders.
+    """
+    if shard_by in df.columns:
+        fill_value = 'C' if shard_by == 'abc_class' else OTHER_SHARD
+        return df[shard_by].astype(object).fillna(fill_value).astype(str)
+    if shard_by == 'abc_class' and 'abc_encoded' in df.columns and encoders is not None:
+        categories = np.asarray(encoders.categories.get('abc_class', []), dtype=object)
+        codes = df['abc_encoded'].to_numpy()
+        known = (codes >= 0) & (codes < len(categories))
+        labels = np.full(len(df), OTHER_SHARD, dtype=object)
+        labels[known] = categories[codes[known]]
+        return pd.Series(labels, index=df.index)
+    return pd.Series(OTHER_SHARD, index=df.index)
+
+
+def plan_shards(labels: pd.Series, n_trials: int, min_rows: int = SHARD_MIN_ROWS,
+                min_trials: int = SHARD_MIN_TRIALS) -> Dict[str, Dict]:
+    """
+    {shard: {'rows': vị trí dòng, 'n_trials': budget}}; segment nhỏ gộp vào OTHER_SHARD.
+    """
+    counts = labels.value_counts()
+    small = set(counts[counts < min_rows].index)
+    shard_labels = labels.where(~labels.isin(small), OTHER_SHARD).to_numpy()
+    total_rows = max(len(labels), 1)
+
+    plan = {}
+    for shard in pd.unique(shard_labels):
+        rows = np.flatnonzero(shard_labels == shard)
+        plan[shard] = {
+            'rows': rows,
+            'n_trials': max(min_trials, int(round(n_trials * len(rows) / total_rows))),
+        }
+    return plan
+
+
+def run_shards_parallel(train_shard: Callable, shard_args: Dict[str, tuple],
+                        n_workers: Optional[int] = None) -> Dict[str, tuple]:
+    """
+    Chạy train_shard(*args) cho mỗi shard trong worker processes (spawn).
+
+    Mỗi worker dùng cpu_count // n_workers threads OpenMP (OMP_NUM_THREADS được
+    đặt trước khi spawn để process con đọc lúc khởi tạo).
+    """
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(shard_args)))
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    logger.info(f"⚙️  Sharded training: {len(shard_args)} shards, {n_workers} workers × {n_threads} threads")
+
+    previous = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    results = {}
+    try:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+            futures = {shard: pool.submit(train_shard, *args) for shard, args in shard_args.items()}
+            for shard, future in futures.items():
+                try:
+                    results[shard] = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Shard '{shard}' training failed: {e}")
+    finally:
+        if previous is None:
+            os.environ.pop('OMP_NUM_THREADS', None)
+        else:
+            os.environ['OMP_NUM_THREADS'] = previous
+    return results
+
+
+class ShardedModel:
+    """Tập models theo segment + router series → model"""
+
+    def __init__(self, shard_by: str, models: Dict[str, object]):
+        self.shard_by = shard_by
+        self.models = models
+
+    @property
+    def feature_names_in_(self) -> np.ndarray:
+        return next(iter(self.models.values())).feature_names_in_
+
+    def fallback_shard(self) -> str:
+        """Shard cho segment không có model riêng: OTHER_SHARD, nếu không có thì shard đầu tiên"""
+        return OTHER_SHARD if OTHER_SHARD in self.models else next(iter(self.models))
+
+    def route(self, labels: pd.Series) -> pd.Series:
+        """Segment label → tên shard có model"""
+        return labels.where(labels.isin(list(self.models)), self.fallback_shard())
+
+    def groups(self, df: pd.DataFrame, encoders=None) -> List[tuple]:
+        """[(shard, model, sub-frame)] theo segment của từng dòng"""
+        labels = segment_labels(df, self.shard_by, encoders)
+        if {'chi_nhanh', 'ma_hang'}.issubset(df.columns):
+            # Cả series đi cùng một shard (recursive forecast cần toàn bộ lịch sử series)
+            labels = labels.groupby([df['chi_nhanh'], df['ma_hang']], sort=False, observed=True).transform('last')
+        shards = self.route(labels)
+        return [(shard, self.models[shard], part) for shard, part in df.groupby(shards.to_numpy(), sort=False)]
@@ -0,0 +1,126 @@
+"""
+Snapshot cache cho dữ liệu training load từ ClickHouse
+
+Kết quả query nặng (fct_regular_sales ⨝ dim_product ⨝ int_dynamic_seasonal_factor)
+được lưu thành file Arrow IPC trong {model_dir}/snapshots, key là hash của:
+    - text query (bao gồm date filter)
+    - watermark của nguồn: max(transaction_date) + count() của fct_regular_sales
+      và max(modification_time) của các parts thuộc các bảng trong query
+    - ngày hiện tại nếu query dùng today() (cửa sổ ngày trượt theo ngày)
+
+Lần load sau với cùng phiên bản dữ liệu (chạy lại sau crash, stage thứ hai của
+--mode all) chỉ cần query watermark nhẹ rồi đọc file bằng memory map.
+"""
+
+import os
+import json
+import glob
+import hashlib
+import logging
+from datetime import date, datetime
+from typing import Callable, Dict, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAX_ENTRIES = int(os.getenv('SNAPSHOT_MAX_ENTRIES', '4'))
+
+
+def snapshot_enabled() -> bool:
+    return PYARROW_AVAILABLE and os.getenv('SNAPSHOT_CACHE', 'true').lower() in ('1', 'true', 'yes')
+
+
+def watermark_query(tables, days: int = 0) -> str:
+    """
+    Query watermark nhẹ: max ngày + số dòng fact (cùng cửa sổ ngày với query chính)
+    và lần thay đổi parts gần nhất của các bảng nguồn.
+    """
+    table_list = ', '.join(f"'{t}'" for t in tables)
+    date_filter = f"AND f.transaction_date >= today() - {days}" if days > 0 else ""
+    return f"""
+    SELECT
+        (SELECT toString(max(transaction_date)) FROM retail_dw.fct_regular_sales f
+         WHERE f.product_code IS NOT NULL AND f.product_code != '' {date_filter}) as max_date,
+        (SELECT count() FROM retail_dw.fct_regular_sales f
+         WHERE f.product_code IS NOT NULL AND f.product_code != '' {date_filter}) as row_count,
+        (SELECT toString(max(modification_time)) FROM system.parts
+         WHERE database = 'retail_dw' AND table IN ({table_list}) AND active) as parts_modified
+    """
+
+
+class SnapshotCache:
+    """Arrow IPC snapshots của các frame đã load, key theo query + watermark"""
+
+    def __init__(self, cache_dir: str, max_entries: int = SNAPSHOT_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(query: str, watermark: Dict) -> str:
+        payload = json.dumps({'query': ' '.join(query.split()), 'watermark': watermark}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.arrow')
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            # File không nén → memory map, không copy khi đọc
+            table = feather.read_table(path, memory_map=True)
+            os.utime(path)  # LRU theo mtime
+            return table.to_pandas()
+        except Exception as e:
+            logger.warning(f"⚠️ Snapshot hỏng, bỏ qua: {path} ({e})")
+            return None
+
+    def put(self, key: str, df: pd.DataFrame, watermark: Dict):
+        path = self._path(key)
+        tmp_path = f'{path}.tmp'
+        try:
+            feather.write_feather(df.reset_index(drop=True), tmp_path, compression='uncompressed')
+            os.replace(tmp_path, path)
+            with open(os.path.join(self.cache_dir, f'{key}.json'), 'w', encoding='utf-8') as f:
+                json.dump({'watermark': watermark, 'rows': len(df),
+                           'created_at': datetime.now().isoformat()}, f, indent=2, default=str)
+        except Exception as e:
+            logger.warning(f"⚠️ Không thể lưu snapshot {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        """Giữ max_entries snapshots dùng gần nhất"""
+        snapshots = sorted(glob.glob(os.path.join(self.cache_dir, '*.arrow')), key=os.path.getmtime, reverse=True)
+        for path in snapshots[self.max_entries:]:
+            for stale in (path, path[:-len('.arrow')] + '.json'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+    def load(self, query: str, run_query: Callable[[str], pd.DataFrame], watermark: Dict,
+             uses_today: bool = False) -> pd.DataFrame:
+        """
+        Trả snapshot nếu cùng phiên bản dữ liệu, nếu không thì chạy query và lưu snapshot.
+        """
+        if uses_today:
+            watermark = {**watermark, 'today': date.today().isoformat()}
+        key = self.make_key(query, watermark)
+        df = self.get(key)
+        if df is not None:
+            logger.info(f"⚡ Snapshot cache hit ({len(df):,} dòng, watermark {watermark}) → {self._path(key)}")
+            return df
+        df = run_query(query)
+        self.put(key, df, watermark)
+        logger.info(f"💾 Snapshot cache miss - đã lưu {len(df):,} dòng → {self._path(key)}")
+        return df
@@ -5,9 +5,11 @@ Script chính để train XGBoost models với Optuna hyperparameter tuning
 
 import argparse
 import logging
+import os
 import sys
 import traceback
 from xgboost_forecast import SalesForecaster
+from connection_pool import log_connection_stats
 
 logging.basicConfig(
     level=logging.INFO,
@@ -44,6 +46,64 @@ def main():
         action='store_true',
         help='Generate forecasts sau khi train'
     )
+    parser.add_argument(
+        '--forecast-mode',
+        type=str,
+        default='recursive',
+        choices=['recursive', 'direct'],
+        help='Chế độ forecast Model 1: recursive hoặc direct multi-horizon (default: recursive)'
+    )
+    parser.add_argument(
+        '--feature-store',
+        action='store_true',
+        help='Load features từ feature store (Parquet) thay vì tính lại toàn bộ'
+    )
+    parser.add_argument(
+        '--tuning-workers',
+        type=int,
+        default=int(os.getenv('TUNING_WORKERS', '1')),
+        help='Số processes chạy Optuna trials song song, mỗi process dùng cpu_count/workers threads (default: 1)'
+    )
+    parser.add_argument(
+        '--warm-start',
+        action='store_true',
+        help='Enqueue top params của study lần trước; giảm số trials khi target ít drift'
+    )
+    parser.add_argument(
+        '--tuning-strategy',
+        type=str,
+        default='full',
+        choices=['full', 'hyperband'],
+        help='full: mọi trial trên toàn bộ dữ liệu; hyperband: successive halving trên tập con series (default: full)'
+    )
+    parser.add_argument(
+        '--shard-by',
+        type=str,
+        default=None,
+        choices=['abc_class', 'nhom_hang_cap_1'],
+        help='Train Model 1 theo segment trong các worker processes song song (default: model global)'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Continued training Model 1 trên ngày mới + replay window khi drift nhỏ, fallback full retrain'
+    )
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='Out-of-core training: features theo chunk ngày trên đĩa, Model 1 train bằng xgb.DataIter (bộ nhớ theo chunk)'
+    )
+    parser.add_argument(
+        '--chunk-days',
+        type=int,
+        default=int(os.getenv('EXTERNAL_MEMORY_CHUNK_DAYS', '30')),
+        help='Số ngày mỗi chunk cho --streaming (default: 30)'
+    )
+    parser.add_argument(
+        '--full-catalog-po',
+        action='store_true',
+        help='Tạo file Excel đơn hàng cho toàn bộ catalog (sheet tổng hợp + mỗi chi nhánh) sau khi train'
+    )
     parser.add_argument(
         '--no-email',
         action='store_true',
@@ -64,23 +124,62 @@ def main():
         logger.info(f"Method: {args.method}")
         logger.info(f"Trials: {args.trials}")
         logger.info(f"Historical days: {args.days}")
+        logger.info(f"Forecast mode: {args.forecast_mode}")
+        logger.info(f"Tuning workers: {args.tuning_workers}")
+        logger.info(f"Warm start: {'ON' if args.warm_start else 'OFF'}")
+        logger.info(f"Tuning strategy: {args.tuning_strategy}")
+        logger.info(f"Shard by: {args.shard_by or 'OFF (global model)'}")
+        logger.info(f"Incremental: {'ON' if args.incremental else 'OFF'}")
+        logger.info(f"Streaming: {f'ON ({args.chunk_days} ngày/chunk)' if args.streaming else 'OFF'}")
+        logger.info(f"Full-catalog PO: {'ON' if args.full_catalog_po else 'OFF'}")
         logger.info(f"Email notifications: {'OFF' if args.no_email else 'ON'}")
         logger.info("=" * 60)
         
-        metrics = forecaster.train_all_models(
-            n_trials=args.trials,
-            days=args.days,
-            send_email=not args.no_email,
-            tuning_method=args.method
-        )
+        metrics = None
+        if args.incremental:
+            retrain_mode, reason = forecaster.should_retrain(allow_incremental=True)
+            logger.info(f"Retrain mode: {retrain_mode} - {reason}")
+            if retrain_mode == 'incremental':
+                metrics = forecaster.update_models_incremental(use_feature_store=args.feature_store)
+            elif retrain_mode == 'skip':
+                metrics = {}
+        
+        if metrics is None and args.streaming:
+            metrics = forecaster.train_all_models_streaming(
+                n_trials=args.trials,
+                days=args.days,
+                send_email=not args.no_email,
+                chunk_days=args.chunk_days
+            )
+        if metrics is None:
+            metrics = forecaster.train_all_models(
+                n_trials=args.trials,
+                days=args.days,
+                send_email=not args.no_email,
+                tuning_method=args.method,
+                forecast_mode=args.forecast_mode,
+                use_feature_store=args.feature_store,
+                tuning_workers=args.tuning_workers,
+                warm_start=args.warm_start,
+                tuning_strategy=args.tuning_strategy,
+                shard_by=args.shard_by
+            )
         
         # Generate forecasts nếu cần
         if args.predict:
             logger.info("\n🔮 Generating forecasts...")
-            forecasts = forecaster.predict_next_week()
+            forecasts = forecaster.predict_next_week(forecast_mode=args.forecast_mode)
             forecaster.save_forecasts(forecasts, send_email=not args.no_email)
             logger.info(f"✅ Saved {len(forecasts)} forecasts")
         
+        if args.full_catalog_po:
+            logger.info("\n📦 Generating full-catalog purchase order...")
+            po_path = forecaster.generate_purchase_order_excel(full_catalog=True,
+                                                              forecast_mode=args.forecast_mode)
+            logger.info(f"✅ Purchase order: {po_path}")
+        
+        logger.info(f"🗃️ ClickHouse query cache: {forecaster.ch.query_cache.stats()}")
+        log_connection_stats()
         logger.info("\n✨ Training completed!")
         
     except Exception as e:
@@ -0,0 +1,642 @@
+"""
+Tiện ích Optuna tuning cho XGBoost
+
+Pruning theo 2 mức trong train_model_optuna:
+    - Boosting round: XGBoostPruningCallback report validation metric sau mỗi round
+      của mỗi fold → trial tệ bị dừng ngay trong fold đầu tiên
+    - Fold: report CV score trung bình sau mỗi fold TimeSeriesSplit
+
+Mỗi loại report dùng một dải step riêng để MedianPruner chỉ so sánh các giá trị
+cùng loại giữa các trials:
+    round r của fold k  → step = k × MAX_BOOST_ROUNDS + r
+    kết thúc fold k     → step = n_splits × MAX_BOOST_ROUNDS + k
+
+Fold cache: dữ liệu train/valid của mỗi fold được quantize một lần thành
+QuantileDMatrix (valid dùng ref=train để chung cut points) và dùng lại read-only
+cho mọi trial qua xgb.train, thay vì XGBRegressor.fit chuyển đổi lại pandas slices
+ở mỗi fold của mỗi trial.
+
+Multi-fidelity (tuning strategy 'hyperband'): mỗi trial đi qua các rung dữ liệu
+tăng dần (FIDELITY_FRACTIONS của series, lấy mẫu phân tầng theo chi nhánh × ABC;
+không có series thì dùng cửa sổ ngày gần nhất), successive halving chỉ cho các
+config tốt lên rung dữ liệu đầy đủ. CPU-seconds mỗi trial được ghi vào
+trial.user_attrs để ước tính phần tiết kiệm so với tuning trên toàn bộ dữ liệu.
+
+Warm start: study của lần train trước ({target}_optuna_study.pkl) cung cấp top-k
+params để enqueue vào study mới; nếu phân phối target gần như không đổi
+(PSI < WARM_START_DRIFT_THRESHOLD) thì số trials được giảm theo
+WARM_START_TRIAL_FRACTION.
+
+Parallel tuning: N worker processes cùng chạy một study qua journal storage
+(file trong model_dir), mỗi worker giới hạn số thread XGBoost để
+workers × threads ≤ số CPU cores. X/y, fold splits và rung subsets được ghi một lần
+thành .npy cạnh journal; workers mở bằng memmap (page cache dùng chung) thay vì nhận
+một bản copy pickle của ma trận training. Budget n_trials được giữ chính xác theo
+trial.number (storage cấp số tuần tự) thay vì MaxTrialsCallback (đếm sau khi trial xong
+nên N workers có thể chạy dư tới N - 1 trials).
+"""
+
+import os
+import time
+import shutil
+import logging
+import joblib
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.metrics import mean_absolute_error, mean_absolute_percentage_error
+
+try:
+    import optuna
+    from optuna.samplers import TPESampler
+    OPTUNA_AVAILABLE = True
+except ImportError:
+    OPTUNA_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+MAX_BOOST_ROUNDS = 2000  # n_estimators tối đa, early stopping sẽ dừng sớm
+EARLY_STOPPING_ROUNDS = 50
+MAX_BIN = 256  # Giảm bins để tăng tốc; fold cache được quantize với cùng max_bin
+QUANTILE_TREE_METHODS = ('hist', 'gpu_hist')
+
+# Warm start từ study trước
+WARM_START_TOP_K = int(os.getenv('WARM_START_TOP_K', '5'))
+WARM_START_DRIFT_THRESHOLD = float(os.getenv('WARM_START_DRIFT_THRESHOLD', '0.1'))  # PSI: < 0.1 = drift nhỏ
+WARM_START_TRIAL_FRACTION = float(os.getenv('WARM_START_TRIAL_FRACTION', '0.3'))
+PROFILE_BINS = 10
+
+# Tuning strategies: 'full' = mọi trial trên toàn bộ dữ liệu (MedianPruner theo round/fold),
+# 'hyperband' = successive halving trên kích thước dữ liệu
+TUNING_STRATEGIES = ('full', 'hyperband')
+FIDELITY_FRACTIONS = (1 / 9, 1 / 3, 1.0)  # reduction factor 3
+FIDELITY_MAX_RESOURCE = 9  # step Optuna của rung = fraction × FIDELITY_MAX_RESOURCE
+FIDELITY_STRATA = ('chi_nhanh', 'abc_class', 'abc_encoded')
+
+
+def median_absolute_percentage_error(y_true, y_pred):
+    """MdAPE - Median Absolute Percentage Error, ít nhạy cảm với outliers hơn MAPE
+    
+    Filter out zeros để tránh division by zero.
+    """
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    mask = y_true > 0
+    if mask.sum() == 0:
+        return np.nan
+    return np.median(np.abs((y_true[mask] - y_pred[mask]) / y_true[mask])) * 100
+
+
+def score_predictions(y_true, y_pred, metric_type: str = 'mape') -> float:
+    """Metric tuning: 'mdape', 'mae' hoặc 'mape' (bỏ qua y_true = 0)"""
+    if metric_type == 'mdape':
+        # Median Absolute Percentage Error - ít nhạy với outliers
+        return median_absolute_percentage_error(y_true, y_pred)
+    if metric_type == 'mae':
+        # Mean Absolute Error - phù hợp cho profit margin
+        return mean_absolute_error(y_true, y_pred)
+    # Filter out zeros để tránh division by zero
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    mask = y_true > 0
+    if mask.sum() > 0:
+        return mean_absolute_percentage_error(y_true[mask], y_pred[mask])
+    return np.nan
+
+
+def round_step(fold_idx: int, iteration: int) -> int:
+    """Step Optuna cho boosting round `iteration` của fold `fold_idx`"""
+    return fold_idx * MAX_BOOST_ROUNDS + iteration
+
+
+def fold_step(n_splits: int, fold_idx: int) -> int:
+    """Step Optuna cho CV score sau fold `fold_idx`"""
+    return n_splits * MAX_BOOST_ROUNDS + fold_idx
+
+
+def create_pruner(strategy: str = 'full', n_startup_trials: int = 5, n_warmup_steps: int = 20):
+    """
+    'full': MedianPruner - không prune trong n_startup_trials trials đầu và
+            n_warmup_steps boosting rounds đầu của fold đầu tiên.
+    'hyperband': successive halving trên các rung dữ liệu (step 1 → FIDELITY_MAX_RESOURCE),
+                 tức một bracket của Hyperband - với 50-150 trials, chia trials cho nhiều
+                 brackets khiến các rung nhỏ gần như không prune.
+    """
+    if strategy == 'hyperband':
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=3,
+                                                      min_early_stopping_rate=0)
+    return optuna.pruners.MedianPruner(n_startup_trials=n_startup_trials,
+                                       n_warmup_steps=n_warmup_steps)
+
+
+class XGBoostPruningCallback(xgb.callback.TrainingCallback):
+    """
+    Report validation metric của eval_set đầu tiên sau mỗi boosting round và
+    raise optuna.TrialPruned khi pruner quyết định dừng trial.
+    """
+
+    def __init__(self, trial, fold_idx: int = 0):
+        super().__init__()
+        self.trial = trial
+        self.fold_idx = fold_idx
+
+    def after_iteration(self, model, epoch: int, evals_log) -> bool:
+        if not evals_log:
+            return False
+        metrics = next(iter(evals_log.values()))
+        values = next(iter(metrics.values()))
+        if not values:
+            return False
+        score = values[-1]
+        if isinstance(score, tuple):  # (mean, std) khi dùng xgb.cv
+            score = score[0]
+        self.trial.report(float(score), step=round_step(self.fold_idx, epoch))
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"Pruned tại fold {self.fold_idx}, round {epoch}")
+        return False
+
+
+def log_study_summary(study, target_col: str):
+    """Log số trials hoàn thành / bị prune"""
+    states = [t.state for t in study.trials]
+    n_complete = sum(s == optuna.trial.TrialState.COMPLETE for s in states)
+    n_pruned = sum(s == optuna.trial.TrialState.PRUNED for s in states)
+    logger.info(f"✂️  {target_col}: {n_complete} trials hoàn thành, {n_pruned} trials bị prune "
+                f"({n_pruned / max(len(states), 1) * 100:.0f}%)")
+
+
+def fidelity_savings(study) -> Dict:
+    """
+    CPU-seconds thực tế của multi-fidelity tuning và ước tính tiết kiệm so với chạy
+    mọi trial trên toàn bộ dữ liệu (chi phí rung đầy đủ trung bình × số trials).
+    """
+    trials = [t for t in study.trials if 'cpu_seconds' in t.user_attrs]
+    full_costs = [t.user_attrs['cpu_seconds_full'] for t in trials if 'cpu_seconds_full' in t.user_attrs]
+    actual = float(sum(t.user_attrs['cpu_seconds'] for t in trials))
+    if not full_costs:
+        return {'cpu_seconds': actual}
+    exhaustive = float(np.mean(full_costs)) * len(trials)
+    return {
+        'cpu_seconds': actual,
+        'cpu_seconds_exhaustive_est': exhaustive,
+        'cpu_seconds_saved_est': exhaustive - actual,
+        'trials_full_fidelity': len(full_costs),
+    }
+
+
+def _take(data, idx):
+    """Dòng theo vị trí của DataFrame/Series (iloc) hoặc ndarray/memmap (chỉ copy các dòng lấy)"""
+    return data.iloc[idx] if isinstance(data, (pd.DataFrame, pd.Series)) else np.asarray(data[idx])
+
+
+class FoldDataCache:
+    """
+    DMatrix train/valid của các fold CV, build một lần và dùng chung cho mọi trial.
+
+    hist/gpu_hist: QuantileDMatrix (đã quantize theo MAX_BIN, valid dùng ref=train);
+    tree method khác: DMatrix thường. X/y là pandas hoặc ndarray (memmap của worker).
+    """
+
+    def __init__(self, X, y, splits: List[Tuple[np.ndarray, np.ndarray]],
+                 tree_method: str = 'hist', n_threads: int = -1):
+        self.folds = []
+        for train_idx, valid_idx in splits:
+            X_train, y_train = _take(X, train_idx), _take(y, train_idx)
+            X_valid, y_valid = _take(X, valid_idx), _take(y, valid_idx)
+            if tree_method in QUANTILE_TREE_METHODS:
+                dtrain = xgb.QuantileDMatrix(X_train, y_train, max_bin=MAX_BIN, nthread=n_threads)
+                dvalid = xgb.QuantileDMatrix(X_valid, y_valid, ref=dtrain, nthread=n_threads)
+            else:
+                dtrain = xgb.DMatrix(X_train, y_train, nthread=n_threads)
+                dvalid = xgb.DMatrix(X_valid, y_valid, nthread=n_threads)
+            self.folds.append((dtrain, dvalid, np.asarray(y_valid)))
+
+    def __len__(self) -> int:
+        return len(self.folds)
+
+    def __iter__(self):
+        return iter(self.folds)
+
+
+class XGBoostCVObjective:
+    """
+    Objective Optuna: TimeSeriesSplit CV (xgb.train trên FoldDataCache) với pruning
+    theo round và fold.
+
+    Là object (không phải closure) để pickle được sang worker processes; fold cache
+    không được pickle mà build lại một lần trong mỗi process. Sau share_data(), X/y/splits
+    nằm trong các file .npy và pickle chỉ mang đường dẫn.
+    """
+
+    strategy = 'full'
+
+    def __init__(self, X: pd.DataFrame, y: pd.Series, splits: List[Tuple[np.ndarray, np.ndarray]],
+                 metric_type: str = 'mape', tree_method: str = 'hist', n_threads: int = -1):
+        self.X = X
+        self.y = y
+        self.splits = splits
+        self.metric_type = metric_type
+        self.tree_method = tree_method
+        self.n_threads = n_threads
+        self.data_dir = None
+        self._cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None  # DMatrix không pickle được
+        if self.data_dir is not None:
+            # Worker mở lại từ file (memmap) - không pickle ma trận training
+            for key in self._shared_keys():
+                state[key] = None
+        return state
+
+    def _shared_keys(self) -> Tuple[str, ...]:
+        return ('X', 'y', 'splits')
+
+    def share_data(self, data_dir: str):
+        """Ghi X, y và fold splits thành .npy trong data_dir (một lần) cho worker processes"""
+        os.makedirs(data_dir, exist_ok=True)
+        X = self.X.to_numpy() if isinstance(self.X, pd.DataFrame) else np.asarray(self.X)
+        np.save(os.path.join(data_dir, 'X.npy'), X)
+        np.save(os.path.join(data_dir, 'y.npy'), np.asarray(self.y))
+        for k, (train_idx, valid_idx) in enumerate(self.splits):
+            np.save(os.path.join(data_dir, f'split_{k}_train.npy'), np.asarray(train_idx))
+            np.save(os.path.join(data_dir, f'split_{k}_valid.npy'), np.asarray(valid_idx))
+        self.n_splits = len(self.splits)
+        self.data_dir = data_dir
+
+    def _load_shared(self):
+        """Mở lại dữ liệu đã share_data (read-only memmap) trong worker process"""
+        if self.X is not None or self.data_dir is None:
+            return
+
+        def load(name):
+            return np.load(os.path.join(self.data_dir, f'{name}.npy'), mmap_mode='r')
+
+        self.X, self.y = load('X'), load('y')
+        self.splits = [(load(f'split_{k}_train'), load(f'split_{k}_valid')) for k in range(self.n_splits)]
+
+    @property
+    def cache(self) -> FoldDataCache:
+        self._load_shared()
+        if self._cache is None:
+            self._cache = FoldDataCache(self.X, self.y, self.splits, self.tree_method, self.n_threads)
+        return self._cache
+
+    def suggest_params(self, trial) -> dict:
+        """Params cho xgb.train (tên native), cùng search space với XGBRegressor trước đây"""
+        return {
+            'objective': 'reg:squarederror',
+            'seed': 42,
+            'nthread': self.n_threads,  # -1 = tất cả cores; giới hạn khi chạy nhiều workers
+            'verbosity': 0,
+            
+            # CPU optimizations
+            'tree_method': self.tree_method,  # Auto-detected: gpu_hist for GPU, hist for CPU
+            'max_bin': MAX_BIN,
+            
+            # Tree structure - quan trọng nhất cho time series
+            'max_depth': trial.suggest_int('max_depth', 3, 10),
+            'min_child_weight': trial.suggest_int('min_child_weight', 1, 10),
+            'gamma': trial.suggest_float('gamma', 0.0, 0.5, step=0.1),
+            
+            # Sampling - chống overfitting
+            'subsample': trial.suggest_float('subsample', 0.6, 1.0, step=0.1),
+            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.6, 1.0, step=0.1),
+            'colsample_bylevel': trial.suggest_float('colsample_bylevel', 0.6, 1.0, step=0.1),
+            
+            # Regularization
+            'alpha': trial.suggest_float('reg_alpha', 1e-8, 10.0, log=True),
+            'lambda': trial.suggest_float('reg_lambda', 1e-8, 10.0, log=True),
+            
+            # Learning - số cây sẽ được điều chỉnh bởi early stopping
+            'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.3, log=True),
+        }
+
+    def __call__(self, trial) -> float:
+        params = self.suggest_params(trial)
+        self._load_shared()
+        n_splits = len(self.splits)
+
+        # Pruning: report mỗi boosting round (callback) và CV score sau mỗi fold
+        cv_scores = []
+        for fold_idx, (dtrain, dvalid, y_valid) in enumerate(self.cache):
+            booster = xgb.train(
+                params, dtrain,
+                num_boost_round=MAX_BOOST_ROUNDS,  # Cao, sẽ early stop
+                evals=[(dvalid, 'validation_0')],
+                early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                callbacks=[XGBoostPruningCallback(trial, fold_idx)],
+                verbose_eval=False
+            )
+            # Giống XGBRegressor.predict: dùng các cây đến best_iteration
+            y_pred = booster.predict(dvalid, iteration_range=(0, booster.best_iteration + 1))
+            cv_scores.append(score_predictions(y_valid, y_pred, self.metric_type))
+
+            trial.report(float(np.mean(cv_scores)), step=fold_step(n_splits, fold_idx))
+            if trial.should_prune():
+                raise optuna.TrialPruned(f"Pruned sau fold {fold_idx}")
+
+        return np.mean(cv_scores)
+
+
+def fidelity_row_subsets(frame: pd.DataFrame, fractions=FIDELITY_FRACTIONS,
+                         seed: int = 42) -> List[np.ndarray]:
+    """
+    Vị trí dòng (theo thứ tự của frame) cho từng rung fidelity, lồng nhau.
+
+    Có series (chi_nhanh, ma_hang): lấy fraction số series trong mỗi tầng
+    chi nhánh × ABC; không có: cửa sổ ngày gần nhất chứa fraction số dòng.
+    """
+    n_rows = len(frame)
+    if 'ma_hang' in frame.columns:
+        keys = [c for c in ('chi_nhanh', 'ma_hang') if c in frame.columns]
+        strata_cols = [c for c in FIDELITY_STRATA if c in frame.columns and c not in keys]
+        series_id = frame.groupby(keys, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        first = pd.DataFrame({'series': series_id}).drop_duplicates('series').index.to_numpy()
+        series = frame.iloc[first][strata_cols].copy() if strata_cols else pd.DataFrame(index=frame.index[first])
+        series['_series'] = series_id[first]
+        series['_stratum'] = series.groupby(strata_cols, sort=False, dropna=False, observed=True).ngroup() if strata_cols else 0
+        # Hoán vị ngẫu nhiên trong mỗi tầng → rank cố định để các rung lồng nhau
+        series['_order'] = np.random.default_rng(seed).permutation(len(series))
+        series['_rank'] = series.groupby('_stratum')['_order'].rank(method='first')
+        series['_size'] = series.groupby('_stratum')['_order'].transform('size')
+        subsets = []
+        for fraction in fractions:
+            chosen = series.loc[series['_rank'] <= np.ceil(series['_size'] * fraction), '_series'].to_numpy()
+            subsets.append(np.flatnonzero(np.isin(series_id, chosen)))
+        return subsets
+
+    if 'ngay' in frame.columns:
+        dates = frame['ngay'].to_numpy()
+        order = np.sort(dates)
+        return [np.flatnonzero(dates >= order[max(0, int(n_rows * (1 - fraction)))]) for fraction in fractions]
+    return [np.arange(n_rows - int(np.ceil(n_rows * fraction)), n_rows) for fraction in fractions]
+
+
+class MultiFidelityCVObjective(XGBoostCVObjective):
+    """
+    Successive halving trên kích thước dữ liệu: CV trên rung dữ liệu nhỏ trước,
+    report tại step = fraction × FIDELITY_MAX_RESOURCE để pruner (successive halving) quyết định
+    config nào được lên rung tiếp theo.
+    """
+
+    strategy = 'hyperband'
+
+    def __init__(self, X: pd.DataFrame, y: pd.Series, splits: List[Tuple[np.ndarray, np.ndarray]],
+                 row_subsets: List[np.ndarray], metric_type: str = 'mape', tree_method: str = 'hist',
+                 n_threads: int = -1, fractions=FIDELITY_FRACTIONS):
+        super().__init__(X, y, splits, metric_type, tree_method, n_threads)
+        self.row_subsets = row_subsets
+        self.fractions = fractions
+        self._rung_caches = {}
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_rung_caches'] = {}
+        return state
+
+    def _shared_keys(self) -> Tuple[str, ...]:
+        return super()._shared_keys() + ('row_subsets',)
+
+    def share_data(self, data_dir: str):
+        super().share_data(data_dir)
+        for rung, rows in enumerate(self.row_subsets):
+            np.save(os.path.join(data_dir, f'rung_{rung}.npy'), np.asarray(rows))
+
+    def _load_shared(self):
+        if self.X is not None or self.data_dir is None:
+            return
+        super()._load_shared()
+        self.row_subsets = [np.load(os.path.join(self.data_dir, f'rung_{rung}.npy'), mmap_mode='r')
+                            for rung in range(len(self.fractions))]
+
+    def rung_cache(self, rung: int) -> FoldDataCache:
+        if self.fractions[rung] >= 1.0:
+            return self.cache
+        self._load_shared()
+        if rung not in self._rung_caches:
+            mask = np.zeros(len(self.X), dtype=bool)
+            mask[self.row_subsets[rung]] = True
+            splits = [(train_idx[mask[train_idx]], valid_idx[mask[valid_idx]])
+                      for train_idx, valid_idx in self.splits]
+            splits = [(t, v) for t, v in splits if len(t) > 0 and len(v) > 0]
+            self._rung_caches[rung] = FoldDataCache(self.X, self.y, splits, self.tree_method, self.n_threads)
+        return self._rung_caches[rung]
+
+    def _cv_score(self, params: dict, cache: FoldDataCache) -> float:
+        scores = []
+        for dtrain, dvalid, y_valid in cache:
+            booster = xgb.train(
+                params, dtrain,
+                num_boost_round=MAX_BOOST_ROUNDS,
+                evals=[(dvalid, 'validation_0')],
+                early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                verbose_eval=False
+            )
+            y_pred = booster.predict(dvalid, iteration_range=(0, booster.best_iteration + 1))
+            scores.append(score_predictions(y_valid, y_pred, self.metric_type))
+        return float(np.nanmean(scores)) if scores else np.nan
+
+    def __call__(self, trial) -> float:
+        params = self.suggest_params(trial)
+        cpu_start = time.process_time()
+        score = np.nan
+        for rung, fraction in enumerate(self.fractions):
+            cache = self.rung_cache(rung)
+            if len(cache) == 0:
+                continue
+            rung_start = time.process_time()
+            score = self._cv_score(params, cache)
+            trial.set_user_attr('fidelity', fraction)
+            trial.set_user_attr('cpu_seconds', time.process_time() - cpu_start)
+            if fraction >= 1.0:
+                trial.set_user_attr('cpu_seconds_full', time.process_time() - rung_start)
+                break
+            trial.report(score, step=max(1, int(round(fraction * FIDELITY_MAX_RESOURCE))))
+            if trial.should_prune():
+                raise optuna.TrialPruned(f"Pruned tại rung {rung} ({fraction:.0%} dữ liệu)")
+        return score
+
+
+# ----------------------------------------------------------------------
+# Warm start
+# ----------------------------------------------------------------------
+def study_path(model_dir: str, target_col: str) -> str:
+    return os.path.join(model_dir, f'{target_col}_optuna_study.pkl')
+
+
+def load_previous_study(model_dir: str, target_col: str):
+    """Study đã lưu của lần train trước (None nếu chưa có hoặc không đọc được)"""
+    path = study_path(model_dir, target_col)
+    if not os.path.exists(path):
+        return None
+    try:
+        return joblib.load(path)
+    except Exception as e:
+        logger.warning(f"⚠️ Không đọc được study cũ {path}: {e}")
+        return None
+
+
+def top_trial_params(study, k: int = WARM_START_TOP_K) -> List[Dict]:
+    """Params của k trials hoàn thành tốt nhất (value nhỏ nhất)"""
+    completed = [t for t in study.trials
+                 if t.state == optuna.trial.TrialState.COMPLETE and t.value is not None
+                 and np.isfinite(t.value)]
+    completed.sort(key=lambda t: t.value)
+    return [dict(t.params) for t in completed[:k]]
+
+
+def target_profile(y) -> Dict:
+    """Phân phối target (bins theo decile) để đo drift ở lần train sau"""
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.unique(np.quantile(y, np.linspace(0, 1, PROFILE_BINS + 1)[1:-1]))
+    counts = np.bincount(np.searchsorted(edges, y, side='right'), minlength=len(edges) + 1)
+    return {
+        'edges': edges.tolist(),
+        'fractions': (counts / max(len(y), 1)).tolist(),
+        'n_rows': int(len(y)),
+        'mean': float(y.mean()) if len(y) else 0.0,
+    }
+
+
+def population_stability_index(profile: Dict, y) -> float:
+    """PSI giữa phân phối target lúc train trước (profile) và target hiện tại"""
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.asarray(profile['edges'])
+    expected = np.asarray(profile['fractions'])
+    actual = np.bincount(np.searchsorted(edges, y, side='right'), minlength=len(expected)) / max(len(y), 1)
+    expected = np.clip(expected, 1e-4, None)
+    actual = np.clip(actual, 1e-4, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def warm_start_plan(previous_study, y, metric_type: str, n_trials: int) -> Tuple[List[Dict], int]:
+    """
+    Params cần enqueue và số trials cho study mới.
+
+    Returns:
+        (params top-k của study trước, n_trials sau khi điều chỉnh theo drift)
+    """
+    if previous_study is None:
+        logger.info("🌱 Warm start: chưa có study trước - tuning từ đầu")
+        return [], n_trials
+    attrs = previous_study.user_attrs
+    if attrs.get('metric_type', metric_type) != metric_type:
+        logger.info(f"🌱 Warm start: study trước dùng metric '{attrs['metric_type']}' - tuning từ đầu")
+        return [], n_trials
+
+    seeds = top_trial_params(previous_study)
+    profile = attrs.get('target_profile')
+    if profile is None:
+        logger.info(f"🌱 Warm start: enqueue {len(seeds)} params, không có target profile - giữ {n_trials} trials")
+        return seeds, n_trials
+
+    drift = population_stability_index(profile, y)
+    if drift < WARM_START_DRIFT_THRESHOLD:
+        reduced = max(len(seeds) + 1, int(np.ceil(n_trials * WARM_START_TRIAL_FRACTION)))
+        n_trials = min(n_trials, reduced)
+        logger.info(f"🌱 Warm start: PSI={drift:.4f} < {WARM_START_DRIFT_THRESHOLD} → "
+                    f"enqueue {len(seeds)} params, giảm còn {n_trials} trials")
+    else:
+        logger.info(f"🌱 Warm start: PSI={drift:.4f} (drift lớn) → enqueue {len(seeds)} params, giữ {n_trials} trials")
+    return seeds, n_trials
+
+
+# ----------------------------------------------------------------------
+# Parallel study
+# ----------------------------------------------------------------------
+def threads_per_worker(n_workers: int) -> int:
+    """Số thread XGBoost cho mỗi worker để workers × threads ≤ số CPU cores"""
+    return max(1, (os.cpu_count() or 1) // max(n_workers, 1))
+
+
+def journal_storage(path: str):
+    """Optuna journal storage trên file local (nhiều process cùng ghi an toàn)"""
+    try:
+        from optuna.storages.journal import JournalFileBackend
+        backend = JournalFileBackend(path)
+    except ImportError:  # optuna < 4.0
+        backend = optuna.storages.JournalFileStorage(path)
+    return optuna.storages.JournalStorage(backend)
+
+
+class _TrialBudget:
+    """
+    Bọc objective: trial.number do storage cấp tuần tự (nguyên tử giữa các process),
+    trial có number >= n_trials là trial vượt budget → dừng worker, không chạy objective.
+    """
+
+    def __init__(self, objective, n_trials: int):
+        self.objective = objective
+        self.n_trials = n_trials
+
+    def __call__(self, trial) -> float:
+        if trial.number >= self.n_trials:
+            trial.study.stop()
+            raise optuna.TrialPruned("Vượt budget n_trials")
+        return self.objective(trial)
+
+
+def _study_worker(study_name: str, storage_path: str, objective, n_trials: int,
+                  seed: int, timeout: Optional[int], n_threads: int):
+    """Worker process: load study từ storage chung và chạy trials đến khi đủ n_trials"""
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = optuna.load_study(study_name=study_name, storage=journal_storage(storage_path),
+                              sampler=TPESampler(seed=seed), pruner=create_pruner(objective.strategy))
+    study.optimize(_TrialBudget(objective, n_trials), timeout=timeout)
+
+
+def run_parallel_study(study_name: str, storage_path: str, objective: XGBoostCVObjective,
+                       n_trials: int, n_workers: int, timeout: Optional[int] = None,
+                       seed: int = 42, enqueue_params: Optional[List[Dict]] = None):
+    """
+    Chạy study với n_workers processes trên journal storage chung.
+
+    enqueue_params (warm start) được enqueue trước khi workers bắt đầu. Dữ liệu training
+    được ghi một lần vào {storage_path}.data/ (xoá khi xong), workers đọc bằng memmap.
+
+    Returns:
+        Study (bản copy in-memory, pickle được bằng joblib như study tuần tự)
+    """
+    if os.path.exists(storage_path):
+        os.remove(storage_path)
+    storage = journal_storage(storage_path)
+    study = optuna.create_study(study_name=study_name, storage=storage, direction='minimize')
+    for params in enqueue_params or []:
+        study.enqueue_trial(params, skip_if_exists=True)
+
+    n_threads = threads_per_worker(n_workers)
+    objective.n_threads = n_threads
+    data_dir = f'{storage_path}.data'
+    objective.share_data(data_dir)
+    logger.info(f"⚙️  Parallel tuning: {n_workers} workers × {n_threads} threads, storage: {storage_path}")
+
+    # spawn thay vì fork: fork sau khi OpenMP đã khởi tạo (XGBoost) có thể bị treo
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=_study_worker,
+                        args=(study_name, storage_path, objective, n_trials, seed + i, timeout, n_threads))
+        for i in range(n_workers)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        objective.data_dir = None
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        logger.warning(f"⚠️ {len(failed)} tuning workers kết thúc lỗi (exit codes: {failed})")
+
+    # Bản copy in-memory chỉ gồm các trial trong budget (bỏ trial vượt budget của _TrialBudget)
+    memory_study = optuna.create_study(study_name=study_name, storage=optuna.storages.InMemoryStorage(),
+                                       direction='minimize')
+    memory_study.add_trials([t for t in study.get_trials(deepcopy=False) if t.number < n_trials])
+    return memory_study
@@ -11,24 +11,14 @@ import logging
 import joblib
 import os
 import json
+import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import xgboost as xgb
 from sklearn.model_selection import TimeSeriesSplit, RandomizedSearchCV
 from sklearn.metrics import mean_absolute_error, mean_squared_error, mean_absolute_percentage_error
 
-def median_absolute_percentage_error(y_true, y_pred):
-    """MdAPE - Median Absolute Percentage Error, ít nhạy cảm với outliers hơn MAPE
-    
-    Filter out zeros để tránh division by zero.
-    """
-    y_true = np.asarray(y_true)
-    y_pred = np.asarray(y_pred)
-    mask = y_true > 0
-    if mask.sum() == 0:
-        return np.nan
-    return np.median(np.abs((y_true[mask] - y_pred[mask]) / y_true[mask])) * 100
-
 # Optuna cho Bayesian Optimization
 try:
     import optuna
@@ -38,12 +28,54 @@ except ImportError:
     OPTUNA_AVAILABLE = False
     warnings.warn("Optuna not installed. Tuning will use RandomizedSearchCV instead.")
 
-from db_connectors import PostgreSQLConnector, ClickHouseConnector
+from db_connectors import (
+    PostgreSQLConnector, ClickHouseConnector, key_set_table, product_set_table, CLICKHOUSE_STREAM_BLOCKS
+)
 from email_notifier import EmailNotifier, get_notifier
+from encoders import CategoricalEncoders, ENCODERS_FILENAME, ENCODED_COLUMNS
+from feature_kernels import grouped_rolling, grouped_ema
+from feature_store import FeatureStore, PYARROW_AVAILABLE
+from snapshot_cache import SnapshotCache, snapshot_enabled, watermark_query
+from dtype_policy import apply_dtype_policy, categorize_keys, frame_memory_mb
+from external_memory import (
+    train_external_memory, date_chunks, split_chunks, DEFAULT_PARAMS as STREAMING_DEFAULT_PARAMS,
+    EXTERNAL_MEMORY_CHUNK_DAYS, STREAMING_LOOKBACK_DAYS, MIN_FIRST_CHUNK_DAYS
+)
+from tuning import (
+    XGBoostCVObjective, MultiFidelityCVObjective, create_pruner, fidelity_row_subsets, fidelity_savings,
+    log_study_summary, median_absolute_percentage_error, TUNING_STRATEGIES,
+    run_parallel_study, load_previous_study, study_path, target_profile, warm_start_plan, top_trial_params,
+    MAX_BOOST_ROUNDS, EARLY_STOPPING_ROUNDS, MAX_BIN
+)
+from sharding import (
+    ShardedModel, plan_shards, run_shards_parallel, segment_labels, SHARD_COLUMNS
+)
+from incremental import (
+    incremental_update, INCREMENTAL_MAX_NEW_DAYS, INCREMENTAL_REPLAY_DAYS, FEATURE_LOOKBACK_DAYS
+)
+from purchase_order import (
+    rank_products, format_purchase_orders, product_order_quantities, branch_order_quantities,
+    excel_order_rows, write_order_workbook, EXCEL_SUMMARY_SHEET
+)
+from forecast_engine import (
+    BatchRecursiveForecaster, DirectMultiHorizonForecaster, build_direct_training_frame,
+    DIRECT_TARGET_COL, FORECAST_MODES
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cột không dùng làm feature (keys, ngày, target/metrics gốc)
+NON_FEATURE_COLUMNS = frozenset({'ngay', 'chi_nhanh', 'ma_hang', 'nhom_hang_cap_1', 'nhom_hang_cap_2',
+                                 'daily_quantity', 'daily_revenue', 'daily_profit', 'transaction_count'})
+# Giá trị fill NA cho metadata sản phẩm khi load dữ liệu training
+SALES_FILL_VALUES = {'nhom_hang_cap_1': 'Unknown', 'nhom_hang_cap_2': 'Unknown',
+                     'thuong_hieu': 'Unknown', 'abc_class': 'C'}
+# Số thread chạy song song các query enrichment trong save_forecasts (mỗi thread checkout một connection)
+ENRICHMENT_WORKERS = int(os.getenv('ENRICHMENT_WORKERS', '4'))
+# Số ngày gốc gần nhất dùng để tạo frame train direct multi-horizon (0 = toàn bộ lịch sử)
+DIRECT_TRAIN_ORIGIN_DAYS = int(os.getenv('DIRECT_TRAIN_ORIGIN_DAYS', '180'))
+
 # ============================================================================
 # GPU SUPPORT HELPER FUNCTIONS
 # ============================================================================
@@ -101,6 +133,8 @@ class SalesForecaster:
     def __init__(self, model_dir: str = '/app/models', enable_email: bool = True):
         self.model_dir = model_dir
         os.makedirs(model_dir, exist_ok=True)
+        self.feature_store_dir = os.getenv('FEATURE_STORE_DIR', os.path.join(model_dir, 'feature_store'))
+        self.snapshot_dir = os.getenv('SNAPSHOT_CACHE_DIR', os.path.join(model_dir, 'snapshots'))
         
         self.pg = PostgreSQLConnector(
             host=os.getenv('POSTGRES_HOST'),
@@ -130,6 +164,7 @@ class SalesForecaster:
             except Exception as e:
                 logger.warning(f"⚠️ Không thể khởi tạo email notifier: {e}")
         self.feature_cols = []  # Sẽ được cập nhật động sau khi create_features
+        self.encoders = None  # CategoricalEncoders - fit lúc training, load khi predict
     
     def calculate_dynamic_percentiles(self, df: pd.DataFrame, columns: List[str] = ['daily_quantity'], 
                                       percentiles: List[float] = [0.95, 0.99]) -> Dict:
@@ -212,7 +247,79 @@ class SalesForecaster:
         
         return df, stats
     
-    def load_historical_data(self, days: int = 0, apply_winsorize: bool = True) -> pd.DataFrame:
+    @staticmethod
+    def _date_filter(days: int = 0, date_range: Optional[Tuple[date, date]] = None) -> str:
+        """Điều kiện ngày cho query training (date_range ưu tiên hơn days)"""
+        if date_range is not None:
+            start, end = date_range
+            return f"AND f.transaction_date >= '{start}' AND f.transaction_date < '{end}'"
+        return f"AND f.transaction_date >= today() - {days}" if days > 0 else ""
+
+    def _read_sales_blocks(self, query: str, valid_sales_only: bool = True) -> pd.DataFrame:
+        """
+        Đọc query doanh số: mặc định một lần bằng query() columnar (numpy theo cột, không tuple
+        từng dòng); CLICKHOUSE_STREAM_BLOCKS=true → theo block dòng (ClickHouseConnector.iter_blocks),
+        peak memory ≈ kết quả đã lọc + một block. Mỗi block được chuẩn hoá (ngay → datetime,
+        fill NA metadata) và lọc dòng không có doanh số trước khi ghép.
+
+        Args:
+            valid_sales_only: Chỉ giữ dòng daily_quantity > 0 và daily_revenue > 0
+        """
+        blocks = self.ch.iter_blocks(query) if CLICKHOUSE_STREAM_BLOCKS else [self.ch.query(query)]
+        parts, raw_rows = [], 0
+        for block in blocks:
+            raw_rows += len(block)
+            block['ngay'] = pd.to_datetime(block['ngay'])
+            self._fill_sales_metadata(block)
+            if valid_sales_only and len(block):
+                valid = (pd.to_numeric(block['daily_quantity'], errors='coerce').gt(0)
+                         & pd.to_numeric(block['daily_revenue'], errors='coerce').gt(0))
+                if not valid.all():
+                    block = block[valid.to_numpy()]
+            parts.append(block)
+        if not parts:
+            return pd.DataFrame()
+        df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        del parts
+
+        removed = raw_rows - len(df)
+        logger.info(f"📦 Đã đọc {raw_rows:,} dòng từ ClickHouse{' theo block' if CLICKHOUSE_STREAM_BLOCKS else ''} "
+                    f"→ giữ {len(df):,} dòng")
+        if removed > 0:
+            logger.warning(f"⚠️  Đã loại bỏ {removed:,} records ({removed/raw_rows*100:.1f}%) do không có dữ liệu bán hàng (quantity=0 hoặc NULL)")
+        return df
+
+    @staticmethod
+    def _fill_sales_metadata(df: pd.DataFrame) -> pd.DataFrame:
+        """Fill NA cho category/brand/ABC (tại chỗ, bỏ qua cột không có NA)"""
+        for col, value in SALES_FILL_VALUES.items():
+            if col in df.columns and df[col].hasnans:
+                df[col] = df[col].fillna(value)
+        return df
+
+    def _query_snapshot(self, query: str, days: int, tables: Tuple[str, ...],
+                        use_snapshot: bool = True, run_query=None) -> pd.DataFrame:
+        """
+        Chạy query training nặng qua SnapshotCache: nếu watermark nguồn không đổi
+        thì đọc lại snapshot Arrow thay vì chạy lại JOIN trên ClickHouse.
+        use_snapshot=False (load theo chunk ngày) → query trực tiếp, không ghi snapshot.
+
+        Args:
+            run_query: Hàm query → DataFrame khi cache miss (mặc định self.ch.query)
+        """
+        run_query = run_query or self.ch.query
+        if not use_snapshot or not snapshot_enabled():
+            return run_query(query)
+        try:
+            mark = self.ch.query(watermark_query(tables, days)).iloc[0].to_dict()
+        except Exception as e:
+            logger.warning(f"⚠️ Không lấy được watermark, bỏ qua snapshot cache: {e}")
+            return run_query(query)
+        cache = SnapshotCache(self.snapshot_dir)
+        return cache.load(query, run_query, mark, uses_today=days > 0)
+
+    def load_historical_data(self, days: int = 0, apply_winsorize: bool = True,
+                             date_range: Optional[Tuple[date, date]] = None) -> pd.DataFrame:
         """Load dữ liệu lịch sử từ ClickHouse (fct_regular_sales + JOIN seasonal factor)
         
         Cách 2B: Query từ fct_regular_sales (doanh số không khuyến mại) và JOIN với 
@@ -221,6 +328,7 @@ class SalesForecaster:
         Args:
             days: Số ngày dữ liệu để load. Nếu 0, load toàn bộ dữ liệu.
             apply_winsorize: Nếu True, áp dụng winsorization cho daily_quantity
+            date_range: (start, end) - chỉ load [start, end), thay cho days (streaming training)
         """
         
         # Kiểm tra các bảng cần thiết
@@ -232,7 +340,7 @@ class SalesForecaster:
         WHERE database = 'retail_dw' AND name IN ('fct_regular_sales', 'int_dynamic_seasonal_factor')
         """
         try:
-            check_result = self.ch.query(check_query)
+            check_result = self.ch.cached_query(check_query)
             has_regular = check_result.iloc[0, 0] > 0
             has_seasonal = check_result.iloc[0, 1] > 0
         except:
@@ -245,11 +353,11 @@ class SalesForecaster:
         
         if not has_seasonal:
             logger.warning("⚠️ Bảng int_dynamic_seasonal_factor chưa tồn tại. Chạy fallback không có seasonal.")
-            return self._load_from_regular_sales_no_seasonal(days)
+            return self._load_from_regular_sales_no_seasonal(days, date_range)
         
         # Query từ fct_regular_sales + JOIN int_dynamic_seasonal_factor (Cách 2B)
         # Nếu days=0, load toàn bộ dữ liệu
-        date_filter = f"AND f.transaction_date >= today() - {days}" if days > 0 else ""
+        date_filter = self._date_filter(days, date_range)
         
         query = f"""
         SELECT
@@ -309,24 +417,19 @@ class SalesForecaster:
         """
         
         try:
-            df = self.ch.query(query)
+            # Đọc theo block: fill NA category + lọc dòng không có doanh số trên từng block
+            df = self._query_snapshot(
+                query, days, ('fct_regular_sales', 'dim_product', 'int_dynamic_seasonal_factor'),
+                use_snapshot=date_range is None, run_query=self._read_sales_blocks)
             df['ngay'] = pd.to_datetime(df['ngay'])
-            # Fill NA cho category
-            df['nhom_hang_cap_1'] = df['nhom_hang_cap_1'].fillna('Unknown')
-            df['nhom_hang_cap_2'] = df['nhom_hang_cap_2'].fillna('Unknown')
-            df['thuong_hieu'] = df['thuong_hieu'].fillna('Unknown')
-            df['abc_class'] = df['abc_class'].fillna('C')
+            self._fill_sales_metadata(df)
             
             # VALIDATION: Chỉ giữ lại records có dữ liệu bán thực tế
+            # (snapshot cũ có thể chưa lọc; quantity/revenue NULL hoặc <= 0 → loại)
             original_count = len(df)
-            
-            # Loại bỏ records với quantity <= 0 hoặc NULL
-            df = df[df['daily_quantity'].notna()]
-            df = df[df['daily_quantity'] > 0]
-            
-            # Loại bỏ records với revenue <= 0 (double check)
-            df = df[df['daily_revenue'].notna()]
-            df = df[df['daily_revenue'] > 0]
+            valid = df['daily_quantity'].gt(0) & df['daily_revenue'].gt(0)
+            if not valid.all():
+                df = df[valid]
             
             filtered_count = len(df)
             removed_count = original_count - filtered_count
@@ -403,13 +506,15 @@ class SalesForecaster:
             logger.error(f"❌ Lỗi khi query fct_regular_sales: {e}")
             return self._load_from_daily_sales(days)
     
-    def _load_from_regular_sales_no_seasonal(self, days: int = 0) -> pd.DataFrame:
+    def _load_from_regular_sales_no_seasonal(self, days: int = 0,
+                                             date_range: Optional[Tuple[date, date]] = None) -> pd.DataFrame:
         """Fallback: Load từ fct_regular_sales không có seasonal factors
         
         Args:
             days: Số ngày dữ liệu để load. Nếu 0, load toàn bộ dữ liệu.
+            date_range: (start, end) - chỉ load [start, end)
         """
-        date_filter = f"WHERE f.transaction_date >= today() - {days}" if days > 0 else ""
+        date_filter = self._date_filter(days, date_range).replace('AND', 'WHERE', 1)
         
         query = f"""
         SELECT
@@ -451,12 +556,11 @@ class SalesForecaster:
         """
         
         try:
-            df = self.ch.query(query)
+            df = self._query_snapshot(query, days, ('fct_regular_sales', 'dim_product'),
+                                      use_snapshot=date_range is None,
+                                      run_query=lambda q: self._read_sales_blocks(q, valid_sales_only=False))
             df['ngay'] = pd.to_datetime(df['ngay'])
-            df['nhom_hang_cap_1'] = df['nhom_hang_cap_1'].fillna('Unknown')
-            df['nhom_hang_cap_2'] = df['nhom_hang_cap_2'].fillna('Unknown')
-            df['thuong_hieu'] = df['thuong_hieu'].fillna('Unknown')
-            df['abc_class'] = df['abc_class'].fillna('C')
+            self._fill_sales_metadata(df)
             
             logger.info(f"✅ Đã load {len(df):,} records từ fct_regular_sales (no seasonal - fallback)")
             
@@ -484,7 +588,7 @@ class SalesForecaster:
         WHERE database = 'retail_dw' AND name = 'fct_daily_sales'
         """
         try:
-            table_exists = self.ch.query(check_query).iloc[0, 0] > 0
+            table_exists = self.ch.cached_query(check_query).iloc[0, 0] > 0
         except:
             table_exists = False
             
@@ -570,7 +674,8 @@ class SalesForecaster:
                 'is_peak_day', 'peak_level', 'seasonal_factor', 'revenue_factor', 'quantity_factor', 'peak_reason'
             ])
     
-    def create_features(self, df: pd.DataFrame, prediction_mode: bool = False) -> pd.DataFrame:
+    def create_features(self, df: pd.DataFrame, prediction_mode: bool = False,
+                        fit_encoders: bool = False) -> pd.DataFrame:
         """
         Tạo features cho model.
         
@@ -588,22 +693,26 @@ class SalesForecaster:
             df: DataFrame với dữ liệu
             prediction_mode: Nếu True, chỉ tạo lag features >= 7 ngày
                            để tránh sử dụng thông tin tuần hiện tại chưa dự báo
+            fit_encoders: Nếu True, fit lại categorical encoders trên df (chỉ dùng khi training)
         """
-        df = df.copy()
+        # Sort theo series (cũng là bản copy duy nhất của df đầu vào, không df.copy() riêng)
+        df = df.sort_values(['chi_nhanh', 'ma_hang', 'ngay'],
+                            key=lambda col: pd.to_datetime(col) if col.name == 'ngay' else col)
         
         # Đảm bảo ngay là datetime
         df['ngay'] = pd.to_datetime(df['ngay'])
         
         # Tạo time-based features từ ngay (quan trọng cho predict ngày tương lai)
-        df['day_of_week'] = df['ngay'].dt.dayofweek + 1  # 1=Monday, 7=Sunday
-        df['day_of_month'] = df['ngay'].dt.day
-        df['month'] = df['ngay'].dt.month
-        df['quarter'] = df['ngay'].dt.quarter  # EXTENDED: Quarter cho yearly seasonality
-        df['day_of_year'] = df['ngay'].dt.dayofyear  # EXTENDED: Day of year
-        df['week_of_year'] = df['ngay'].dt.isocalendar().week.astype(int)
-        df['is_weekend'] = (df['day_of_week'] >= 6).astype(int)
-        df['is_month_start'] = (df['day_of_month'] == 1).astype(int)
-        df['is_month_end'] = (df['day_of_month'] == df['ngay'].dt.days_in_month).astype(int)
+        # Calendar/cờ tạo thẳng ở int8/int16 (dtype_policy.py)
+        df['day_of_week'] = (df['ngay'].dt.dayofweek + 1).astype(np.int8)  # 1=Monday, 7=Sunday
+        df['day_of_month'] = df['ngay'].dt.day.astype(np.int8)
+        df['month'] = df['ngay'].dt.month.astype(np.int8)
+        df['quarter'] = df['ngay'].dt.quarter.astype(np.int8)  # EXTENDED: Quarter cho yearly seasonality
+        df['day_of_year'] = df['ngay'].dt.dayofyear.astype(np.int16)  # EXTENDED: Day of year
+        df['week_of_year'] = df['ngay'].dt.isocalendar().week.astype(np.int8)
+        df['is_weekend'] = (df['day_of_week'] >= 6).astype(np.int8)
+        df['is_month_start'] = (df['day_of_month'] == 1).astype(np.int8)
+        df['is_month_end'] = (df['day_of_month'] == df['ngay'].dt.days_in_month).astype(np.int8)
         
         # Holiday detection đơn giản (backup nếu không có từ ClickHouse)
         if 'is_holiday' not in df.columns:
@@ -612,7 +721,7 @@ class SalesForecaster:
                 ((df['month'] == 4) & (df['day_of_month'] == 30)) |  # 30/4
                 ((df['month'] == 5) & (df['day_of_month'] == 1)) |   # 1/5
                 ((df['month'] == 9) & (df['day_of_month'] == 2))     # 2/9
-            ).astype(int)
+            ).astype(np.int8)
         
         # Log thông tin về seasonal factors
         if 'seasonal_factor' in df.columns:
@@ -622,8 +731,7 @@ class SalesForecaster:
         else:
             logger.warning("⚠️ No seasonal_factor found - using static seasonality only")
         
-        # Lag features - điều chỉnh dựa trên số ngày dữ liệu có sẵn
-        df = df.sort_values(['chi_nhanh', 'ma_hang', 'ngay'])
+        # Lag features - điều chỉnh dựa trên số ngày dữ liệu có sẵn (df đã sort ở trên)
         n_unique_days = df['ngay'].nunique()
         
         # EXTENDED: Thêm lag 3 và 21 ngày cho model training sâu hơn
@@ -644,64 +752,54 @@ class SalesForecaster:
         else:
             logger.info(f"📊 Training mode - Lag features: {available_lags} (dữ liệu có {n_unique_days} ngày)")
         
+        series = df.groupby(['chi_nhanh', 'ma_hang'], sort=False, observed=True)
         for lag in available_lags:
-            df[f'lag_{lag}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'].shift(lag)
-            df[f'lag_{lag}_revenue'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_revenue'].shift(lag)
+            df[f'lag_{lag}_quantity'] = series['daily_quantity'].shift(lag).astype(np.float32)
+            df[f'lag_{lag}_revenue'] = series['daily_revenue'].shift(lag).astype(np.float32)
         
         # Rolling statistics - giảm window nếu dữ liệu ít
         available_windows = [w for w in [7, 14, 30] if w <= n_unique_days]
         if not available_windows:
             available_windows = [min(3, n_unique_days)]  # Mặc định 3 ngày nếu ít dữ liệu
         
+        # Grouped window kernels (feature_kernels.py): 1 pass native cho mỗi statistic,
+        # không gọi lambda cho từng series. df đã sort theo (chi_nhanh, ma_hang, ngay)
+        group_ids = df.groupby(['chi_nhanh', 'ma_hang'], sort=False, dropna=False).ngroup().to_numpy()
+        quantity = df['daily_quantity'].to_numpy(dtype=np.float64)
+        rolling_stats = grouped_rolling(quantity, group_ids, available_windows)
         for window in available_windows:
-            df[f'rolling_mean_{window}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'] \
-                .transform(lambda x: x.rolling(window, min_periods=1).mean())
-            df[f'rolling_std_{window}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'] \
-                .transform(lambda x: x.rolling(window, min_periods=1).std())
+            df[f'rolling_mean_{window}_quantity'] = rolling_stats[f'mean_{window}'].astype(np.float32)
+            df[f'rolling_std_{window}_quantity'] = rolling_stats[f'std_{window}'].astype(np.float32)
             # EXTENDED: Min/Max/Range cho volatility analysis
-            df[f'rolling_min_{window}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'] \
-                .transform(lambda x: x.rolling(window, min_periods=1).min())
-            df[f'rolling_max_{window}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'] \
-                .transform(lambda x: x.rolling(window, min_periods=1).max())
-            df[f'rolling_range_{window}_quantity'] = df[f'rolling_max_{window}_quantity'] - df[f'rolling_min_{window}_quantity']
+            df[f'rolling_min_{window}_quantity'] = rolling_stats[f'min_{window}'].astype(np.float32)
+            df[f'rolling_max_{window}_quantity'] = rolling_stats[f'max_{window}'].astype(np.float32)
+            df[f'rolling_range_{window}_quantity'] = \
+                (rolling_stats[f'max_{window}'] - rolling_stats[f'min_{window}']).astype(np.float32)
+        del rolling_stats
         
         # EXTENDED: Exponential Moving Average (EMA) - phản ứng nhanh hơn SMA
+        ema_values = grouped_ema(quantity, group_ids, available_windows)
         for span in available_windows:
-            df[f'ema_{span}_quantity'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'] \
-                .transform(lambda x: x.ewm(span=span, adjust=False).mean())
+            df[f'ema_{span}_quantity'] = ema_values[span].astype(np.float32)
+        del ema_values
         
         # EXTENDED: Price features
         df['avg_price'] = df['daily_revenue'] / (df['daily_quantity'] + 1e-8)
-        df['price_change'] = df.groupby(['chi_nhanh', 'ma_hang'])['avg_price'].pct_change().fillna(0)
-        df['price_change'] = df['price_change'].replace([np.inf, -np.inf], 0)
+        df['price_change'] = df.groupby(['chi_nhanh', 'ma_hang'], sort=False, observed=True)['avg_price'].pct_change()
         
-        # Growth rate - handle inf values
-        df['quantity_growth'] = df.groupby(['chi_nhanh', 'ma_hang'])['daily_quantity'].pct_change()
-        # Replace inf with NaN and fill with 0
-        df['quantity_growth'] = df['quantity_growth'].replace([np.inf, -np.inf], np.nan).fillna(0)
+        # Growth rate - inf/NaN được làm sạch cùng các cột khác ở cuối
+        df['quantity_growth'] = series['daily_quantity'].pct_change()
         
         # Encoding cho categorical - đảm bảo kiểu int
-        df['branch_encoded'] = pd.Categorical(df['chi_nhanh']).codes.astype(int)
-        df['category1_encoded'] = pd.Categorical(df['nhom_hang_cap_1']).codes.astype(int)
-        df['category2_encoded'] = pd.Categorical(df['nhom_hang_cap_2']).codes.astype(int)
-        
-        # Encode thêm brand và abc_class nếu có
-        if 'thuong_hieu' in df.columns:
-            df['brand_encoded'] = pd.Categorical(df['thuong_hieu'].fillna('Unknown')).codes.astype(int)
-            df.drop(columns=['thuong_hieu'], inplace=True)  # Xoá cột gốc
-        if 'abc_class' in df.columns:
-            df['abc_encoded'] = pd.Categorical(df['abc_class'].fillna('C')).codes.astype(int)
-            df.drop(columns=['abc_class'], inplace=True)  # Xoá cột gốc
+        df = self.encode_categoricals(df, fit=fit_encoders)
         
         # Xoá peak_reason (string) nếu có - seasonal factor đã đủ thông tin
         if 'peak_reason' in df.columns:
             df.drop(columns=['peak_reason'], inplace=True)
         
-        # Clean up any remaining inf or NaN in numeric columns
-        numeric_cols = df.select_dtypes(include=[np.number]).columns
-        for col in numeric_cols:
-            df[col] = df[col].replace([np.inf, -np.inf], np.nan)
-            df[col] = df[col].fillna(0)
+        # Dtype policy + làm sạch inf/NaN → 0 trong một pass trên block float32
+        # (target/metrics gốc giữ float64)
+        df = apply_dtype_policy(df)
         
         # Log các cột object còn lại (debug)
         object_cols = df.select_dtypes(include=['object']).columns.tolist()
@@ -710,8 +808,97 @@ class SalesForecaster:
         
         return df
     
+    def load_features_from_store(self, days: int = 0, force_rebuild: bool = False,
+                                 fit_encoders: bool = False) -> pd.DataFrame:
+        """
+        Load training features từ feature store (Parquet, partition theo ngày).
+        
+        Lần đầu (hoặc force_rebuild): load toàn bộ lịch sử và materialize create_features.
+        Các lần sau: chỉ query dữ liệu từ partition cuối cùng trong store, tính lại
+        các partition đó (kèm 30 dòng lookback mỗi series cho lag/rolling) rồi scan store.
+        
+        Args:
+            days: Số ngày features gần nhất cần load (0 = toàn bộ)
+            force_rebuild: Buộc tính lại toàn bộ store
+            fit_encoders: Fit lại CategoricalEncoders trên dữ liệu load (chỉ full training);
+                          False = dùng categorical_encoders.pkl đã lưu, giữ nguyên codes
+                          mà model hiện tại đã học (incremental update)
+        
+        Returns:
+            DataFrame giống output của create_features
+        """
+        store = FeatureStore(self.feature_store_dir)
+        
+        if force_rebuild or not store.exists():
+            logger.info("🏗️  Feature store: rebuild toàn bộ lịch sử...")
+            raw_df = self.load_historical_data(days=0)
+            if raw_df.empty:
+                return raw_df
+            cap = getattr(self, '_winsorization_stats', {}).get('cap_value')
+            store.rebuild(raw_df, self.create_features, winsorization_cap=cap)
+        else:
+            # Partition cuối có thể chưa đủ dữ liệu trong ngày → tính lại từ partition cuối
+            start_date = store.last_date
+            load_days = max((date.today() - start_date).days, 0)
+            logger.info(f"🔄 Feature store: cập nhật partitions từ {start_date} ({load_days} ngày)")
+            # date_range thay cho days: chạy lại trong ngày (load_days = 0) không query toàn bộ lịch sử
+            raw_df = self.load_historical_data(apply_winsorize=False,
+                                               date_range=(start_date, date.today() + timedelta(days=1)))
+            if not raw_df.empty:
+                # Dùng cùng ngưỡng winsorization với lúc rebuild để features nhất quán
+                if store.winsorization_cap is not None:
+                    raw_df['daily_quantity'] = raw_df['daily_quantity'].clip(upper=store.winsorization_cap)
+            if not store.refresh(raw_df, self.create_features):
+                return self.load_features_from_store(days=days, force_rebuild=True, fit_encoders=fit_encoders)
+        
+        df = store.load(lambda frame: self.encode_categoricals(frame, fit=fit_encoders), days=days)
+        logger.info(f"✅ Loaded {len(df):,} dòng features từ feature store")
+        return df
+    
+    def get_encoders(self) -> Optional[CategoricalEncoders]:
+        """Encoders đã fit (trong bộ nhớ hoặc categorical_encoders.pkl cạnh models)"""
+        if self.encoders is None:
+            self.encoders = CategoricalEncoders.load(self.model_dir)
+            if self.encoders is not None:
+                logger.info(f"✅ Loaded categorical encoders: {ENCODERS_FILENAME}")
+        return self.encoders
+    
+    def encode_categoricals(self, df: pd.DataFrame, fit: bool = False) -> pd.DataFrame:
+        """
+        Encode chi_nhanh, nhom_hang, thuong_hieu, abc_class thành *_encoded (int)
+        và xoá cột gốc thuong_hieu/abc_class. Dùng chung cho create_features và feature store.
+        
+        Code lấy từ CategoricalEncoders cố định (fit=True khi training); giá trị chưa gặp
+        → unknown bucket. Chỉ khi chưa có encoders nào (models cũ) mới encode theo frame.
+        """
+        if fit:
+            self.encoders = CategoricalEncoders().fit(df)
+        encoders = self.get_encoders()
+        if encoders is not None:
+            df = encoders.transform(df)
+            for col in ['thuong_hieu', 'abc_class']:
+                if col in df.columns:
+                    df.drop(columns=[col], inplace=True)  # Xoá cột gốc
+            return df
+        
+        logger.warning("⚠️ Chưa có categorical encoders - encode theo frame hiện tại")
+        df['branch_encoded'] = pd.Categorical(df['chi_nhanh']).codes.astype(int)
+        df['category1_encoded'] = pd.Categorical(df['nhom_hang_cap_1']).codes.astype(int)
+        df['category2_encoded'] = pd.Categorical(df['nhom_hang_cap_2']).codes.astype(int)
+        
+        # Encode thêm brand và abc_class nếu có
+        if 'thuong_hieu' in df.columns:
+            df['brand_encoded'] = pd.Categorical(df['thuong_hieu'].fillna('Unknown')).codes.astype(int)
+            df.drop(columns=['thuong_hieu'], inplace=True)  # Xoá cột gốc
+        if 'abc_class' in df.columns:
+            df['abc_encoded'] = pd.Categorical(df['abc_class'].fillna('C')).codes.astype(int)
+            df.drop(columns=['abc_class'], inplace=True)  # Xoá cột gốc
+        return df
+    
     def train_model_optuna(self, df: pd.DataFrame, target_col: str = 'daily_quantity', 
-                          n_trials: int = 50, timeout: int = 600, metric_type: str = 'mape') -> xgb.XGBRegressor:
+                          n_trials: int = 50, timeout: int = 600, metric_type: str = 'mape',
+                          n_workers: int = 1, warm_start: bool = False,
+                          tuning_strategy: str = 'full') -> xgb.XGBRegressor:
         """
         Train XGBoost với Bayesian Optimization sử dụng Optuna
         
@@ -721,6 +908,11 @@ class SalesForecaster:
             n_trials: Số lần thử hyperparameters
             timeout: Thờigian tối đa (giây)
             metric_type: 'mape', 'mdape', hoặc 'mae' - metric để optimize
+            n_workers: Số processes chạy trials song song (journal storage chung trong model_dir)
+            warm_start: Enqueue top-k params của study lần trước và giảm số trials
+                        khi phân phối target ít thay đổi
+            tuning_strategy: 'full' (mọi trial trên toàn bộ dữ liệu) hoặc 'hyperband'
+                             (successive halving trên tập con series/cửa sổ ngày)
         
         Returns:
             XGBRegressor với best hyperparameters
@@ -743,9 +935,7 @@ class SalesForecaster:
             )
         
         # Tự động xác định feature columns
-        exclude_cols = {'ngay', 'chi_nhanh', 'ma_hang', 'nhom_hang_cap_1', 'nhom_hang_cap_2', 
-                       'daily_quantity', 'daily_revenue', 'daily_profit', 'transaction_count',
-                       target_col}
+        exclude_cols = NON_FEATURE_COLUMNS | {target_col}
         available_features = [col for col in df_clean.columns if col not in exclude_cols]
         
         if not available_features:
@@ -792,84 +982,58 @@ class SalesForecaster:
             n_splits = max(2, len(X_train_full) // 3)
             tscv = TimeSeriesSplit(n_splits=n_splits)
         
-        def objective(trial):
-            """Objective function cho Optuna"""
-            
-            params = {
-                'objective': 'reg:squarederror',
-                'random_state': 42,
-                'n_jobs': -1,  # Dùng tất cả 16 CPU cores
-                'verbosity': 0,
-                
-                # CPU optimizations
-                'tree_method': TREE_METHOD,  # Auto-detected: gpu_hist for GPU, hist for CPU
-                'max_bin': 256,  # Giảm bins để tăng tốc
-                
-                # Tree structure - quan trọng nhất cho time series
-                'max_depth': trial.suggest_int('max_depth', 3, 10),
-                'min_child_weight': trial.suggest_int('min_child_weight', 1, 10),
-                'gamma': trial.suggest_float('gamma', 0.0, 0.5, step=0.1),
-                
-                # Sampling - chống overfitting
-                'subsample': trial.suggest_float('subsample', 0.6, 1.0, step=0.1),
-                'colsample_bytree': trial.suggest_float('colsample_bytree', 0.6, 1.0, step=0.1),
-                'colsample_bylevel': trial.suggest_float('colsample_bylevel', 0.6, 1.0, step=0.1),
-                
-                # Regularization
-                'reg_alpha': trial.suggest_float('reg_alpha', 1e-8, 10.0, log=True),
-                'reg_lambda': trial.suggest_float('reg_lambda', 1e-8, 10.0, log=True),
-                
-                # Learning - số cây sẽ được điều chỉnh bởi early stopping
-                'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.3, log=True),
-                'n_estimators': 2000,  # Cao, sẽ early stop
-            }
-            
-            model = xgb.XGBRegressor(**params)
-            
-            # Cross-validation với TimeSeriesSplit
-            cv_scores = []
-            for train_idx, valid_idx in tscv.split(X_train_full):
-                X_train_cv, X_valid_cv = X_train_full.iloc[train_idx], X_train_full.iloc[valid_idx]
-                y_train_cv, y_valid_cv = y_train_full.iloc[train_idx], y_train_full.iloc[valid_idx]
-                
-                model.fit(
-                    X_train_cv, y_train_cv,
-                    eval_set=[(X_valid_cv, y_valid_cv)],
-                    verbose=False
-                )
-                
-                y_pred = model.predict(X_valid_cv)
-                
-                # Chọn metric phù hợp
-                if metric_type == 'mdape':
-                    # Median Absolute Percentage Error - ít nhạy với outliers
-                    score = median_absolute_percentage_error(y_valid_cv, y_pred)
-                elif metric_type == 'mae':
-                    # Mean Absolute Error - phù hợp cho profit margin
-                    score = mean_absolute_error(y_valid_cv, y_pred)
-                else:  # mape
-                    # Filter out zeros để tránh division by zero
-                    mask = y_valid_cv > 0
-                    if mask.sum() > 0:
-                        score = mean_absolute_percentage_error(y_valid_cv[mask], y_pred[mask])
-                    else:
-                        score = np.nan
-                
-                cv_scores.append(score)
-            
-            return np.mean(cv_scores)
+        # Objective là object pickle được để chạy trong worker processes
+        if tuning_strategy not in TUNING_STRATEGIES:
+            logger.warning(f"⚠️ tuning_strategy '{tuning_strategy}' không hợp lệ - dùng 'full'")
+            tuning_strategy = 'full'
+        if tuning_strategy == 'hyperband':
+            row_subsets = fidelity_row_subsets(df_clean.iloc[:split_idx])
+            logger.info(f"🪜 Hyperband rungs: {[len(rows) for rows in row_subsets]} dòng")
+            objective = MultiFidelityCVObjective(
+                X_train_full, y_train_full, list(tscv.split(X_train_full)), row_subsets,
+                metric_type=metric_type, tree_method=TREE_METHOD
+            )
+        else:
+            objective = XGBoostCVObjective(
+                X_train_full, y_train_full, list(tscv.split(X_train_full)),
+                metric_type=metric_type, tree_method=TREE_METHOD
+            )
+        
+        # Warm start: params tốt nhất của study lần trước + budget theo drift của target
+        warm_params = []
+        if warm_start:
+            previous_study = load_previous_study(self.model_dir, target_col)
+            warm_params, n_trials = warm_start_plan(previous_study, y, metric_type, n_trials)
         
         # Tạo study với pruning
         study_name = f"{target_col}_study"
-        study = optuna.create_study(
-            direction='minimize',
-            sampler=TPESampler(seed=42),
-            pruner=optuna.pruners.MedianPruner(n_startup_trials=10, n_warmup_steps=20),
-            study_name=study_name
-        )
-        
         logger.info(f"🔍 Starting Optuna tuning for '{target_col}' with {n_trials} trials...")
-        study.optimize(objective, n_trials=n_trials, timeout=timeout, show_progress_bar=True)
+        if n_workers > 1:
+            storage_path = os.path.join(self.model_dir, f'{target_col}_optuna_journal.log')
+            study = run_parallel_study(study_name, storage_path, objective, n_trials=n_trials,
+                                       n_workers=n_workers, timeout=timeout, enqueue_params=warm_params)
+        else:
+            study = optuna.create_study(
+                direction='minimize',
+                sampler=TPESampler(seed=42),
+                pruner=create_pruner(tuning_strategy),
+                study_name=study_name
+            )
+            for params in warm_params:
+                study.enqueue_trial(params, skip_if_exists=True)
+            study.optimize(objective, n_trials=n_trials, timeout=timeout, show_progress_bar=True)
+        log_study_summary(study, target_col)
+        # Thông tin cho warm start lần train sau
+        study.set_user_attr('metric_type', metric_type)
+        study.set_user_attr('target_profile', target_profile(y))
+        
+        savings = {}
+        if tuning_strategy == 'hyperband':
+            savings = fidelity_savings(study)
+            if 'cpu_seconds_saved_est' in savings:
+                logger.info(f"⏱️  Hyperband: {savings['cpu_seconds']:.1f} CPU-s, ước tính tiết kiệm "
+                            f"{savings['cpu_seconds_saved_est']:.1f} CPU-s so với "
+                            f"{savings['cpu_seconds_exhaustive_est']:.1f} CPU-s khi mọi trial chạy trên toàn bộ dữ liệu")
         
         # Log kết quả
         metric_name = 'MdAPE' if metric_type == 'mdape' else ('MAE' if metric_type == 'mae' else 'MAPE')
@@ -882,7 +1046,8 @@ class SalesForecaster:
             'objective': 'reg:squarederror',
             'random_state': 42,
             'n_jobs': -1,
-            'n_estimators': 2000  # High, early stopping will find optimal
+            'n_estimators': MAX_BOOST_ROUNDS,  # High, early stopping will find optimal
+            'early_stopping_rounds': EARLY_STOPPING_ROUNDS
         })
         
         final_model = xgb.XGBRegressor(**best_params)
@@ -939,7 +1104,9 @@ class SalesForecaster:
             'val_mdape': val_mdape,
             'best_iteration': best_iter,
             'n_trials': len(study.trials),
-            'primary_metric': metric_type
+            'primary_metric': metric_type,
+            'tuning_strategy': tuning_strategy,
+            **savings
         }
         
         # Lưu metric chính theo loại (để hiển thị trong summary)
@@ -957,9 +1124,9 @@ class SalesForecaster:
         self.studies[target_col] = study
         
         # Lưu study
-        study_path = os.path.join(self.model_dir, f'{target_col}_optuna_study.pkl')
-        joblib.dump(study, study_path)
-        logger.info(f"💾 Study saved to {study_path}")
+        saved_path = study_path(self.model_dir, target_col)
+        joblib.dump(study, saved_path)
+        logger.info(f"💾 Study saved to {saved_path}")
         
         return final_model
 
@@ -1029,7 +1196,7 @@ class SalesForecaster:
             SELECT max(transaction_date) as max_date
             FROM retail_dw.fct_regular_sales
             """
-            result = self.ch.query(query)
+            result = self.ch.cached_query(query)
             if result is not None and len(result) > 0 and result.iloc[0, 0] is not None:
                 max_date = result.iloc[0, 0]
                 if isinstance(max_date, str):
@@ -1080,10 +1247,17 @@ class SalesForecaster:
             logger.debug(f"Không thể lấy ngày training gần nhất: {e}")
             return None
     
-    def _load_models_if_exist(self) -> bool:
-        """Load models từ file nếu tồn tại"""
+    def _load_models_if_exist(self, names: Optional[List[str]] = None) -> bool:
+        """
+        Load models từ file nếu tồn tại - chỉ các model chưa có trong self.models
+        (vd. sau update_models_incremental chỉ có product_quantity, các model còn lại vẫn
+        được load từ đĩa)
+        """
         loaded = False
-        for name in ['product_quantity', 'category_trend']:
+        names = names or ['product_quantity', 'category_trend', 'product_quantity_direct', 'product_quantity_shards']
+        for name in names:
+            if name in self.models:
+                continue
             model_path = os.path.join(self.model_dir, f'{name}_model.pkl')
             if os.path.exists(model_path):
                 try:
@@ -1116,21 +1290,26 @@ class SalesForecaster:
         except Exception as e:
             logger.warning(f"⚠️ Không thể lưu timestamp training: {e}")
     
-    def should_retrain(self, min_new_days: int = 1) -> tuple:
+    def should_retrain(self, min_new_days: int = 1, allow_incremental: bool = False) -> tuple:
         """
         Kiểm tra có cần train lại không
         
+        Args:
+            min_new_days: Số ngày dữ liệu mới tối thiểu để train lại
+            allow_incremental: Cho phép cập nhật incremental (continued training Model 1)
+                               khi số ngày mới ≤ INCREMENTAL_MAX_NEW_DAYS
+        
         Returns:
-            tuple: (should_train: bool, reason: str)
+            tuple: (mode: 'skip' | 'incremental' | 'full', reason: str)
         """
         latest_date = self.get_latest_data_date()
         last_train_date = self.get_last_training_date()
         
         if latest_date is None:
-            return False, "Không thể lấy ngày dữ liệu mới nhất"
+            return 'skip', "Không thể lấy ngày dữ liệu mới nhất"
         
         if last_train_date is None:
-            return True, "Chưa có lịch sử training"
+            return 'full', "Chưa có lịch sử training"
         
         # Cả hai đã là date objects sau khi refactor
         # Đảm bảo cùng kiểu date
@@ -1143,12 +1322,90 @@ class SalesForecaster:
         days_diff = (latest_date - last_train_date).days
         
         if days_diff < min_new_days:
-            return False, f"Không có dữ liệu mới (last_data={latest_date}, last_train={last_train_date}, diff={days_diff} days)"
+            return 'skip', f"Không có dữ liệu mới (last_data={latest_date}, last_train={last_train_date}, diff={days_diff} days)"
+        
+        if allow_incremental and days_diff <= INCREMENTAL_MAX_NEW_DAYS:
+            model_path = os.path.join(self.model_dir, 'product_quantity_model.pkl')
+            shards_path = os.path.join(self.model_dir, 'product_quantity_shards_model.pkl')
+            if os.path.exists(model_path) and not os.path.exists(shards_path):
+                return 'incremental', f"{days_diff} ngày mới (≤ {INCREMENTAL_MAX_NEW_DAYS}) - cập nhật incremental Model 1"
         
-        return True, f"Có dữ liệu mới: {days_diff} ngày kể từ lần train cuối"
+        return 'full', f"Có dữ liệu mới: {days_diff} ngày kể từ lần train cuối"
+    
+    def update_models_incremental(self, use_feature_store: bool = False) -> Optional[Dict]:
+        """
+        Continued training cho Model 1 (product_quantity) trên ngày mới + replay window,
+        giữ params đã tune. Các models khác giữ nguyên.
+        
+        Returns:
+            Metrics của Model 1 sau cập nhật, hoặc None nếu cần full retrain
+            (drift lớn hoặc MdAPE holdout tệ hơn ngưỡng)
+        """
+        import time
+        start_time = time.time()
+        
+        logger.info("=" * 60)
+        logger.info("⚡ INCREMENTAL UPDATE - Model 1 (product_quantity)")
+        logger.info("=" * 60)
+        
+        last_train_date = self.get_last_training_date()
+        model_path = os.path.join(self.model_dir, 'product_quantity_model.pkl')
+        if last_train_date is None or not os.path.exists(model_path):
+            logger.warning("⚠️ Chưa có model/lịch sử training - cần full retrain")
+            return None
+        model = joblib.load(model_path)
+        
+        # Load đủ lịch sử cho replay window + lag/rolling features
+        days = (date.today() - last_train_date).days + INCREMENTAL_REPLAY_DAYS + FEATURE_LOOKBACK_DAYS
+        if use_feature_store and PYARROW_AVAILABLE:
+            # Không fit lại encoders trên replay window: booster tiếp tục train trên codes cũ
+            df_features = self.load_features_from_store(days=days, fit_encoders=False)
+        else:
+            df = self.load_historical_data(days=days)
+            if df.empty:
+                logger.warning("⚠️ Không có dữ liệu - cần full retrain")
+                return None
+            df_features = self.create_features(df)
+        if df_features.empty:
+            logger.warning("⚠️ Không có features - cần full retrain")
+            return None
+        
+        previous_study = load_previous_study(self.model_dir, 'daily_quantity')
+        profile = previous_study.user_attrs.get('target_profile') if previous_study is not None else None
+        
+        updated, info = incremental_update(model, df_features, last_train_date, target_profile=profile)
+        if updated is None:
+            logger.warning(f"⚠️ Incremental update bị từ chối: {info['reason']} → full retrain")
+            return None
+        
+        self.models['product_quantity'] = updated
+        joblib.dump(updated, model_path)
+        
+        # Cập nhật metrics của Model 1
+        metrics_path = os.path.join(self.model_dir, 'training_metrics.json')
+        if os.path.exists(metrics_path):
+            with open(metrics_path, 'r', encoding='utf-8') as f:
+                self.metrics = json.load(f)
+        metrics = self.metrics.setdefault('daily_quantity', {})
+        metrics['incremental_update'] = {
+            **info,
+            'updated_at': datetime.now().isoformat(),
+            'duration_seconds': round(time.time() - start_time, 1),
+        }
+        with open(metrics_path, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics, f, indent=2, ensure_ascii=False, default=float)
+        
+        self.save_training_timestamp()
+        logger.info(f"✅ {info['reason']} - MdAPE holdout {info['holdout_mdape_before']:.2f}% → "
+                    f"{info['holdout_mdape_after']:.2f}% ({time.time() - start_time:.1f}s)")
+        return metrics
     
     def train_all_models(self, n_trials: int = 50, days: int = 0, 
-                         send_email: bool = True, tuning_method: str = 'optuna') -> Dict:
+                         send_email: bool = True, tuning_method: str = 'optuna',
+                         forecast_mode: str = 'recursive', forecast_horizon: int = 14,
+                         use_feature_store: bool = False, tuning_workers: int = 1,
+                         warm_start: bool = False, tuning_strategy: str = 'full',
+                         shard_by: Optional[str] = None) -> Dict:
         """
         Train models cho tất cả levels (LUÔN dùng Optuna tuning)
         
@@ -1157,6 +1414,16 @@ class SalesForecaster:
             days: Số ngày dữ liệu lịch sử để train
             send_email: Có gửi email thông báo không
             tuning_method: 'optuna' (mặc định) hoặc 'random_search' (fallback)
+            forecast_mode: 'recursive' (mặc định) hoặc 'direct' - train thêm model
+                           direct multi-horizon (product_quantity_direct) cho t+1…t+forecast_horizon
+            forecast_horizon: Số horizon cho chế độ direct (mặc định: 14 ngày)
+            use_feature_store: Load features từ feature store (chỉ tính lại partition mới)
+                               thay vì load lại toàn bộ dữ liệu và create_features
+            tuning_workers: Số processes chạy Optuna trials song song (mặc định: 1)
+            warm_start: Khởi tạo Optuna từ study lần train trước (giảm trials khi drift nhỏ)
+            tuning_strategy: 'full' (mặc định) hoặc 'hyperband' (multi-fidelity trên kích thước dữ liệu)
+            shard_by: None (model global) hoặc 'abc_class' / 'nhom_hang_cap_1' - train Model 1
+                      theo từng segment trong các worker processes song song
         
         Returns:
             Dict chứa metrics của tất cả models
@@ -1176,8 +1443,15 @@ class SalesForecaster:
             logger.info(f"📊 Latest data: {latest_data}, Last training: {last_training}, Diff: {days_diff} days")
         
         # Load data
-        logger.info(f"📥 Loading {days} days of historical data...")
-        df = self.load_historical_data(days=days)
+        if use_feature_store and not PYARROW_AVAILABLE:
+            logger.warning("⚠️ pyarrow chưa được cài đặt - bỏ qua feature store")
+            use_feature_store = False
+        if use_feature_store:
+            logger.info(f"📥 Loading {days} days of features từ feature store...")
+            df = self.load_features_from_store(days=days, fit_encoders=True)
+        else:
+            logger.info(f"📥 Loading {days} days of historical data...")
+            df = self.load_historical_data(days=days)
         
         # VALIDATION: Kiểm tra dữ liệu sau khi load
         if df.empty:
@@ -1220,9 +1494,16 @@ class SalesForecaster:
         else:
             logger.info(f"   ✅ Time-series continuity: Good ({len(daily_counts)}/{date_range_days} days)")
         
-        # Feature engineering
-        logger.info("🔧 Creating features...")
-        df_features = self.create_features(df)
+        # Feature engineering (feature store đã materialize sẵn)
+        if use_feature_store:
+            df_features = df
+        else:
+            logger.info("🔧 Creating features...")
+            df_features = self.create_features(df, fit_encoders=True)
+            del df
+        # String keys → category: training frame không dùng cho predict theo series
+        df_features = categorize_keys(apply_dtype_policy(df_features))
+        logger.info(f"   💾 Training frame: {frame_memory_mb(df_features):,.0f} MB")
         
         # VALIDATION: Kiểm tra sau feature engineering
         if df_features.empty:
@@ -1254,8 +1535,8 @@ class SalesForecaster:
         
         # Training function - LUÔN dùng Optuna tuning
         if OPTUNA_AVAILABLE:
-            train_func = lambda df, target, metric_type='mape': self.train_model_optuna(df, target, n_trials=n_trials, metric_type=metric_type)
-            logger.info(f"🎯 Using Optuna tuning with {n_trials} trials")
+            train_func = lambda df, target, metric_type='mape': self.train_model_optuna(df, target, n_trials=n_trials, metric_type=metric_type, n_workers=tuning_workers, warm_start=warm_start, tuning_strategy=tuning_strategy)
+            logger.info(f"🎯 Using Optuna tuning with {n_trials} trials ({tuning_workers} workers, strategy: {tuning_strategy})")
         else:
             train_func = lambda df, target, metric_type='mape': self.train_model_random_search(df, target, n_iter=n_trials, metric_type=metric_type)
             logger.info(f"🎯 Using Random Search with {n_trials} iterations (Optuna not available)")
@@ -1264,10 +1545,24 @@ class SalesForecaster:
         logger.info("\n" + "-" * 40)
         logger.info("📦 Model 1: Product-Level Quantity Forecast (MdAPE)")
         logger.info("-" * 40)
-        self.models['product_quantity'] = train_func(df_features, 'daily_quantity', metric_type='mdape')
+        shards_path = os.path.join(self.model_dir, 'product_quantity_shards_model.pkl')
+        if shard_by and OPTUNA_AVAILABLE:
+            sharded = self.train_sharded_models(df_features, shard_by, n_trials, tuning_strategy)
+            if sharded is not None:
+                self.models['product_quantity_shards'] = sharded
+        if 'product_quantity_shards' not in self.models:
+            if shard_by:
+                logger.warning("⚠️ Không train được sharded models - dùng model global")
+            self.models['product_quantity'] = train_func(df_features, 'daily_quantity', metric_type='mdape')
+            if os.path.exists(shards_path):
+                # Tránh predict bằng shards cũ sau khi đã train lại model global
+                os.remove(shards_path)
+                logger.info(f"🗑️  Removed stale sharded models: {shards_path}")
         
         # VALIDATION: Kiểm tra model đã train thành công
-        if 'product_quantity' not in self.models or self.models['product_quantity'] is None:
+        if 'product_quantity_shards' in self.models:
+            logger.info(f"✅ Model 1 trained as {len(self.models['product_quantity_shards'].models)} shards")
+        elif 'product_quantity' not in self.models or self.models['product_quantity'] is None:
             logger.error("❌ Model 1 training failed!")
         else:
             model = self.models['product_quantity']
@@ -1275,6 +1570,8 @@ class SalesForecaster:
                 logger.info(f"✅ Model 1 trained successfully with {len(model.feature_importances_)} features")
             else:
                 logger.warning("⚠️  Model 1 may not be trained properly (no feature_importances_)")
+        # Model 2/direct ghi đè self.feature_cols khi train - giữ lại cột của Model 1
+        model_feature_cols = self.feature_cols
         
         # Model 2: Category Trend Forecast (Seasonal/Festival) - Độ tin cậy thấp nhất
         logger.info("\n" + "-" * 40)
@@ -1283,71 +1580,26 @@ class SalesForecaster:
         logger.info("   Độ tin cậy: LOW - Chỉ dùng cho xu hướng dài hạn")
         logger.info("-" * 40)
         
-        # Aggregate lên category level (bao gồm cả seasonal factors)
-        agg_dict = {
-            'daily_quantity': 'sum',
-            'daily_revenue': 'sum',
-            'day_of_week': 'first',
-            'day_of_month': 'first',
-            'month': 'first',
-            'week_of_year': 'first',
-            'is_weekend': 'first',
-            'is_month_start': 'first',
-            'is_month_end': 'first',
-            'is_holiday': 'first'
-        }
-        
-        # Thêm seasonal factors nếu có
-        if 'seasonal_factor' in df_features.columns:
-            agg_dict['seasonal_factor'] = 'mean'  # Trung bình seasonal factor
-            agg_dict['is_peak_day'] = 'max'  # Nếu có 1 ngày peak thì cả nhóm là peak
-            agg_dict['revenue_factor'] = 'mean'
-            agg_dict['quantity_factor'] = 'mean'
-        
-        category_df = df_features.groupby(['ngay', 'nhom_hang_cap_1']).agg(agg_dict).reset_index()
-        
-        category_df = category_df.sort_values(['nhom_hang_cap_1', 'ngay'])
-        
-        # Lag features cho category
-        for lag in [1, 7, 14]:
-            category_df[f'lag_{lag}_quantity'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'].shift(lag)
-            category_df[f'lag_{lag}_revenue'] = category_df.groupby('nhom_hang_cap_1')['daily_revenue'].shift(lag)
-        
-        # Rolling statistics
-        for window in [7, 14]:
-            category_df[f'rolling_mean_{window}_quantity'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'] \
-                .transform(lambda x: x.rolling(window, min_periods=1).mean())
-        
-        # Growth rate
-        category_df['quantity_growth'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'].pct_change()
-        category_df['quantity_growth'] = category_df['quantity_growth'].replace([np.inf, -np.inf], np.nan).fillna(0)
-        
-        # Encoding
-        category_df['category1_encoded'] = pd.Categorical(category_df['nhom_hang_cap_1']).codes
-        
-        # Clean up
-        numeric_cols = category_df.select_dtypes(include=[np.number]).columns
-        for col in numeric_cols:
-            category_df[col] = category_df[col].replace([np.inf, -np.inf], np.nan).fillna(0)
-        
-        # Dummy values cho category-level
-        category_df['chi_nhanh'] = 'ALL_BRANCHES'
-        category_df['ma_hang'] = 'ALL_PRODUCTS'
-        category_df['nhom_hang_cap_2'] = 'ALL_CAT2'
-        category_df['branch_encoded'] = 0
-        category_df['category2_encoded'] = 0
-        
-        # Fill missing features
-        for col in self.feature_cols:
-            if col not in category_df.columns:
-                category_df[col] = 0
-        
-        # Model 2 dùng target riêng để tránh ghi đè metrics
-        category_df['category_daily_quantity'] = category_df['daily_quantity']
+        category_df = self._category_training_frame(self._aggregate_categories(df_features))
         # TODO: Model 2 cần metric riêng cho seasonal forecast (ví dụ: sMAPE)
         self.models['category_trend'] = train_func(category_df, 'category_daily_quantity', metric_type='mape')
         logger.info("⚠️  Lưu ý: Model 2 có độ tin cậy thấp - cần dữ liệu >= 1 năm để seasonal forecast chính xác")
         
+        # Model 1 (direct): Multi-horizon t+1…t+H với feature horizon
+        if forecast_mode == 'direct':
+            logger.info("\n" + "-" * 40)
+            logger.info(f"🎯 Model 1 (direct): Multi-Horizon Quantity Forecast t+1…t+{forecast_horizon} (MdAPE)")
+            logger.info("-" * 40)
+            direct_df = build_direct_training_frame(df_features, horizons=range(1, forecast_horizon + 1),
+                                                    origin_days=DIRECT_TRAIN_ORIGIN_DAYS or None)
+            logger.info(f"   📊 Direct training rows: {len(direct_df):,} ({forecast_horizon} horizons)")
+            if len(direct_df) > 0:
+                self.models['product_quantity_direct'] = train_func(direct_df, DIRECT_TARGET_COL, metric_type='mdape')
+            else:
+                logger.warning("⚠️ Không đủ lịch sử để tạo target multi-horizon - bỏ qua model direct")
+        # Khôi phục feature_cols của Model 1 (như luồng streaming)
+        self.feature_cols = model_feature_cols
+        
         # Lưu models
         logger.info("\n" + "-" * 40)
         logger.info("💾 Saving models...")
@@ -1356,6 +1608,9 @@ class SalesForecaster:
             model_path = os.path.join(self.model_dir, f'{name}_model.pkl')
             joblib.dump(model, model_path)
             logger.info(f"✅ Saved: {name} → {model_path}")
+        if self.encoders is not None:
+            encoders_path = self.encoders.save(self.model_dir)
+            logger.info(f"✅ Saved: categorical encoders → {encoders_path}")
         
         # Lưu metrics
         metrics_path = os.path.join(self.model_dir, 'training_metrics.json')
@@ -1371,7 +1626,9 @@ class SalesForecaster:
         # Map model names to (target_col, metric_label, cv_key, val_key)
         model_metric_map = {
             'product_quantity': ('daily_quantity', 'MdAPE', 'cv_mdape', 'val_mdape'),
-            'category_trend': ('category_daily_quantity', 'MAPE', 'cv_mape', 'val_mape')
+            'category_trend': ('category_daily_quantity', 'MAPE', 'cv_mape', 'val_mape'),
+            'product_quantity_direct': (DIRECT_TARGET_COL, 'MdAPE', 'cv_mdape', 'val_mdape'),
+            'product_quantity_shards': ('daily_quantity_shards', 'MdAPE', 'cv_mdape', 'val_mdape')
         }
         
         for model_name in self.models.keys():
@@ -1426,7 +1683,283 @@ class SalesForecaster:
             except Exception as e:
                 logger.error(f"❌ Lỗi khi gửi email: {e}")
         
-        return self.metrics
+        return self.metrics
+
+    def _source_dates(self, days: int = 0) -> List[date]:
+        """Các ngày có doanh số hợp lệ trong fct_regular_sales (streaming training chia chunk theo ngày)"""
+        query = f"""
+        SELECT DISTINCT f.transaction_date as ngay
+        FROM retail_dw.fct_regular_sales f
+        WHERE f.product_code IS NOT NULL AND f.product_code != ''
+          AND f.quantity_sold > 0 AND f.gross_revenue > 0
+          {self._date_filter(days)}
+        ORDER BY ngay
+        """
+        result = self.ch.query(query)
+        return [] if result.empty else list(pd.to_datetime(result['ngay']).dt.date)
+
+    def _source_winsorization_cap(self, days: int = 0, percentile: float = 0.99) -> Optional[float]:
+        """P99 daily_quantity tính trên ClickHouse (cùng ngưỡng với apply_winsorization trên toàn bộ dữ liệu)"""
+        query = f"""
+        SELECT quantileExact({percentile})(f.quantity_sold) as cap
+        FROM retail_dw.fct_regular_sales f
+        WHERE f.product_code IS NOT NULL AND f.product_code != ''
+          AND f.quantity_sold > 0 AND f.gross_revenue > 0
+          {self._date_filter(days)}
+        """
+        try:
+            cap = self.ch.query(query).iloc[0, 0]
+            return float(cap) if cap is not None and np.isfinite(cap) else None
+        except Exception as e:
+            logger.warning(f"⚠️ Không tính được winsorization cap: {e}")
+            return None
+
+    def materialize_feature_store_chunked(self, store: FeatureStore, days: int = 0,
+                                          chunk_days: int = EXTERNAL_MEMORY_CHUNK_DAYS) -> bool:
+        """
+        Materialize feature store theo từng cụm chunk_days ngày (không load toàn bộ lịch sử):
+        chunk đầu → rebuild, các chunk sau → refresh với lookback đọc lại từ store.
+
+        Returns:
+            False nếu không có dữ liệu hoặc không materialize được
+        """
+        dates = self._source_dates(days)
+        if store.exists():
+            dates = [d for d in dates if d >= store.last_date]
+            cap = store.winsorization_cap
+        else:
+            cap = self._source_winsorization_cap(days)
+        if not dates:
+            return store.exists()
+
+        # Chunk đầu của rebuild cần đủ ngày cho lag_30/rolling_30 để schema giống các chunk sau
+        chunks = date_chunks(dates, chunk_days, first_chunk_days=None if store.exists() else MIN_FIRST_CHUNK_DAYS)
+        logger.info(f"🧱 Materialize feature store: {len(dates)} ngày, {len(chunks)} chunks × ≤{chunk_days} ngày")
+        rebuilt = False
+        for start, end in chunks:
+            raw_df = self.load_historical_data(apply_winsorize=False, date_range=(start, end))
+            if raw_df.empty:
+                continue
+            if cap is not None:
+                raw_df['daily_quantity'] = raw_df['daily_quantity'].clip(upper=cap)
+            if not store.exists():
+                store.rebuild(raw_df, self.create_features, winsorization_cap=cap)
+                rebuilt = True
+            elif not store.refresh(raw_df, self.create_features, lookback_days=STREAMING_LOOKBACK_DAYS):
+                if rebuilt:
+                    logger.error("❌ Schema features thay đổi giữa các chunk - tăng EXTERNAL_MEMORY_CHUNK_DAYS")
+                    return False
+                # Schema cũ khác → materialize lại toàn bộ theo chunk
+                shutil.rmtree(store.root_dir, ignore_errors=True)
+                return self.materialize_feature_store_chunked(store, days, chunk_days)
+            del raw_df
+        return store.exists()
+
+    def train_all_models_streaming(self, n_trials: int = 50, days: int = 0, send_email: bool = True,
+                                   chunk_days: int = EXTERNAL_MEMORY_CHUNK_DAYS) -> Dict:
+        """
+        Streaming (out-of-core) training: bộ nhớ giới hạn theo chunk_days thay vì độ dài lịch sử.
+
+        - Features được materialize theo chunk vào feature store (Parquet, partition theo ngày)
+        - Model 1 train trên external memory DMatrix từ FeatureChunkIter (xgb.DataIter),
+          params lấy từ study lần train trước (không chạy Optuna trên toàn bộ lịch sử)
+        - Model 2 (category) tổng hợp theo chunk rồi train như train_all_models (frame nhỏ)
+
+        Args:
+            n_trials: Số Optuna trials cho Model 2
+            days: Số ngày lịch sử (0 = toàn bộ)
+            send_email: Có gửi email thông báo không
+            chunk_days: Số ngày mỗi chunk
+        """
+        import time
+        start_time = time.time()
+        logger.info("=" * 60)
+        logger.info(f"🚀 BẮT ĐẦU STREAMING TRAINING (chunk {chunk_days} ngày)")
+        logger.info("=" * 60)
+
+        if not PYARROW_AVAILABLE:
+            logger.error("❌ Streaming training cần pyarrow (feature store) - dùng train_all_models")
+            return self.metrics
+        store = FeatureStore(self.feature_store_dir)
+        if not self.materialize_feature_store_chunked(store, days, chunk_days):
+            logger.error("❌ Không có dữ liệu để training!")
+            return self.metrics
+
+        dates = store.partition_dates()
+        if days > 0:
+            first = date.today() - timedelta(days=days)
+            dates = [d for d in dates if d >= first]
+        if len(dates) < 2:
+            logger.error(f"❌ Chỉ có {len(dates)} ngày features - không đủ để training")
+            return self.metrics
+        chunks = date_chunks(dates, chunk_days)
+
+        # Encoders: hợp categories của mọi chunk (chỉ đọc các cột categorical gốc)
+        raw_columns = [column for column, _ in ENCODED_COLUMNS.values()
+                       if column in store.metadata.get('columns', [])]
+        self.encoders = CategoricalEncoders().fit_chunks(
+            store.load_range(None, start, end, columns=raw_columns) for start, end in chunks)
+
+        def load_chunk(start, end):
+            return apply_dtype_policy(store.load_range(self.encode_categoricals, start, end))
+
+        train_chunks, val_chunks = split_chunks(dates, chunk_days)
+        sample = load_chunk(*train_chunks[0])
+        self.feature_cols = [col for col in sample.columns
+                             if col not in NON_FEATURE_COLUMNS and pd.api.types.is_numeric_dtype(sample[col])]
+        del sample
+
+        # Model 1: params đã tune lần trước, số rounds theo early stopping trên các ngày cuối
+        logger.info("\n" + "-" * 40)
+        logger.info("📦 Model 1: Product-Level Quantity Forecast (external memory)")
+        logger.info("-" * 40)
+        previous = load_previous_study(self.model_dir, 'daily_quantity')
+        best = top_trial_params(previous, k=1) if previous is not None else []
+        params = dict(STREAMING_DEFAULT_PARAMS)
+        if best:
+            params.update(best[0])
+            logger.info(f"🎯 Dùng best params của study trước: {best[0]}")
+        else:
+            logger.info(f"🎯 Chưa có study trước - dùng params mặc định: {params}")
+        params.update({'random_state': 42, 'n_jobs': -1, 'tree_method': get_xgboost_tree_method()})
+
+        model, result = train_external_memory(
+            load_chunk, train_chunks, val_chunks, self.feature_cols, 'daily_quantity', params,
+            cache_dir=os.path.join(self.model_dir, 'extmem_cache'), max_bin=MAX_BIN,
+            num_boost_round=MAX_BOOST_ROUNDS, early_stopping_rounds=EARLY_STOPPING_ROUNDS)
+        self.models['product_quantity'] = model
+
+        y_val, y_pred = result['y_val'], result['pred_val']
+        mask = y_val > 0
+        self.metrics['daily_quantity'] = {
+            'tuning_method': 'previous_study' if best else 'default_params',
+            'training_mode': 'streaming',
+            'primary_metric': 'mdape',
+            'val_mdape': float(median_absolute_percentage_error(y_val, y_pred)) if len(y_val) else None,
+            'val_mape': float(mean_absolute_percentage_error(y_val[mask], y_pred[mask])) if mask.any() else None,
+            'val_mae': float(mean_absolute_error(y_val, y_pred)) if len(y_val) else None,
+            'val_rmse': float(np.sqrt(mean_squared_error(y_val, y_pred))) if len(y_val) else None,
+            'n_rounds': result['n_rounds'],
+            'train_days': sum(1 for d in dates if d < val_chunks[0][0]) if val_chunks else len(dates),
+            'validation_rows': int(len(y_val)),
+            'chunk_days': chunk_days,
+        }
+        logger.info(f"📊 Validation MdAPE: {self.metrics['daily_quantity']['val_mdape']}, rounds: {result['n_rounds']}")
+
+        # Model 2: tổng hợp category theo chunk (mỗi ngày nằm trọn trong một chunk)
+        logger.info("\n" + "-" * 40)
+        logger.info("📊 Model 2: Category Trend Forecast (Seasonal/Festival)")
+        logger.info("-" * 40)
+        category_df = pd.concat([self._aggregate_categories(store.load_range(None, start, end))
+                                 for start, end in chunks], ignore_index=True)
+        category_df = self._category_training_frame(category_df)
+        model_feature_cols = self.feature_cols
+        if OPTUNA_AVAILABLE:
+            self.models['category_trend'] = self.train_model_optuna(
+                category_df, 'category_daily_quantity', n_trials=n_trials, metric_type='mape')
+        else:
+            self.models['category_trend'] = self.train_model_random_search(
+                category_df, 'category_daily_quantity', n_iter=n_trials, metric_type='mape')
+        self.feature_cols = model_feature_cols
+
+        # Lưu models (model global thay cho shards cũ nếu có)
+        shards_path = os.path.join(self.model_dir, 'product_quantity_shards_model.pkl')
+        if os.path.exists(shards_path):
+            os.remove(shards_path)
+            logger.info(f"🗑️  Removed stale sharded models: {shards_path}")
+        for name, trained in self.models.items():
+            model_path = os.path.join(self.model_dir, f'{name}_model.pkl')
+            joblib.dump(trained, model_path)
+            logger.info(f"✅ Saved: {name} → {model_path}")
+        encoders_path = self.encoders.save(self.model_dir)
+        logger.info(f"✅ Saved: categorical encoders → {encoders_path}")
+        metrics_path = os.path.join(self.model_dir, 'training_metrics.json')
+        with open(metrics_path, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics, f, indent=2, ensure_ascii=False)
+        logger.info(f"✅ Metrics saved to {metrics_path}")
+        self.save_training_timestamp()
+
+        training_duration = time.time() - start_time
+        logger.info(f"✅ Streaming training hoàn tất sau {training_duration:.0f}s")
+        if send_email and self.email_notifier:
+            try:
+                self.email_notifier.send_training_report(metrics=self.metrics, training_duration=training_duration,
+                                                         model_dir=self.model_dir)
+            except Exception as e:
+                logger.error(f"❌ Lỗi khi gửi email: {e}")
+        return self.metrics
+
+    def _aggregate_categories(self, df_features: pd.DataFrame) -> pd.DataFrame:
+        """
+        Tổng hợp features Model 1 lên (ngay, nhom_hang_cap_1) cho Model 2.
+        Mỗi ngày chỉ nằm trong một chunk nên streaming training gọi hàm này theo chunk rồi concat.
+        """
+        # Aggregate lên category level (bao gồm cả seasonal factors)
+        agg_dict = {
+            'daily_quantity': 'sum',
+            'daily_revenue': 'sum',
+            'day_of_week': 'first',
+            'day_of_month': 'first',
+            'month': 'first',
+            'week_of_year': 'first',
+            'is_weekend': 'first',
+            'is_month_start': 'first',
+            'is_month_end': 'first',
+            'is_holiday': 'first'
+        }
+        
+        # Thêm seasonal factors nếu có
+        if 'seasonal_factor' in df_features.columns:
+            agg_dict['seasonal_factor'] = 'mean'  # Trung bình seasonal factor
+            agg_dict['is_peak_day'] = 'max'  # Nếu có 1 ngày peak thì cả nhóm là peak
+            agg_dict['revenue_factor'] = 'mean'
+            agg_dict['quantity_factor'] = 'mean'
+        
+        category_df = df_features.groupby(['ngay', 'nhom_hang_cap_1'], observed=True).agg(agg_dict).reset_index()
+        category_df['nhom_hang_cap_1'] = category_df['nhom_hang_cap_1'].astype(object)
+        return category_df
+
+    def _category_training_frame(self, category_df: pd.DataFrame) -> pd.DataFrame:
+        """Lag/rolling/growth + encoding cho frame category đã tổng hợp (Model 2)"""
+        category_df = category_df.sort_values(['nhom_hang_cap_1', 'ngay'])
+        
+        # Lag features cho category
+        for lag in [1, 7, 14]:
+            category_df[f'lag_{lag}_quantity'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'].shift(lag)
+            category_df[f'lag_{lag}_revenue'] = category_df.groupby('nhom_hang_cap_1')['daily_revenue'].shift(lag)
+        
+        # Rolling statistics
+        for window in [7, 14]:
+            category_df[f'rolling_mean_{window}_quantity'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'] \
+                .transform(lambda x: x.rolling(window, min_periods=1).mean())
+        
+        # Growth rate
+        category_df['quantity_growth'] = category_df.groupby('nhom_hang_cap_1')['daily_quantity'].pct_change()
+        category_df['quantity_growth'] = category_df['quantity_growth'].replace([np.inf, -np.inf], np.nan).fillna(0)
+        
+        # Encoding
+        category_df['category1_encoded'] = self.encoders.encode('nhom_hang_cap_1', category_df['nhom_hang_cap_1'])
+        
+        # Clean up
+        numeric_cols = category_df.select_dtypes(include=[np.number]).columns
+        for col in numeric_cols:
+            category_df[col] = category_df[col].replace([np.inf, -np.inf], np.nan).fillna(0)
+        
+        # Dummy values cho category-level
+        category_df['chi_nhanh'] = 'ALL_BRANCHES'
+        category_df['ma_hang'] = 'ALL_PRODUCTS'
+        category_df['nhom_hang_cap_2'] = 'ALL_CAT2'
+        category_df['branch_encoded'] = 0
+        category_df['category2_encoded'] = 0
+        
+        # Fill missing features
+        for col in self.feature_cols:
+            if col not in category_df.columns:
+                category_df[col] = 0
+        
+        # Model 2 dùng target riêng để tránh ghi đè metrics
+        category_df['category_daily_quantity'] = category_df['daily_quantity']
+        return category_df
 
     def get_tuning_summary(self, target_col: str = None) -> pd.DataFrame:
         """
@@ -1480,7 +2013,7 @@ class SalesForecaster:
         LIMIT {top_n}
         """
         
-        df = self.ch.query(query)
+        df = self.ch.cached_query(query)
         logger.info(f"📊 Đã chọn {len(df)} sản phẩm cần nhập (Top {top_n} theo doanh thu)")
         if len(df) > 0:
             abc_summary = df.groupby('abc_class').size().to_dict()
@@ -1488,7 +2021,47 @@ class SalesForecaster:
                 logger.info(f"   - Loại {cls}: {count} sản phẩm")
         return df
     
-    def predict_next_week(self, use_abc_filter: bool = True, abc_top_n: int = 50, forecast_days: int = 14) -> pd.DataFrame:
+    def train_sharded_models(self, df_features: pd.DataFrame, shard_by: str, n_trials: int,
+                             tuning_strategy: str = 'full') -> Optional[ShardedModel]:
+        """
+        Train Model 1 theo segment (shard_by) trong các worker processes song song.
+        Mỗi shard nhận số trials tỉ lệ với số dòng; metrics gộp (trung bình theo số dòng)
+        lưu ở self.metrics['daily_quantity_shards'].
+        """
+        if shard_by not in SHARD_COLUMNS:
+            logger.warning(f"⚠️ shard_by '{shard_by}' không hợp lệ (chọn: {SHARD_COLUMNS})")
+            return None
+        labels = segment_labels(df_features, shard_by, self.encoders)
+        plan = plan_shards(labels, n_trials)
+        for shard, spec in plan.items():
+            logger.info(f"   🧩 Shard {shard}: {len(spec['rows']):,} dòng, {spec['n_trials']} trials")
+        
+        shard_args = {
+            shard: (self.model_dir, shard, df_features.iloc[spec['rows']], spec['n_trials'], tuning_strategy)
+            for shard, spec in plan.items()
+        }
+        results = run_shards_parallel(_train_shard, shard_args)
+        if not results:
+            return None
+        
+        models = {shard: model for shard, (model, _) in results.items()}
+        shard_metrics = {shard: metrics for shard, (_, metrics) in results.items()}
+        weights = {shard: len(plan[shard]['rows']) for shard in results}
+        summary = {'tuning_method': 'optuna', 'primary_metric': 'mdape', 'shard_by': shard_by,
+                   'shards': shard_metrics}
+        for key in ('cv_mdape', 'val_mdape', 'val_mape', 'val_mae', 'val_rmse'):
+            values = [(m[key], weights[s]) for s, m in shard_metrics.items()
+                      if isinstance(m.get(key), (int, float)) and np.isfinite(m[key])]
+            if values:
+                summary[key] = float(np.average([v for v, _ in values], weights=[w for _, w in values]))
+        self.metrics['daily_quantity_shards'] = summary
+        sharded = ShardedModel(shard_by, models)
+        # Feature columns của Model 1 (các shard train trên cùng tập cột)
+        self.feature_cols = list(sharded.feature_names_in_)
+        return sharded
+    
+    def predict_next_week(self, use_abc_filter: bool = True, abc_top_n: int = 50, forecast_days: int = 14,
+                          forecast_mode: str = 'recursive') -> pd.DataFrame:
         """
         Dự báo cho tuần tới với batch query và ABC-based product selection.
         Sử dụng Model 1 (product_quantity).
@@ -1497,20 +2070,23 @@ class SalesForecaster:
             use_abc_filter: Nếu True, chỉ dự báo cho Top N sản phẩm cần nhập (mặc định: 50)
             abc_top_n: Số sản phẩm cần nhập để dự báo (mặc định: 50)
             forecast_days: Số ngày dự báo (mặc định: 14 ngày = 2 tuần)
+            forecast_mode: 'recursive' (mặc định) hoặc 'direct' - dùng model
+                           product_quantity_direct, dự báo tất cả horizon trong 1 batch
         
         Returns:
             DataFrame với dự báo cho forecast_days ngày tới
         """
-        # Load models nếu chưa có
-        if not self.models:
-            for name in ['product_quantity', 'category_trend']:
-                model_path = os.path.join(self.model_dir, f'{name}_model.pkl')
-                if os.path.exists(model_path):
-                    self.models[name] = joblib.load(model_path)
-                    logger.info(f"✅ Loaded model: {name}")
+        # Load các models chưa có trong self.models
+        self._load_models_if_exist()
         
-        if 'product_quantity' not in self.models:
+        sharded = self.models.get('product_quantity_shards')
+        if 'product_quantity' not in self.models and sharded is None:
             raise ValueError("Model 'product_quantity' chưa được train hoặc load!")
+        if forecast_mode not in FORECAST_MODES:
+            raise ValueError(f"forecast_mode không hợp lệ: {forecast_mode} (chọn: {FORECAST_MODES})")
+        if forecast_mode == 'direct' and 'product_quantity_direct' not in self.models:
+            logger.warning("⚠️ Chưa có model 'product_quantity_direct' - chuyển sang recursive forecast")
+            forecast_mode = 'recursive'
         
         # Tạo future dates (14 ngày tới = 2 tuần)
         future_dates = pd.date_range(
@@ -1539,7 +2115,7 @@ class SalesForecaster:
             WHERE transaction_date >= today() - 30
             """
             try:
-                all_products = self.ch.query(products_query)
+                all_products = self.ch.cached_query(products_query)
                 product_list = all_products['ma_hang'].tolist()
                 logger.info(f"✅ Loaded {len(product_list)} products from fct_regular_sales")
             except Exception as e:
@@ -1553,7 +2129,7 @@ class SalesForecaster:
                   AND lower(p.category_level_1) NOT LIKE '%khuyến mại%'
                   AND lower(p.category_level_1) NOT LIKE '%khuyen mai%'
                 """
-                all_products = self.ch.query(products_query)
+                all_products = self.ch.cached_query(products_query)
                 product_list = all_products['ma_hang'].tolist()
             product_abc_map = {}
         
@@ -1573,7 +2149,7 @@ class SalesForecaster:
         WHERE database = 'retail_dw' AND name = 'int_dynamic_seasonal_factor'
         """
         try:
-            seasonal_table_exists = self.ch.query(check_query).iloc[0, 0] > 0
+            seasonal_table_exists = self.ch.cached_query(check_query).iloc[0, 0] > 0
         except:
             seasonal_table_exists = False
         
@@ -1595,7 +2171,7 @@ class SalesForecaster:
             GROUP BY month
             """
             try:
-                seasonal_df = self.ch.query(seasonal_query)
+                seasonal_df = self.ch.cached_query(seasonal_query)
                 # Tạo mapping từ month -> seasonal factors
                 seasonal_map = {}
                 for _, row in seasonal_df.iterrows():
@@ -1620,12 +2196,12 @@ class SalesForecaster:
         # BƯỚC 2b: Batch query - Lấy toàn bộ dữ liệu lịch sử từ fct_regular_sales (Cách 2B)
         logger.info("📥 Đang tải dữ liệu lịch sử từ fct_regular_sales + JOIN seasonal...")
         
-        # Tạo chuỗi product codes cho SQL IN clause
-        product_codes_str = "', '".join(str(p) for p in product_list)
+        # Tập mã sản phẩm gửi dạng external table (không dựng chuỗi IN literal)
+        product_set = product_set_table(product_list)
         
         # Sử dụng Cách 2B: fct_regular_sales + LEFT JOIN int_dynamic_seasonal_factor
         if seasonal_table_exists:
-            history_query = f"""
+            history_query = """
             SELECT 
                 f.transaction_date as ngay,
                 f.branch_code as chi_nhanh,
@@ -1660,13 +2236,13 @@ class SalesForecaster:
                 FROM retail_dw.int_dynamic_seasonal_factor
                 GROUP BY month
             ) s ON toMonth(f.transaction_date) = s.month
-            WHERE f.product_code IN ('{product_codes_str}')
+            WHERE f.product_code IN (SELECT product_code FROM product_set)
               AND f.transaction_date >= today() - 60
             ORDER BY f.branch_code, f.product_code, f.transaction_date
             """
         else:
             # Fallback nếu bảng mới chưa tồn tại
-            history_query = f"""
+            history_query = """
             SELECT 
                 f.transaction_date as ngay,
                 f.branch_code as chi_nhanh,
@@ -1687,12 +2263,12 @@ class SalesForecaster:
                 '' as peak_reason
             FROM retail_dw.fct_regular_sales f
             LEFT JOIN retail_dw.dim_product p ON f.product_code = p.p.product_code
-            WHERE f.product_code IN ('{product_codes_str}')
+            WHERE f.product_code IN (SELECT product_code FROM product_set)
               AND f.transaction_date >= today() - 60
             ORDER BY f.branch_code, f.product_code, f.transaction_date
             """
         
-        history_df = self.ch.query(history_query)
+        history_df = self.ch.query(history_query, external_tables=[product_set])
         history_df['ngay'] = pd.to_datetime(history_df['ngay'])
         
         # VALIDATION: Chỉ giữ lại records có dữ liệu (giữ cả daily_quantity = 0)
@@ -1724,7 +2300,9 @@ class SalesForecaster:
         logger.info("🔧 Đang tạo features cho dự báo...")
         
         # Lấy danh sách unique (chi_nhanh, ma_hang, ten_san_pham, categories)
-        branch_products = history_df[['chi_nhanh', 'ma_hang', 'ten_san_pham', 'nhom_hang_cap_1', 'nhom_hang_cap_2']].drop_duplicates()
+        history_df = history_df.sort_values(['chi_nhanh', 'ma_hang', 'ngay'], kind='mergesort').reset_index(drop=True)
+        branch_products = history_df[['chi_nhanh', 'ma_hang', 'ten_san_pham', 'nhom_hang_cap_1', 'nhom_hang_cap_2']] \
+            .drop_duplicates(subset=['chi_nhanh', 'ma_hang']).reset_index(drop=True)
         
         # Tính category averages cho cold start fallback
         logger.info("📊 Tính category averages cho cold start fallback...")
@@ -1752,187 +2330,122 @@ class SalesForecaster:
         
         forecasts = []
         cold_start_products = []
-        model_features = list(self.models['product_quantity'].feature_names_in_)
+        model_features = list((sharded or self.models['product_quantity']).feature_names_in_)
+        
+        # BƯỚC 4: Phát hiện cold start cho tất cả (branch, product) cùng lúc
+        # 1. Nếu ít hơn 2 ngày dữ liệu
+        # 2. Hoặc ít hơn 7 ngày và tất cả đều có cùng giá trị (dữ liệu đồng nhất bất thường - có thể là outliers)
+        # 3. Hoặc dữ liệu quá thưa (sparse): < 5% ngày có dữ liệu trong toàn bộ khoảng thời gian
+        series_stats = history_df.groupby(['chi_nhanh', 'ma_hang'], sort=False).agg(
+            n_days=('ngay', 'size'),
+            n_unique_qty=('daily_quantity', 'nunique'),
+            first_qty=('daily_quantity', 'first'),
+            min_date=('ngay', 'min'),
+            max_date=('ngay', 'max')
+        ).reset_index().merge(branch_products, on=['chi_nhanh', 'ma_hang'], how='left')
+        series_stats['date_range_days'] = (series_stats['max_date'] - series_stats['min_date']).dt.days + 1
+        series_stats['data_sparsity'] = series_stats['n_days'] / series_stats['date_range_days']
+        series_stats['is_uniform_outlier'] = (series_stats['n_days'] < 7) & (series_stats['n_unique_qty'] == 1)
+        series_stats['is_sparse_data'] = (
+            (series_stats['n_days'] >= 2) & (series_stats['data_sparsity'] < 0.05) & (series_stats['n_days'] < 10)
+        )
+        series_stats['is_cold_start'] = (
+            (series_stats['n_days'] < 2) | series_stats['is_uniform_outlier'] | series_stats['is_sparse_data']
+        )
         
-        # BƯỚC 4: Xử lý từng (branch, product) trong memory (không query DB nữa)
-        for _, bp in branch_products.iterrows():
-            branch = bp['chi_nhanh']
+        created_at = datetime.now()
+        for _, bp in series_stats[series_stats['is_cold_start']].iterrows():
             product = bp['ma_hang']
-            product_name = bp['ten_san_pham']
             cat1 = bp['nhom_hang_cap_1']
-            cat2 = bp['nhom_hang_cap_2']
-            
-            # Lấy lịch sử của sản phẩm này
-            product_history = history_df[
-                (history_df['chi_nhanh'] == branch) & 
-                (history_df['ma_hang'] == product)
-            ].sort_values('ngay').reset_index(drop=True)
-            
-            # COLD START HANDLING: 
-            # 1. Nếu ít hơn 2 ngày dữ liệu
-            # 2. Hoặc ít hơn 7 ngày và tất cả đều có cùng giá trị (dữ liệu đồng nhất bất thường - có thể là outliers)
-            # 3. Hoặc dữ liệu quá thưa (sparse): < 5% ngày có dữ liệu trong toàn bộ khoảng thờ i gian
-            is_uniform_outlier = (len(product_history) < 7 and product_history['daily_quantity'].nunique() == 1)
-            
-            # Tính sparsity: tỷ lệ ngày có dữ liệu / tổng ngày trong range
-            if len(product_history) >= 2:
-                date_range_days = (product_history['ngay'].max() - product_history['ngay'].min()).days + 1
-                data_sparsity = len(product_history) / date_range_days if date_range_days > 0 else 1.0
-                is_sparse_data = data_sparsity < 0.05 and len(product_history) < 10  # < 5% và < 10 ngày
+            if bp['is_uniform_outlier']:
+                logger.warning(f"   ⚠️ Uniform outlier detected: {product} has {bp['n_days']} days with same value {bp['first_qty']}. Using capped category median.")
+                # Cap category median cho uniform outliers để tránh giá trị quá cao
+                cat_median = min(category_stats_dict.get(cat1, 10), 50)  # Max 50 cho uniform outliers
+            elif bp['is_sparse_data']:
+                logger.warning(f"   ⚠️ Sparse data detected: {product} has only {bp['n_days']} days in {bp['date_range_days']} days range ({bp['data_sparsity']*100:.1f}% sparsity). Using category median.")
+                cat_median = category_stats_dict.get(cat1, 10)  # Default 10 nếu không tìm thấy category
             else:
-                is_sparse_data = False
-            
-            if len(product_history) < 2 or is_uniform_outlier or is_sparse_data:
-                if is_uniform_outlier:
-                    logger.warning(f"   ⚠️ Uniform outlier detected: {product} has {len(product_history)} days with same value {product_history['daily_quantity'].iloc[0]}. Using capped category median.")
-                    # Cap category median cho uniform outliers để tránh giá trị quá cao
-                    cat_median = min(category_stats_dict.get(cat1, 10), 50)  # Max 50 cho uniform outliers
-                elif is_sparse_data:
-                    logger.warning(f"   ⚠️ Sparse data detected: {product} has only {len(product_history)} days in {date_range_days} days range ({data_sparsity*100:.1f}% sparsity). Using category median.")
-                    cat_median = category_stats_dict.get(cat1, 10)  # Default 10 nếu không tìm thấy category
-                else:
-                    cat_median = category_stats_dict.get(cat1, 10)  # Default 10 nếu không tìm thấy category
-                cold_start_products.append({
-                    'branch': branch,
-                    'product': product,
-                    'category': cat1,
-                    'fallback_quantity': cat_median
-                })
-                
-                # Tạo dự báo đơn giản dựa trên category median
-                for future_date in future_dates:
-                    month = future_date.month
-                    sf = seasonal_map.get(month, {})
-                    seasonal_factor = sf.get('seasonal_factor', 1.0)
-                    
-                    # Áp dụng seasonal factor vào category median
-                    # cat_median đã là daily median, không cần chia 7
-                    predicted_qty = max(0, cat_median * seasonal_factor)
-                    
-                    forecasts.append({
-                        'forecast_date': future_date.date(),
-                        'chi_nhanh': branch,
-                        'ma_hang': product,
-                        'ten_san_pham': product_name,
-                        'nhom_hang_cap_1': cat1,
-                        'nhom_hang_cap_2': cat2,
-                        'abc_class': product_abc_map.get(product, 'Unknown'),
-                        'predicted_quantity': round(predicted_qty),
-                        'predicted_quantity_raw': float(predicted_qty),
-                        'predicted_profit_margin': None,
-                        'confidence_lower': predicted_qty * 0.5,
-                        'confidence_upper': predicted_qty * 1.5,
-                        'created_at': datetime.now(),
-                        'is_cold_start': True  # Flag để đánh dấu
-                    })
-                continue  # Skip phần dự báo bình thường
-            
-            # Dự báo cho từng ngày trong tương lai (RECURSIVE FORECAST)
-            # Sau mỗi ngày dự báo, cập nhật kết quả vào product_history để tính lag đúng
-            predicted_values = {}  # Lưu các giá trị đã dự báo: {date: quantity}
+                cat_median = category_stats_dict.get(cat1, 10)  # Default 10 nếu không tìm thấy category
+            cold_start_products.append({
+                'branch': bp['chi_nhanh'],
+                'product': product,
+                'category': cat1,
+                'fallback_quantity': cat_median
+            })
             
+            # Tạo dự báo đơn giản dựa trên category median
             for future_date in future_dates:
-                try:
-                    # Lấy seasonal factors cho ngày này
-                    month = future_date.month
-                    sf = seasonal_map.get(month, {})
-                    is_peak = 1 if sf.get('peak_reason') else 0
-                    
-                    # Cập nhật product_history với các giá trị đã dự báo trước đó trong tuần
-                    # Điều này đảm bảo lag features được tính đúng
-                    if predicted_values:
-                        for pred_date, pred_qty in predicted_values.items():
-                            # Tìm và cập nhật hoặc thêm vào product_history
-                            mask = product_history['ngay'] == pred_date
-                            if mask.any():
-                                product_history.loc[mask, 'daily_quantity'] = pred_qty
-                            else:
-                                # Thêm row mới với giá trị dự báo
-                                new_row = pd.DataFrame({
-                                    'ngay': [pred_date],
-                                    'chi_nhanh': [branch],
-                                    'ma_hang': [product],
-                                    'ten_san_pham': [product_name],
-                                    'nhom_hang_cap_1': [cat1],
-                                    'nhom_hang_cap_2': [cat2],
-                                    'daily_quantity': [pred_qty],
-                                    'daily_revenue': [0],  # Không dùng cho dự báo
-                                    'daily_profit': [0],
-                                    'transaction_count': [0],
-                                    'is_peak_day': [is_peak],
-                                    'seasonal_factor': [sf.get('seasonal_factor', 1.0)],
-                                    'revenue_factor': [sf.get('revenue_factor', 1.0)],
-                                    'quantity_factor': [sf.get('quantity_factor', 1.0)],
-                                    'peak_reason': [sf.get('peak_reason', '')]
-                                })
-                                product_history = pd.concat([product_history, new_row], ignore_index=True)
-                    
-                    # Tạo row cho ngày cần dự báo (daily_quantity = 0, sẽ được dự báo)
-                    future_row = pd.DataFrame({
-                        'ngay': [future_date],
-                        'chi_nhanh': [branch],
-                        'ma_hang': [product],
-                        'ten_san_pham': [product_name],
-                        'nhom_hang_cap_1': [cat1],
-                        'nhom_hang_cap_2': [cat2],
-                        'daily_quantity': [0],  # Sẽ được dự báo
-                        'daily_revenue': [0],
-                        'daily_profit': [0],
-                        'transaction_count': [0],
-                        'is_peak_day': [is_peak],
-                        'seasonal_factor': [sf.get('seasonal_factor', 1.0)],
-                        'revenue_factor': [sf.get('revenue_factor', 1.0)],
-                        'quantity_factor': [sf.get('quantity_factor', 1.0)],
-                        'peak_reason': [sf.get('peak_reason', '')]
-                    })
-                    
-                    # Kết hợp lịch sử (đã cập nhật với dự báo trước) + ngày cần dự báo
-                    combined = pd.concat([product_history, future_row], ignore_index=True)
-                    combined['ngay'] = pd.to_datetime(combined['ngay'])
-                    combined = combined.sort_values('ngay').reset_index(drop=True)
-                    
-                    # Tạo features với prediction_mode=True (chỉ dùng lag >= 7)
-                    combined_features = self.create_features(combined, prediction_mode=True)
-                    
-                    # Lấy row cho ngày cần dự báo
-                    pred_row = combined_features[combined_features['ngay'] == future_date]
-                    
-                    if len(pred_row) == 0:
-                        continue
-                    
-                    # Chuẩn bị features cho model (chỉ lấy các cột model cần)
-                    X_pred = pd.DataFrame(0, index=[0], columns=model_features)
-                    for col in model_features:
-                        if col in pred_row.columns:
-                            X_pred[col] = pred_row[col].fillna(0).values
-                    
-                    # Dự báo với Model 1 (Quantity) - clip để không âm
-                    quantity_pred = max(0, self.models['product_quantity'].predict(X_pred)[0])
-                    
-                    # Lưu giá trị dự báo để dùng cho ngày tiếp theo (recursive)
-                    predicted_values[future_date] = quantity_pred
-                    
-                    forecasts.append({
-                        'forecast_date': future_date.date(),
-                        'chi_nhanh': branch,
-                        'ma_hang': product,
-                        'ten_san_pham': product_name,
-                        'nhom_hang_cap_1': cat1,
-                        'nhom_hang_cap_2': cat2,
-                        'abc_class': product_abc_map.get(product, 'Unknown'),
-                        'predicted_quantity': round(quantity_pred),
-                        'predicted_quantity_raw': float(quantity_pred),
-                        'predicted_profit_margin': None,
-                        'confidence_lower': quantity_pred * 0.8,
-                        'confidence_upper': quantity_pred * 1.2,
-                        'created_at': datetime.now()
-                    })
-                    
-                except Exception as e:
-                    logger.debug(f"Lỗi dự báo cho {branch}/{product} ngày {future_date}: {e}")
-                    continue
+                seasonal_factor = seasonal_map.get(future_date.month, {}).get('seasonal_factor', 1.0)
+                
+                # Áp dụng seasonal factor vào category median
+                # cat_median đã là daily median, không cần chia 7
+                predicted_qty = max(0, cat_median * seasonal_factor)
+                
+                forecasts.append({
+                    'forecast_date': future_date.date(),
+                    'chi_nhanh': bp['chi_nhanh'],
+                    'ma_hang': product,
+                    'ten_san_pham': bp['ten_san_pham'],
+                    'nhom_hang_cap_1': cat1,
+                    'nhom_hang_cap_2': bp['nhom_hang_cap_2'],
+                    'abc_class': product_abc_map.get(product, 'Unknown'),
+                    'predicted_quantity': round(predicted_qty),
+                    'predicted_quantity_raw': float(predicted_qty),
+                    'predicted_profit_margin': None,
+                    'confidence_lower': predicted_qty * 0.5,
+                    'confidence_upper': predicted_qty * 1.5,
+                    'created_at': created_at,
+                    'is_cold_start': True  # Flag để đánh dấu
+                })
+        
+        # BƯỚC 5: FORECAST cho tất cả series còn lại cùng lúc
+        # - recursive: mỗi ngày dự báo 1 feature matrix + 1 lần predict, giá trị dự báo
+        #   được nối vào lịch sử để tính lag/rolling cho ngày tiếp theo
+        # - direct: 1 lần predict cho tất cả series × horizon
+        warm_series = series_stats.loc[~series_stats['is_cold_start'], ['chi_nhanh', 'ma_hang']]
+        warm_history = history_df.merge(warm_series, on=['chi_nhanh', 'ma_hang'], how='inner')
+        if len(warm_history) > 0:
+            if forecast_mode == 'direct':
+                engine = DirectMultiHorizonForecaster(self.models['product_quantity_direct'], self.create_features)
+                warm_forecasts = engine.forecast(warm_history, future_dates, seasonal_map=seasonal_map)
+            elif sharded is not None:
+                # Router: mỗi series được dự báo bằng model của shard (segment) của nó
+                shard_forecasts = []
+                for shard, model, shard_history in sharded.groups(warm_history, self.get_encoders()):
+                    engine = BatchRecursiveForecaster(model, list(model.feature_names_in_),
+                                                      encoders=self.get_encoders())
+                    shard_forecasts.append(engine.forecast(shard_history, future_dates, seasonal_map=seasonal_map))
+                    logger.info(f"   🧩 Shard {shard}: {shard_history.groupby(['chi_nhanh', 'ma_hang']).ngroups} series")
+                warm_forecasts = pd.concat(shard_forecasts, ignore_index=True)
+            else:
+                engine = BatchRecursiveForecaster(self.models['product_quantity'], model_features,
+                                                  encoders=self.get_encoders())
+                warm_forecasts = engine.forecast(warm_history, future_dates, seasonal_map=seasonal_map)
+            warm_forecasts = warm_forecasts.merge(
+                branch_products[['chi_nhanh', 'ma_hang', 'ten_san_pham', 'nhom_hang_cap_1', 'nhom_hang_cap_2']],
+                on=['chi_nhanh', 'ma_hang'],
+                how='left'
+            )
+            quantity_pred = warm_forecasts.pop('predicted_quantity_raw')
+            warm_forecasts['forecast_date'] = warm_forecasts['forecast_date'].dt.date
+            warm_forecasts['abc_class'] = warm_forecasts['ma_hang'].map(product_abc_map).fillna('Unknown')
+            warm_forecasts['predicted_quantity'] = np.round(quantity_pred).astype(int)
+            warm_forecasts['predicted_quantity_raw'] = quantity_pred.astype(float)
+            warm_forecasts['predicted_profit_margin'] = None
+            warm_forecasts['confidence_lower'] = quantity_pred * 0.8
+            warm_forecasts['confidence_upper'] = quantity_pred * 1.2
+            warm_forecasts['created_at'] = created_at
+            warm_forecasts = warm_forecasts[[
+                'forecast_date', 'chi_nhanh', 'ma_hang', 'ten_san_pham', 'nhom_hang_cap_1', 'nhom_hang_cap_2',
+                'abc_class', 'predicted_quantity', 'predicted_quantity_raw', 'predicted_profit_margin',
+                'confidence_lower', 'confidence_upper', 'created_at'
+            ]]
+            forecasts.extend(warm_forecasts.to_dict('records'))
         
         forecasts_df = pd.DataFrame(forecasts)
+        if len(forecasts_df) > 0:
+            forecasts_df = forecasts_df.sort_values(['chi_nhanh', 'ma_hang', 'forecast_date'], kind='mergesort') \
+                .reset_index(drop=True)
         
         if len(forecasts_df) > 0:
             logger.info(f"✅ Đã tạo {len(forecasts_df)} dự báo thành công")
@@ -1980,6 +2493,145 @@ class SalesForecaster:
         
         return forecasts_df
     
+    def _run_category_trend_model(self) -> Optional[pd.DataFrame]:
+        """Model 2 cho email report: None nếu lỗi hoặc không có dữ liệu"""
+        logger.info("📊 Chạy Model 2: Category Trend Forecast...")
+        try:
+            category_forecasts = self.predict_category_trend(days=7)
+            if not category_forecasts.empty:
+                logger.info(f"✅ Model 2: {len(category_forecasts)} category forecasts")
+                return category_forecasts
+            logger.warning("⚠️ Model 2: Không có dữ liệu dự báo")
+        except Exception as e:
+            logger.error(f"❌ Lỗi khi chạy Model 2: {e}")
+        return None
+    
+    def _query_last_week_sales(self, product_set: Dict) -> pd.DataFrame:
+        """Doanh số tuần trước (tuần đầy đủ gần nhất có dữ liệu) theo sản phẩm"""
+        logger.info("📊 Query doanh số tuần trước cho email report...")
+        # Lấy tuần mới nhất có dữ liệu để tính "tuần trước" chính xác
+        # Query tất cả các tuần có dữ liệu, sắp xếp theo năm-tuần giảm dần
+        current_week_query = """
+        SELECT DISTINCT
+            toYear(transaction_date) as year,
+            toWeek(transaction_date, 1) as week
+        FROM retail_dw.fct_regular_sales
+        ORDER BY year DESC, week DESC
+        LIMIT 2
+        """
+        week_result = self.ch.cached_query(current_week_query)
+        if week_result is not None and len(week_result) >= 2:
+            # Tuần mới nhất có dữ liệu
+            current_week = int(week_result.iloc[0]['week'])
+            current_year = int(week_result.iloc[0]['year'])
+            # Tuần trước (tuần thứ 2 trong kết quả)
+            last_week = int(week_result.iloc[1]['week'])
+            last_year = int(week_result.iloc[1]['year'])
+            logger.info(f"   Tuần gần nhất có dữ liệu: {current_year}-W{current_week:02d}")
+            logger.info(f"   Tuần trước (so sánh): {last_year}-W{last_week:02d}")
+        elif week_result is not None and len(week_result) == 1:
+            # Chỉ có 1 tuần dữ liệu, dùng tuần đó làm tuần trước
+            last_week = int(week_result.iloc[0]['week'])
+            last_year = int(week_result.iloc[0]['year'])
+            logger.warning(f"   Chỉ có 1 tuần dữ liệu: {last_year}-W{last_week:02d}")
+        else:
+            # Fallback: dùng 7 ngày trước
+            logger.warning("   Không lấy được tuần dữ liệu, dùng 7 ngày gần nhất")
+            last_week = None
+        
+        # Query theo tuần hoặc 7 ngày gần nhất
+        if last_week is not None:
+            # Query theo tuần (từ thứ 2 đến chủ nhật tuần trước) - dùng toWeek(..., 1) cho Monday-based week
+            last_week_query = f"""
+            SELECT 
+                f.product_code as ma_hang,
+                SUM(f.quantity_sold) as last_week_sales
+            FROM retail_dw.fct_regular_sales f
+            WHERE f.product_code IN (SELECT product_code FROM product_set)
+              AND toYear(f.transaction_date) = {last_year}
+              AND toWeek(f.transaction_date, 1) = {last_week}
+            GROUP BY f.product_code
+            """
+            logger.info(f"   Query tuần {last_year}-W{last_week:02d}")
+        else:
+            # Fallback: 7 ngày gần nhất có dữ liệu
+            last_week_query = """
+            SELECT 
+                f.product_code as ma_hang,
+                SUM(f.quantity_sold) as last_week_sales
+            FROM retail_dw.fct_regular_sales f
+            WHERE f.product_code IN (SELECT product_code FROM product_set)
+              AND f.transaction_date >= (
+                  SELECT MAX(transaction_date) - INTERVAL 7 DAY 
+                  FROM retail_dw.fct_regular_sales
+              )
+              AND f.transaction_date < (
+                  SELECT MAX(transaction_date) 
+                  FROM retail_dw.fct_regular_sales
+              )
+            GROUP BY f.product_code
+            """
+            logger.info("   Query 7 ngày gần nhất có dữ liệu")
+        
+        return self.ch.query(last_week_query, external_tables=[product_set])
+    
+    def _add_order_inputs(self, forecasts: pd.DataFrame) -> pd.DataFrame:
+        """
+        Thêm last_week_sales và ton_kho_nho_nhat (tồn kho hiện tại) cho forecasts chưa qua
+        enrichment của save_forecasts (vd. predict_next_week toàn bộ catalog), để lượng cần
+        nhập = dự báo × 1.5 - bán tuần qua - tồn kho không bỏ qua tồn kho.
+        
+        Query lỗi → raise (không mặc định 0, tránh đơn hàng bị thổi phồng).
+        """
+        missing = [col for col in ('last_week_sales', 'ton_kho_nho_nhat') if col not in forecasts.columns]
+        if not missing:
+            return forecasts
+        product_set = product_set_table(forecasts['ma_hang'].unique())
+        queries = {'last_week_sales': self._query_last_week_sales, 'ton_kho_nho_nhat': self._query_current_inventory}
+        logger.info(f"📊 Query {', '.join(missing)} cho {forecasts['ma_hang'].nunique():,} sản phẩm...")
+        with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='enrich') as pool:
+            futures = {col: pool.submit(queries[col], product_set) for col in missing}
+            results = {col: future.result() for col, future in futures.items()}
+        forecasts = forecasts.copy()
+        for col, result in results.items():
+            values = pd.Series(pd.to_numeric(result[col], errors='coerce').to_numpy(),
+                               index=result['ma_hang'].astype(str)) if not result.empty else pd.Series(dtype=float)
+            values = values[~values.index.duplicated(keep='last')]
+            # Sản phẩm không có trong kết quả = không bán tuần trước / không còn tồn kho
+            forecasts[col] = forecasts['ma_hang'].astype(str).map(values).fillna(0).to_numpy()
+            logger.info(f"✅ Đã thêm {col} cho {len(values):,} sản phẩm")
+        return forecasts
+    
+    def _query_sales_4weeks(self, product_set: Dict) -> pd.DataFrame:
+        """Doanh số 4 tuần gần nhất theo sản phẩm"""
+        sales_4weeks_query = """
+        SELECT 
+            product_code as ma_hang,
+            SUM(quantity_sold) as sales_4weeks
+        FROM retail_dw.fct_regular_sales
+        WHERE product_code IN (SELECT product_code FROM product_set)
+          AND transaction_date >= today() - INTERVAL 28 DAY
+        GROUP BY product_code
+        """
+        return self.ch.query(sales_4weeks_query, external_tables=[product_set])
+    
+    def _query_current_inventory(self, product_set: Dict) -> pd.DataFrame:
+        """Tồn kho mới nhất (snapshot 7 ngày gần nhất) theo sản phẩm"""
+        inventory_query = """
+        SELECT 
+            p.product_code as ma_hang,
+            argMax(i.stock_quantity, i.snapshot_date) as ton_kho_nho_nhat
+        FROM retail_dw.dim_product p
+        LEFT JOIN (
+            SELECT product_code, stock_quantity, snapshot_date
+            FROM retail_dw.staging_inventory_transactions
+            WHERE snapshot_date >= today() - INTERVAL 7 DAY
+        ) i ON p.product_code = i.product_code
+        WHERE p.product_code IN (SELECT product_code FROM product_set)
+        GROUP BY p.product_code
+        """
+        return self.ch.query(inventory_query, external_tables=[product_set])
+    
     def save_forecasts(self, forecasts: pd.DataFrame, send_email: bool = True):
         """Lưu dự báo vào database và gửi email thông báo"""
         # Tạo bảng nếu chưa có - Schema đầy đủ các cột
@@ -2044,238 +2696,146 @@ class SalesForecaster:
                 n_products = forecasts['ma_hang'].nunique() if 'ma_hang' in forecasts.columns else 0
                 logger.info(f"📧 Đang gửi email forecast report với {len(forecasts)} records, {n_products} sản phẩm...")
                 
-                # CHẠY MODEL 2: Category Trend Forecast
-                logger.info("📊 Chạy Model 2: Category Trend Forecast...")
-                try:
-                    category_forecasts = self.predict_category_trend(days=7)
-                    if not category_forecasts.empty:
-                        logger.info(f"✅ Model 2: {len(category_forecasts)} category forecasts")
-                    else:
-                        logger.warning("⚠️ Model 2: Không có dữ liệu dự báo")
-                        category_forecasts = None
-                except Exception as e:
-                    logger.error(f"❌ Lỗi khi chạy Model 2: {e}")
-                    category_forecasts = None
+                # Các query enrichment độc lập chạy song song trên pool connections:
+                # Model 2, doanh số tuần trước, 4 tuần, tồn kho (rồi khuyến nghị tồn kho)
+                with ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, thread_name_prefix='enrich') as enrichment_pool:
+                    product_set = product_set_table(forecasts['ma_hang'].unique())
+                    logger.info(f"📊 Chạy song song ({ENRICHMENT_WORKERS} workers): Model 2 Category Trend, "
+                                f"doanh số tuần trước, doanh số 4 tuần, tồn kho hiện tại...")
+                    category_future = enrichment_pool.submit(self._run_category_trend_model)
+                    last_week_future = enrichment_pool.submit(self._query_last_week_sales, product_set)
+                    sales_4weeks_future = enrichment_pool.submit(self._query_sales_4weeks, product_set)
+                    inventory_future = enrichment_pool.submit(self._query_current_inventory, product_set)
                 
-                # THÊM DỮ LIỆU BÁN TUẦN TRƯỚC cho email report
-                logger.info("📊 Query doanh số tuần trước cho email report...")
-                try:
-                    product_list = forecasts['ma_hang'].unique().tolist()
-                    products_str = "', '".join(str(p) for p in product_list)
-                    
-                    # Lấy tuần mới nhất có dữ liệu để tính "tuần trước" chính xác
-                    # Query tất cả các tuần có dữ liệu, sắp xếp theo năm-tuần giảm dần
-                    current_week_query = """
-                    SELECT DISTINCT
-                        toYear(transaction_date) as year,
-                        toWeek(transaction_date, 1) as week
-                    FROM retail_dw.fct_regular_sales
-                    ORDER BY year DESC, week DESC
-                    LIMIT 2
-                    """
-                    week_result = self.ch.query(current_week_query)
-                    if week_result is not None and len(week_result) >= 2:
-                        # Tuần mới nhất có dữ liệu
-                        current_week = int(week_result.iloc[0]['week'])
-                        current_year = int(week_result.iloc[0]['year'])
-                        # Tuần trước (tuần thứ 2 trong kết quả)
-                        last_week = int(week_result.iloc[1]['week'])
-                        last_year = int(week_result.iloc[1]['year'])
-                        logger.info(f"   Tuần gần nhất có dữ liệu: {current_year}-W{current_week:02d}")
-                        logger.info(f"   Tuần trước (so sánh): {last_year}-W{last_week:02d}")
-                    elif week_result is not None and len(week_result) == 1:
-                        # Chỉ có 1 tuần dữ liệu, dùng tuần đó làm tuần trước
-                        last_week = int(week_result.iloc[0]['week'])
-                        last_year = int(week_result.iloc[0]['year'])
-                        logger.warning(f"   Chỉ có 1 tuần dữ liệu: {last_year}-W{last_week:02d}")
-                    else:
-                        # Fallback: dùng 7 ngày trước
-                        logger.warning("   Không lấy được tuần dữ liệu, dùng 7 ngày gần nhất")
-                        last_week = None
-                    
-                    # Query theo tuần hoặc 7 ngày gần nhất
-                    if last_week is not None:
-                        # Query theo tuần (từ thứ 2 đến chủ nhật tuần trước) - dùng toWeek(..., 1) cho Monday-based week
-                        last_week_query = f"""
-                        SELECT 
-                            f.product_code as ma_hang,
-                            SUM(f.quantity_sold) as last_week_sales
-                        FROM retail_dw.fct_regular_sales f
-                        WHERE f.product_code IN ('{products_str}')
-                          AND toYear(f.transaction_date) = {last_year}
-                          AND toWeek(f.transaction_date, 1) = {last_week}
-                        GROUP BY f.product_code
-                        """
-                        logger.info(f"   Query tuần {last_year}-W{last_week:02d}")
-                    else:
-                        # Fallback: 7 ngày gần nhất có dữ liệu
-                        last_week_query = f"""
-                        SELECT 
-                            f.product_code as ma_hang,
-                            SUM(f.quantity_sold) as last_week_sales
-                        FROM retail_dw.fct_regular_sales f
-                        WHERE f.product_code IN ('{products_str}')
-                          AND f.transaction_date >= (
-                              SELECT MAX(transaction_date) - INTERVAL 7 DAY 
-                              FROM retail_dw.fct_regular_sales
-                          )
-                          AND f.transaction_date < (
-                              SELECT MAX(transaction_date) 
-                              FROM retail_dw.fct_regular_sales
-                          )
-                        GROUP BY f.product_code
-                        """
-                        logger.info("   Query 7 ngày gần nhất có dữ liệu")
-                    
-                    last_week_df = self.ch.query(last_week_query)
+                    # THÊM DỮ LIỆU BÁN TUẦN TRƯỚC cho email report
+                    try:
+                        last_week_df = last_week_future.result()
                     
-                    if not last_week_df.empty:
-                        forecasts = forecasts.merge(
-                            last_week_df[['ma_hang', 'last_week_sales']], 
-                            on='ma_hang', 
-                            how='left'
-                        )
-                        forecasts['last_week_sales'] = forecasts['last_week_sales'].fillna(0)
-                        logger.info(f"✅ Đã thêm last_week_sales cho {len(last_week_df)} sản phẩm")
-                    else:
-                        logger.warning("⚠️ Không có dữ liệu bán tuần trước")
+                        if not last_week_df.empty:
+                            forecasts = forecasts.merge(
+                                last_week_df[['ma_hang', 'last_week_sales']], 
+                                on='ma_hang', 
+                                how='left'
+                            )
+                            forecasts['last_week_sales'] = forecasts['last_week_sales'].fillna(0)
+                            logger.info(f"✅ Đã thêm last_week_sales cho {len(last_week_df)} sản phẩm")
+                        else:
+                            logger.warning("⚠️ Không có dữ liệu bán tuần trước")
+                            forecasts['last_week_sales'] = 0
+                    except Exception as e:
+                        logger.warning(f"⚠️ Không thể lấy dữ liệu tuần trước: {e}")
                         forecasts['last_week_sales'] = 0
-                except Exception as e:
-                    logger.warning(f"⚠️ Không thể lấy dữ liệu tuần trước: {e}")
-                    forecasts['last_week_sales'] = 0
                 
-                # === LỌC VÀ SẮP XẾP THEO YÊU CẦU MỚI ===
-                logger.info("📊 Áp dụng logic lọc và sắp xếp mới...")
-                try:
-                    # 1. Query doanh số 4 tuần gần nhất cho từng sản phẩm
-                    products_str = "', '".join(str(p) for p in forecasts['ma_hang'].unique())
-                    sales_4weeks_query = f"""
-                    SELECT 
-                        product_code as ma_hang,
-                        SUM(quantity_sold) as sales_4weeks
-                    FROM retail_dw.fct_regular_sales
-                    WHERE product_code IN ('{products_str}')
-                      AND transaction_date >= today() - INTERVAL 28 DAY
-                    GROUP BY product_code
-                    """
-                    sales_4weeks_df = self.ch.query(sales_4weeks_query)
-                    
-                    if not sales_4weeks_df.empty:
-                        forecasts = forecasts.merge(
-                            sales_4weeks_df[['ma_hang', 'sales_4weeks']], 
-                            on='ma_hang', 
-                            how='left'
-                        )
-                        forecasts['sales_4weeks'] = pd.to_numeric(forecasts['sales_4weeks'], errors='coerce').fillna(0)
-                        
-                        # 2. Loại bỏ sản phẩm A-class không có doanh số trong 4 tuần
-                        original_count = len(forecasts)
-                        if 'abc_class' in forecasts.columns:
-                            # Đảm bảo abc_class là string
-                            forecasts['abc_class'] = forecasts['abc_class'].astype(str)
-                            # Giữ lại: B-class, C-class, hoặc A-class có sales_4weeks > 0
-                            mask_keep = (
-                                (forecasts['abc_class'].isin(['B', 'C'])) | 
-                                ((forecasts['abc_class'] == 'A') & (forecasts['sales_4weeks'] > 0))
-                            )
-                            removed_a_class = forecasts[(forecasts['abc_class'] == 'A') & (forecasts['sales_4weeks'] == 0)]
-                            if len(removed_a_class) > 0:
-                                logger.info(f"   🗑️  Loại bỏ {len(removed_a_class)} sản phẩm A-class không có doanh số 4 tuần qua")
-                            forecasts = forecasts[mask_keep].copy()
-                        
-                        logger.info(f"   📊 Còn lại {len(forecasts)}/{original_count} sản phẩm sau khi lọc")
-                    
-                    # 3. Query tồn kho hiện tại (mới nhất)
-                    inventory_query = f"""
-                    SELECT 
-                        p.product_code as ma_hang,
-                        argMax(i.stock_quantity, i.snapshot_date) as ton_kho_nho_nhat
-                    FROM retail_dw.dim_product p
-                    LEFT JOIN (
-                        SELECT product_code, stock_quantity, snapshot_date
-                        FROM retail_dw.staging_inventory_transactions
-                        WHERE snapshot_date >= today() - INTERVAL 7 DAY
-                    ) i ON p.product_code = i.product_code
-                    WHERE p.product_code IN ('{products_str}')
-                    GROUP BY p.product_code
-                    """
+                    # === LỌC VÀ SẮP XẾP THEO YÊU CẦU MỚI ===
+                    logger.info("📊 Áp dụng logic lọc và sắp xếp mới...")
                     try:
-                        inventory_df = self.ch.query(inventory_query)
-                        if not inventory_df.empty:
+                        # 1. Doanh số 4 tuần gần nhất cho từng sản phẩm
+                        sales_4weeks_df = sales_4weeks_future.result()
+                    
+                        if not sales_4weeks_df.empty:
                             forecasts = forecasts.merge(
-                                inventory_df[['ma_hang', 'ton_kho_nho_nhat']], 
+                                sales_4weeks_df[['ma_hang', 'sales_4weeks']], 
                                 on='ma_hang', 
                                 how='left'
                             )
-                            forecasts['ton_kho_nho_nhat'] = forecasts['ton_kho_nho_nhat'].fillna(0)
-                        else:
+                            forecasts['sales_4weeks'] = pd.to_numeric(forecasts['sales_4weeks'], errors='coerce').fillna(0)
+                        
+                            # 2. Loại bỏ sản phẩm A-class không có doanh số trong 4 tuần
+                            original_count = len(forecasts)
+                            if 'abc_class' in forecasts.columns:
+                                # Đảm bảo abc_class là string
+                                forecasts['abc_class'] = forecasts['abc_class'].astype(str)
+                                # Giữ lại: B-class, C-class, hoặc A-class có sales_4weeks > 0
+                                mask_keep = (
+                                    (forecasts['abc_class'].isin(['B', 'C'])) | 
+                                    ((forecasts['abc_class'] == 'A') & (forecasts['sales_4weeks'] > 0))
+                                )
+                                removed_a_class = forecasts[(forecasts['abc_class'] == 'A') & (forecasts['sales_4weeks'] == 0)]
+                                if len(removed_a_class) > 0:
+                                    logger.info(f"   🗑️  Loại bỏ {len(removed_a_class)} sản phẩm A-class không có doanh số 4 tuần qua")
+                                forecasts = forecasts[mask_keep].copy()
+                        
+                            logger.info(f"   📊 Còn lại {len(forecasts)}/{original_count} sản phẩm sau khi lọc")
+                    
+                        # 3. Tồn kho hiện tại (mới nhất)
+                        try:
+                            inventory_df = inventory_future.result()
+                            if not inventory_df.empty:
+                                forecasts = forecasts.merge(
+                                    inventory_df[['ma_hang', 'ton_kho_nho_nhat']], 
+                                    on='ma_hang', 
+                                    how='left'
+                                )
+                                forecasts['ton_kho_nho_nhat'] = forecasts['ton_kho_nho_nhat'].fillna(0)
+                            else:
+                                forecasts['ton_kho_nho_nhat'] = 0
+                        except Exception as e:
+                            logger.warning(f"   ⚠️ Không lấy được dữ liệu tồn kho: {e}")
                             forecasts['ton_kho_nho_nhat'] = 0
-                    except Exception as e:
-                        logger.warning(f"   ⚠️ Không lấy được dữ liệu tồn kho: {e}")
-                        forecasts['ton_kho_nho_nhat'] = 0
                     
-                    # 4. Đảm bảo numeric type trước khi sắp xếp
-                    forecasts['last_week_sales'] = pd.to_numeric(forecasts['last_week_sales'], errors='coerce').fillna(0)
-                    forecasts['ton_kho_nho_nhat'] = pd.to_numeric(forecasts['ton_kho_nho_nhat'], errors='coerce').fillna(0)
-                    forecasts['predicted_quantity'] = pd.to_numeric(forecasts['predicted_quantity'], errors='coerce').fillna(0)
+                        # 4. Đảm bảo numeric type trước khi sắp xếp
+                        forecasts['last_week_sales'] = pd.to_numeric(forecasts['last_week_sales'], errors='coerce').fillna(0)
+                        forecasts['ton_kho_nho_nhat'] = pd.to_numeric(forecasts['ton_kho_nho_nhat'], errors='coerce').fillna(0)
+                        forecasts['predicted_quantity'] = pd.to_numeric(forecasts['predicted_quantity'], errors='coerce').fillna(0)
                     
-                    # 5. Tính suggested_order cho mỗi sản phẩm
-                    # Suggested order = dự báo 14 ngày (2 tuần) - tồn hiện tại (ước tính = bán tuần trước)
-                    product_summary = forecasts.groupby('ma_hang').agg({
-                        'predicted_quantity': 'sum',  # Tổng 14 ngày
-                        'last_week_sales': 'first',
-                        'ton_kho_nho_nhat': 'first',
-                        'ten_san_pham': 'first',
-                        'abc_class': 'first'
-                    }).reset_index()
-                    product_summary['suggested_order'] = (
-                        product_summary['predicted_quantity'] * 1.5 - product_summary['last_week_sales'] - product_summary['ton_kho_nho_nhat']
-                    ).clip(lower=0).round()
+                        # 5. Tính suggested_order cho mỗi sản phẩm
+                        # Suggested order = dự báo 14 ngày (2 tuần) - tồn hiện tại (ước tính = bán tuần trước)
+                        product_summary = forecasts.groupby('ma_hang').agg({
+                            'predicted_quantity': 'sum',  # Tổng 14 ngày
+                            'last_week_sales': 'first',
+                            'ton_kho_nho_nhat': 'first',
+                            'ten_san_pham': 'first',
+                            'abc_class': 'first'
+                        }).reset_index()
+                        product_summary['suggested_order'] = (
+                            product_summary['predicted_quantity'] * 1.5 - product_summary['last_week_sales'] - product_summary['ton_kho_nho_nhat']
+                        ).clip(lower=0).round()
                     
-                    # Merge suggested_order vào forecasts
-                    forecasts = forecasts.merge(
-                        product_summary[['ma_hang', 'suggested_order']], 
-                        on='ma_hang', 
-                        how='left'
-                    )
-                    forecasts['suggested_order'] = forecasts['suggested_order'].fillna(0)
+                        # Merge suggested_order vào forecasts
+                        forecasts = forecasts.merge(
+                            product_summary[['ma_hang', 'suggested_order']], 
+                            on='ma_hang', 
+                            how='left'
+                        )
+                        forecasts['suggested_order'] = forecasts['suggested_order'].fillna(0)
                     
-                    # 6. Sắp xếp: suggested_order DESC (số lượng cần nhập nhiều nhất lên đầu)
-                    forecasts = forecasts.sort_values(
-                        by=['suggested_order', 'last_week_sales'], 
-                        ascending=[False, False]
-                    ).reset_index(drop=True)
+                        # 6. Sắp xếp: suggested_order DESC (số lượng cần nhập nhiều nhất lên đầu)
+                        forecasts = forecasts.sort_values(
+                            by=['suggested_order', 'last_week_sales'], 
+                            ascending=[False, False]
+                        ).reset_index(drop=True)
                     
-                    logger.info(f"   ✅ Đã sắp xếp: 1) Số lượng cần nhập (cao→thấp) 2) Bán tuần trước (cao→thấp)")
+                        logger.info(f"   ✅ Đã sắp xếp: 1) Số lượng cần nhập (cao→thấp) 2) Bán tuần trước (cao→thấp)")
                     
-                    # Log top 10 unique products sau khi sắp xếp
-                    unique_products = forecasts.drop_duplicates(subset=['ma_hang']).head(10)
-                    logger.info(f"   📋 Top 10 sản phẩm sau sắp xếp:")
-                    for idx, row in unique_products.iterrows():
-                        logger.info(f"      {row['ma_hang']} | {row['ten_san_pham'][:25]:<25} | Cần nhập {row['suggested_order']:>4.0f} | Bán T-{row['last_week_sales']:>4.0f} | Tồn {row['ton_kho_nho_nhat']:>4.0f}")
+                        # Log top 10 unique products sau khi sắp xếp
+                        unique_products = forecasts.drop_duplicates(subset=['ma_hang']).head(10)
+                        logger.info(f"   📋 Top 10 sản phẩm sau sắp xếp:")
+                        for idx, row in unique_products.iterrows():
+                            logger.info(f"      {row['ma_hang']} | {row['ten_san_pham'][:25]:<25} | Cần nhập {row['suggested_order']:>4.0f} | Bán T-{row['last_week_sales']:>4.0f} | Tồn {row['ton_kho_nho_nhat']:>4.0f}")
                     
-                    # Thống kê
-                    n_with_order = (forecasts.drop_duplicates(subset=['ma_hang'])['suggested_order'] > 0).sum()
-                    n_total = forecasts['ma_hang'].nunique()
-                    total_order = forecasts.drop_duplicates(subset=['ma_hang'])['suggested_order'].sum()
-                    logger.info(f"   📊 Thống kê: {n_with_order}/{n_total} sản phẩm cần nhập hàng, tổng cần nhập: {total_order:,.0f}")
+                        # Thống kê
+                        n_with_order = (forecasts.drop_duplicates(subset=['ma_hang'])['suggested_order'] > 0).sum()
+                        n_total = forecasts['ma_hang'].nunique()
+                        total_order = forecasts.drop_duplicates(subset=['ma_hang'])['suggested_order'].sum()
+                        logger.info(f"   📊 Thống kê: {n_with_order}/{n_total} sản phẩm cần nhập hàng, tổng cần nhập: {total_order:,.0f}")
                     
-                except Exception as e:
-                    logger.warning(f"⚠️ Lỗi khi áp dụng logic lọc/sắp xếp: {e}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ Lỗi khi áp dụng logic lọc/sắp xếp: {e}")
                 
-                # Lấy một số khuyến nghị tồn kho cho top products
-                inventory_recs = []
-                if 'ma_hang' in forecasts.columns:
-                    top_products = forecasts.groupby('ma_hang')['predicted_quantity'].sum().sort_values(ascending=False).head(10)
-                    logger.info(f"   Top 10 products for inventory recommendations: {list(top_products.head(10).index)}")
-                    for product_code in top_products.index:
+                    # Lấy một số khuyến nghị tồn kho cho top products (một batch cho cả tập)
+                    inventory_recs = []
+                    if 'ma_hang' in forecasts.columns:
+                        top_products = forecasts.groupby('ma_hang')['predicted_quantity'].sum().sort_values(ascending=False).head(10)
+                        logger.info(f"   Top 10 products for inventory recommendations: {list(top_products.head(10).index)}")
                         try:
-                            rec = self.get_inventory_recommendations(product_code)
-                            if 'error' not in rec:
-                                inventory_recs.append(rec)
+                            recs_df = self.get_inventory_recommendations_batch(top_products.index.tolist())
+                            inventory_recs = recs_df[recs_df['error'].isna()].drop(columns='error').to_dict('records')
                         except Exception as e:
-                            logger.debug(f"   Could not get inventory rec for {product_code}: {e}")
-                    logger.info(f"   Got {len(inventory_recs)} inventory recommendations")
+                            logger.warning(f"   ⚠️ Không lấy được khuyến nghị tồn kho: {e}")
+                        logger.info(f"   Got {len(inventory_recs)} inventory recommendations")
+                
+                    # Model 2 (chạy song song từ đầu)
+                    category_forecasts = category_future.result()
                 
                 # Tạo file đơn hàng Excel đính kèm
                 logger.info("📦 Đang tạo file đơn hàng Excel...")
@@ -2347,7 +2907,7 @@ class SalesForecaster:
         ORDER BY category_level_1
         """
         try:
-            categories = self.ch.query(categories_query)
+            categories = self.ch.cached_query(categories_query)
             category_list = categories['nhom_hang_cap_1'].tolist()
         except Exception as e:
             logger.error(f"❌ Lỗi khi lấy danh sách categories: {e}")
@@ -2363,7 +2923,7 @@ class SalesForecaster:
         WHERE database = 'retail_dw' AND name = 'int_dynamic_seasonal_factor'
         """
         try:
-            seasonal_exists = self.ch.query(check_query).iloc[0, 0] > 0
+            seasonal_exists = self.ch.cached_query(check_query).iloc[0, 0] > 0
         except:
             seasonal_exists = False
         
@@ -2384,7 +2944,7 @@ class SalesForecaster:
             GROUP BY month
             """
             try:
-                seasonal_df = self.ch.query(seasonal_query)
+                seasonal_df = self.ch.cached_query(seasonal_query)
                 for _, row in seasonal_df.iterrows():
                     seasonal_map[int(row['month'])] = {
                         'seasonal_factor': float(row.get('seasonal_factor', 1.0)),
@@ -2397,8 +2957,8 @@ class SalesForecaster:
                 logger.warning(f"⚠️ Không thể load seasonal factors: {e}")
         
         # Lấy dữ liệu lịch sử category-level
-        cats_str = "', '".join(category_list)
-        history_query = f"""
+        category_set = key_set_table('category_set', 'category', category_list)
+        history_query = """
         SELECT 
             f.transaction_date as ngay,
             p.category_level_1 as nhom_hang_cap_1,
@@ -2418,7 +2978,7 @@ class SalesForecaster:
             ) as is_holiday
         FROM retail_dw.fct_regular_sales f
         LEFT JOIN retail_dw.dim_product p ON f.product_code = p.p.product_code
-        WHERE p.category_level_1 IN ('{cats_str}')
+        WHERE p.category_level_1 IN (SELECT category FROM category_set)
           AND f.transaction_date >= today() - 60
           AND f.product_code IS NOT NULL
           AND f.product_code != ''
@@ -2436,7 +2996,7 @@ class SalesForecaster:
         """
         
         try:
-            history_df = self.ch.query(history_query)
+            history_df = self.ch.query(history_query, external_tables=[category_set])
             history_df['ngay'] = pd.to_datetime(history_df['ngay'])
             
             # VALIDATION: Chỉ giữ lại records có dữ liệu bán thực tế
@@ -2515,7 +3075,11 @@ class SalesForecaster:
                     combined['quantity_growth'] = combined['quantity_growth'].replace([np.inf, -np.inf], 0).fillna(0)
                     
                     # Encoding
-                    combined['category1_encoded'] = pd.Categorical(combined['nhom_hang_cap_1']).codes
+                    encoders = self.get_encoders()
+                    if encoders is not None:
+                        combined['category1_encoded'] = encoders.encode('nhom_hang_cap_1', combined['nhom_hang_cap_1'])
+                    else:
+                        combined['category1_encoded'] = pd.Categorical(combined['nhom_hang_cap_1']).codes
                     
                     # Dummy values cho compatibility
                     combined['chi_nhanh'] = 'ALL_BRANCHES'
@@ -2836,90 +3400,119 @@ class SalesForecaster:
     
     def get_inventory_recommendations(self, product_code: str) -> Dict:
         """Đưa ra khuyến nghị tồn kho với logic Safety Stock so sánh Min Stock"""
-        # Lấy dự báo cho sản phẩm
-        forecast_query = f"""
+        recs = self.get_inventory_recommendations_batch([product_code])
+        if recs.empty:
+            return {'error': 'No forecast available'}
+        rec = recs.iloc[0]
+        if pd.notna(rec['error']):
+            return {'error': rec['error']}
+        return recs.drop(columns='error').to_dict('records')[0]
+    
+    def get_inventory_recommendations_batch(self, product_codes: List[str], lead_time_max: int = 14,
+                                            lead_time_avg: int = 10) -> pd.DataFrame:
+        """
+        Khuyến nghị tồn kho cho cả tập sản phẩm: một query PostgreSQL (dự báo 14 ngày +
+        tồn kho tối thiểu) và một query ClickHouse (nhu cầu ngày cao nhất 28 ngày),
+        Safety Stock tính vectorized.
+        
+        Safety Stock = (Nhu cầu cao nhất × Lead time max) - (Nhu cầu TB × Lead time TB)
+            - SS < Min Stock → Đặt = Min - SS
+            - SS >= Min Stock → Đặt = 14 ngày dự báo
+        
+        Returns:
+            DataFrame một dòng mỗi sản phẩm (theo thứ tự product_codes), cột 'error' khác
+            None khi sản phẩm không có dự báo hợp lệ
+        """
+        from sqlalchemy import text
+        codes = list(dict.fromkeys(str(p) for p in product_codes))
+        columns = ['product_code', 'predicted_next_14_days', 'avg_daily_demand', 'min_stock',
+                   'recommended_safety_stock', 'reorder_point', 'suggested_order_quantity',
+                   'order_logic', 'reorder_urgency', 'error']
+        if not codes:
+            return pd.DataFrame(columns=columns)
+        
+        # Dự báo 14 ngày tới + tồn kho tối thiểu (PostgreSQL)
+        forecast_query = """
         SELECT 
+            ma_hang,
             SUM(predicted_quantity) as total_predicted,
             AVG(predicted_quantity) as avg_daily
         FROM ml_forecasts
-        WHERE ma_hang = '{product_code}'
+        WHERE ma_hang = ANY(:codes)
         AND forecast_date >= CURRENT_DATE
         AND forecast_date <= CURRENT_DATE + INTERVAL '14 days'
+        GROUP BY ma_hang
         """
-        
-        forecast = self.pg.execute_query(forecast_query)
-        
-        if forecast.empty:
-            return {'error': 'No forecast available'}
-        
-        total_predicted = forecast['total_predicted'].iloc[0]
-        avg_daily = forecast['avg_daily'].iloc[0]
-        
-        # Kiểm tra giá trị NULL
-        if pd.isna(total_predicted) or pd.isna(avg_daily):
-            return {'error': 'Invalid forecast data'}
-        
-        # Lấy tồn kho tối thiểu từ PostgreSQL
         try:
-            from sqlalchemy import text
             with self.pg.get_connection() as conn:
-                min_stock_query = f"""
-                SELECT COALESCE(ton_nho_nhat, 0) as ton_nho_nhat
-                FROM products
-                WHERE ma_hang = '{product_code}'
-                """
-                min_stock_df = pd.read_sql(text(min_stock_query), conn)
-                min_stock = min_stock_df['ton_nho_nhat'].iloc[0] if not min_stock_df.empty else 0
+                pg_df = pd.read_sql(text(f"""
+                SELECT f.*, COALESCE(p.ton_nho_nhat, 0) as ton_nho_nhat
+                FROM ({forecast_query}) f
+                LEFT JOIN products p ON p.ma_hang = f.ma_hang
+                """), conn, params={'codes': codes})
         except Exception as e:
+            # Bảng products chưa có cột ton_nho_nhat → Min Stock = 0
             logger.warning(f"⚠️ Không thể lấy tồn kho tối thiểu: {e}")
-            min_stock = 0
+            with self.pg.get_connection() as conn:
+                pg_df = pd.read_sql(text(forecast_query), conn, params={'codes': codes})
+            pg_df['ton_nho_nhat'] = 0
         
-        # Tính Safety Stock - Method 2: Standard formula
-        # Cần lấy max_daily_demand từ dữ liệu lịch sử
+        df = pd.DataFrame({'product_code': codes}).merge(
+            pg_df.rename(columns={'ma_hang': 'product_code'}), on='product_code', how='left')
+        total = pd.to_numeric(df['total_predicted'], errors='coerce').to_numpy(dtype=float)
+        avg = pd.to_numeric(df['avg_daily'], errors='coerce').to_numpy(dtype=float)
+        min_stock = pd.to_numeric(df['ton_nho_nhat'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        
+        # Nhu cầu ngày cao nhất 28 ngày (ClickHouse); sản phẩm không bán → 0
         try:
-            max_daily_query = f"""
-            SELECT MAX(daily_sold) as max_daily
+            max_daily_query = """
+            SELECT product_code as ma_hang, MAX(daily_sold) as max_daily
             FROM (
-                SELECT SUM(quantity_sold) as daily_sold
+                SELECT product_code, SUM(quantity_sold) as daily_sold
                 FROM retail_dw.fct_regular_sales
-                WHERE product_code = '{product_code}'
+                WHERE product_code IN (SELECT product_code FROM product_set)
                   AND transaction_date >= today() - 28
-                GROUP BY transaction_date
+                GROUP BY product_code, transaction_date
             )
+            GROUP BY product_code
             """
-            max_daily_df = self.ch.query(max_daily_query)
-            max_daily = max_daily_df['max_daily'].iloc[0] if not max_daily_df.empty else avg_daily * 2
-        except:
-            max_daily = avg_daily * 2  # Fallback: 2x average
-        
-        # Standard Safety Stock formula: (Max Demand × Max Lead Time) - (Avg Demand × Avg Lead Time)
-        lead_time_max = 14  # days
-        lead_time_avg = 10  # days
-        safety_stock = (max_daily * lead_time_max) - (avg_daily * lead_time_avg)
-        safety_stock = max(0, round(safety_stock))
-        
-        # Logic: So sánh Safety Stock với Min Stock
-        if safety_stock < min_stock:
-            # Nếu SS < Min Stock → Đặt = Min Stock - SS
-            suggested_order = max(0, min_stock - safety_stock)
-            order_logic = f"SS ({safety_stock}) < Min ({min_stock}): Đặt = Min - SS"
-        else:
-            # Nếu SS >= Min Stock → Đặt bình thường
-            suggested_order = round(avg_daily * 14)  # 14 days = 2 weeks
-            order_logic = f"SS ({safety_stock}) >= Min ({min_stock}): Đặt = 14 ngày dự báo"
+            max_daily_df = self.ch.query(max_daily_query, external_tables=[product_set_table(codes)])
+            max_daily = (pd.Series(pd.to_numeric(max_daily_df['max_daily'], errors='coerce').to_numpy(),
+                                   index=max_daily_df['ma_hang'].astype(str))
+                         .reindex(codes).fillna(0).to_numpy(dtype=float))
+        except Exception:
+            max_daily = avg * 2  # Fallback: 2x average
+        
+        safety_stock = np.maximum(0, np.round(max_daily * lead_time_max - avg * lead_time_avg))
+        reorder_point = np.round(avg * 14)  # 2 weeks
+        below_min = safety_stock < min_stock
+        suggested_order = np.where(below_min, np.maximum(0, min_stock - safety_stock), reorder_point)
+        
+        ss_str = pd.Series(safety_stock).map(lambda v: f"{v:.0f}" if np.isfinite(v) else "nan")
+        min_str = pd.Series(min_stock).map(lambda v: f"{v:g}")
+        order_logic = np.where(
+            below_min,
+            "SS (" + ss_str + ") < Min (" + min_str + "): Đặt = Min - SS",
+            "SS (" + ss_str + ") >= Min (" + min_str + "): Đặt = 14 ngày dự báo"
+        )
         
-        # Khuyến nghị
-        return {
-            'product_code': product_code,
-            'predicted_next_14_days': total_predicted,
-            'avg_daily_demand': avg_daily,
+        valid = np.isfinite(total) & np.isfinite(avg)
+        result = pd.DataFrame({
+            'product_code': codes,
+            'predicted_next_14_days': total,
+            'avg_daily_demand': avg,
             'min_stock': min_stock,
             'recommended_safety_stock': safety_stock,
-            'reorder_point': round(avg_daily * 14),  # 2 weeks
+            'reorder_point': reorder_point,
             'suggested_order_quantity': suggested_order,
             'order_logic': order_logic,
-            'reorder_urgency': 'High' if total_predicted > avg_daily * 14 else 'Normal'
-        }
+            'reorder_urgency': np.where(total > avg * 14, 'High', 'Normal'),
+            'error': np.where(valid, None, 'Invalid forecast data'),
+        }, columns=columns)
+        # Số lượng làm tròn → số nguyên (NA khi không có dự báo)
+        for col in ('recommended_safety_stock', 'reorder_point', 'suggested_order_quantity'):
+            result[col] = result[col].astype('Int64')
+        return result
     
     def generate_purchase_order_csv(self, forecasts: pd.DataFrame = None, 
                                      top_n: int = 50,
@@ -2967,14 +3560,14 @@ class SalesForecaster:
             return None
         
         product_list = forecasts['ma_hang'].unique().tolist()
-        products_str = "', '".join(str(p) for p in product_list)
+        product_set = product_set_table(product_list)
         
         # 1. Lấy thông tin từ PostgreSQL (mã vạch, tồn nhỏ nhất)
         logger.info("📥 Đang lấy thông tin tồn kho tối thiểu từ DanhSachSanPham...")
         try:
             from sqlalchemy import text
             with self.pg.get_connection() as conn:
-                product_info_query = f"""
+                product_info_query = """
                 SELECT 
                     ma_hang,
                     ma_vach,
@@ -2984,106 +3577,53 @@ class SalesForecaster:
                     gia_ban_mac_dinh,
                     COALESCE(ton_nho_nhat, 0) as ton_nho_nhat
                 FROM products
-                WHERE ma_hang IN ('{products_str}')
+                WHERE ma_hang = ANY(:codes)
                 """
-                product_info_df = pd.read_sql(text(product_info_query), conn)
-                product_info = {}
-                for _, row in product_info_df.iterrows():
-                    product_info[row['ma_hang']] = {
-                        'ma_vach': row['ma_vach'] or row['ma_hang'],
-                        'ten_hang': row['ten_hang'],
-                        'thuong_hieu': row['thuong_hieu'],
-                        'gia_von': row['gia_von_mac_dinh'] or 0,
-                        'gia_ban': row['gia_ban_mac_dinh'] or 0,
-                        'ton_nho_nhat': row['ton_nho_nhat'] or 0,
-                        'margin': ((row['gia_ban_mac_dinh'] - row['gia_von_mac_dinh']) / row['gia_von_mac_dinh'] * 100) 
-                                  if row['gia_von_mac_dinh'] and row['gia_von_mac_dinh'] > 0 else 0
-                    }
-                logger.info(f"✅ Loaded {len(product_info)} products from DanhSachSanPham")
+                product_info_df = pd.read_sql(text(product_info_query), conn, params={'codes': product_list})
+                logger.info(f"✅ Loaded {len(product_info_df)} products from DanhSachSanPham")
         except Exception as e:
             logger.warning(f"⚠️ Không thể load từ PostgreSQL: {e}")
-            product_info = {}
+            product_info_df = None
         
         # 2. Lấy tồn kho HIỆN TẠI từ inventory_transactions (PostgreSQL)
         logger.info("📥 Đang lấy tồn kho hiện tại...")
         try:
             from sqlalchemy import text
             with self.pg.get_connection() as conn:
-                inventory_query = f"""
+                inventory_query = """
                 SELECT DISTINCT ON (ma_hang)
                     ma_hang,
                     ton_cuoi_ky as ton_hien_tai
                 FROM inventory_transactions
-                WHERE ma_hang IN ('{products_str}')
+                WHERE ma_hang = ANY(:codes)
                 ORDER BY ma_hang, ngay_bao_cao DESC
                 """
-                inventory_df = pd.read_sql(text(inventory_query), conn)
-                current_stock_map = dict(zip(inventory_df['ma_hang'], inventory_df['ton_hien_tai']))
-                logger.info(f"✅ Loaded current stock for {len(current_stock_map)} products")
+                inventory_df = pd.read_sql(text(inventory_query), conn, params={'codes': product_list})
+                logger.info(f"✅ Loaded current stock for {len(inventory_df)} products")
         except Exception as e:
             logger.warning(f"⚠️ Không thể load tồn kho hiện tại: {e}")
-            current_stock_map = {}
+            inventory_df = None
         
         # 3. Lấy số lượng bán THEO TUẦN (4 tuần gần nhất) để tính tồn kho tối ưu
         logger.info("📊 Đang tính tồn kho tối ưu từ dữ liệu 4 tuần...")
         try:
             # Query dữ liệu bán theo tuần
-            weekly_sales_query = f"""
+            weekly_sales_query = """
             SELECT 
                 product_code as ma_hang,
                 toWeek(transaction_date, 1) as week_num,
                 SUM(quantity_sold) as weekly_sold,
                 SUM(gross_revenue) as weekly_revenue
             FROM retail_dw.fct_regular_sales
-            WHERE product_code IN ('{products_str}')
+            WHERE product_code IN (SELECT product_code FROM product_set)
               AND transaction_date >= today() - 28
             GROUP BY product_code, toWeek(transaction_date, 1)
             ORDER BY product_code, week_num
             """
-            weekly_df = self.ch.query(weekly_sales_query)
-            
-            # Tính tồn kho tối ưu cho mỗi sản phẩm
-            # Công thức: tồn kho tối ưu = median(lượng bán tuần + tồn kho nhỏ nhất × 0.75) qua 4 tuần
-            optimal_inventory_map = {}
-            sales_map = {}
-            
-            for ma_hang in product_list:
-                # Lấy dữ liệu 4 tuần của sản phẩm này
-                product_weekly = weekly_df[weekly_df['ma_hang'] == ma_hang]
-                
-                if len(product_weekly) > 0:
-                    # Lấy tồn kho nhỏ nhất từ database
-                    ton_nho_nhat = product_info.get(ma_hang, {}).get('ton_nho_nhat', 0)
-                    
-                    # Tính tồn kho tối ưu cho mỗi tuần = bán tuần đó + tồn kho nhỏ nhất × 0.75
-                    weekly_optimal = []
-                    for _, week_row in product_weekly.iterrows():
-                        weekly_sold = week_row['weekly_sold'] or 0
-                        optimal_week = weekly_sold + (ton_nho_nhat * 0.75)
-                        weekly_optimal.append(optimal_week)
-                    
-                    # Lấy trung vị (median) của 4 tuần
-                    import numpy as np
-                    optimal_inventory = np.median(weekly_optimal) if weekly_optimal else 0
-                    
-                    optimal_inventory_map[ma_hang] = round(optimal_inventory)
-                    
-                    # Lưu thêm tổng doanh thu 4 tuần cho ưu tiên
-                    sales_map[ma_hang] = {
-                        'quantity_sold': product_weekly['weekly_sold'].sum() or 0,
-                        'revenue': product_weekly['weekly_revenue'].sum() or 0,
-                        'weekly_data': weekly_optimal
-                    }
-                else:
-                    optimal_inventory_map[ma_hang] = 0
-                    sales_map[ma_hang] = {'quantity_sold': 0, 'revenue': 0, 'weekly_data': []}
-            
-            logger.info(f"✅ Calculated optimal inventory for {len(optimal_inventory_map)} products")
-            logger.info(f"   Formula: median(weekly_sales + ton_nho_nhat × 0.75) over 4 weeks")
+            weekly_df = self.ch.query(weekly_sales_query, external_tables=[product_set])
         except Exception as e:
             logger.warning(f"⚠️ Không thể tính tồn kho tối ưu: {e}")
-            optimal_inventory_map = {}
-            sales_map = {}
+            weekly_df = None
         
         # 3b. TÍNH TỒN KHO AN TOÀN (Safety Stock)
         logger.info("📊 Đang tính tồn kho an toàn (Safety Stock)...")
@@ -3092,104 +3632,30 @@ class SalesForecaster:
         
         try:
             # Query dữ liệu bán theo NGÀY (28 ngày gần nhất) để tính nhu cầu
-            daily_sales_query = f"""
+            daily_sales_query = """
             SELECT 
                 product_code as ma_hang,
                 transaction_date as ngay,
                 SUM(quantity_sold) as daily_sold
             FROM retail_dw.fct_regular_sales
-            WHERE product_code IN ('{products_str}')
+            WHERE product_code IN (SELECT product_code FROM product_set)
               AND transaction_date >= today() - 28
             GROUP BY product_code, transaction_date
             ORDER BY product_code, transaction_date
             """
-            daily_df = self.ch.query(daily_sales_query)
-            
-            # Tính Safety Stock cho mỗi sản phẩm
-            safety_stock_map = {}
-            
-            for ma_hang in product_list:
-                # Lấy dữ liệu bán hàng theo ngày của sản phẩm
-                product_daily = daily_df[daily_df['ma_hang'] == ma_hang]
-                
-                if len(product_daily) >= 7:  # Cần ít nhất 7 ngày dữ liệu
-                    daily_sold_list = product_daily['daily_sold'].tolist()
-                    
-                    # Tính nhu cầu cao nhất (max daily demand)
-                    max_daily_demand = max(daily_sold_list)
-                    
-                    # Tính nhu cầu trung bình (average daily demand)
-                    avg_daily_demand = sum(daily_sold_list) / len(daily_sold_list)
-                    
-                    # Công thức Safety Stock:
-                    # (Nhu cầu cao nhất × Lead time max) - (Nhu cầu TB × Lead time TB)
-                    safety_stock = (max_daily_demand * lead_time_max) - (avg_daily_demand * lead_time_avg)
-                    safety_stock = max(0, round(safety_stock))  # Không âm
-                    
-                    safety_stock_map[ma_hang] = safety_stock
-                else:
-                    # Không đủ dữ liệu, dùng tồn nhỏ nhất làm safety stock
-                    ton_nho_nhat = product_info.get(ma_hang, {}).get('ton_nho_nhat', 0)
-                    safety_stock_map[ma_hang] = round(ton_nho_nhat * 0.5)  # 50% tồn nhỏ nhất
-            
-            logger.info(f"✅ Calculated Safety Stock for {len(safety_stock_map)} products")
+            daily_df = self.ch.query(daily_sales_query, external_tables=[product_set])
         except Exception as e:
             logger.warning(f"⚠️ Không thể tính Safety Stock: {e}")
-            safety_stock_map = {}
+            daily_df = None
         
-        # 4. Tổng hợp dự báo theo sản phẩm (14 ngày = 2 tuần)
-        product_summary = forecasts.groupby(['ma_hang', 'ten_san_pham']).agg({
-            'predicted_quantity': 'sum',
-            'last_week_sales': 'first',
-            'ton_kho_nho_nhat': 'first'
-        }).reset_index()
-        product_summary.columns = ['ma_hang', 'ten_san_pham', f'forecast_{forecast_days}d', 'last_week_sales', 'ton_kho_nho_nhat']
-        forecast_col = f'forecast_{forecast_days}d'
-        
-        # 5. Thêm các thông tin bổ sung
-        product_summary['ma_vach'] = product_summary['ma_hang'].map(
-            lambda x: product_info.get(x, {}).get('ma_vach', x))
-        product_summary['ten_hang_day_du'] = product_summary['ma_hang'].map(
-            lambda x: product_info.get(x, {}).get('ten_hang', ''))
-        product_summary['ton_nho_nhat'] = product_summary['ma_hang'].map(
-            lambda x: product_info.get(x, {}).get('ton_nho_nhat', 0))
-        product_summary['ton_hien_tai'] = product_summary['ma_hang'].map(
-            lambda x: current_stock_map.get(x, 0))
-        product_summary['ton_kho_toi_uu'] = product_summary['ma_hang'].map(
-            lambda x: optimal_inventory_map.get(x, 0))  # Tồn kho tối ưu mới
-        product_summary['ton_an_toan'] = product_summary['ma_hang'].map(
-            lambda x: safety_stock_map.get(x, 0))  # Tồn kho an toàn (Safety Stock)
-        product_summary['da_ban_4tuan'] = product_summary['ma_hang'].map(
-            lambda x: sales_map.get(x, {}).get('quantity_sold', 0))
-        product_summary['doanh_thu_4tuan'] = product_summary['ma_hang'].map(
-            lambda x: sales_map.get(x, {}).get('revenue', 0))
-        product_summary['margin_pct'] = product_summary['ma_hang'].map(
-            lambda x: product_info.get(x, {}).get('margin', 0))
-        
-        # 6. Tính LƯỢNG CẦN NHẬP
-        # Unified formula: forecast_14_days * 1.5 - last_week_sales - ton_kho
-        # Đồng bộ với email notifier
-        product_summary['luong_can_nhap'] = (
-            product_summary[forecast_col] * 1.5 
-            - product_summary['last_week_sales'] 
-            - product_summary['ton_kho_nho_nhat']
-        ).clip(lower=0).round()
-        
-        # 7. SẮP XẾP ƯU TIÊN
-        # Primary: Lượng cần nhập (nhiều nhất = cần gấp nhất)
-        # Secondary: Số lượng đã bán (bán nhiều = ưu tiên cao)
-        # Tertiary: Doanh thu (để highlight high value)
-        product_summary = product_summary.sort_values(
-            ['luong_can_nhap', 'da_ban_4tuan', 'doanh_thu_4tuan'], 
-            ascending=[False, False, False]
+        # 4-9. Tổng hợp dự báo, tồn kho tối ưu/an toàn, lượng cần nhập và ưu tiên (purchase_order.py)
+        top_products = rank_products(
+            forecasts, product_info_df=product_info_df, inventory_df=inventory_df,
+            weekly_df=weekly_df, daily_df=daily_df, top_n=top_n,
+            lead_time_max=lead_time_max, lead_time_avg=lead_time_avg, forecast_days=forecast_days
         )
-        
-        # 8. Lấy top N sản phẩm
-        top_products = product_summary.head(top_n).copy()
-        
-        # Đánh dấu sản phẩm HIGH MARGIN (> 20% margin) và HIGH VALUE (top doanh thu)
-        top_products['is_high_margin'] = top_products['margin_pct'] > 20
-        top_products['is_high_value'] = top_products['doanh_thu_4tuan'] >= top_products['doanh_thu_4tuan'].quantile(0.8)
+        logger.info(f"✅ Calculated optimal inventory & Safety Stock for {forecasts['ma_hang'].nunique()} products")
+        logger.info("   Formula: median(weekly_sales + ton_nho_nhat × 0.75) over 4 weeks")
         
         # Thống kê sản phẩm có Safety Stock < Tồn kho tối thiểu
         ss_below_min = top_products[top_products['ton_an_toan'] < top_products['ton_nho_nhat']]
@@ -3202,52 +3668,12 @@ class SalesForecaster:
         logger.info(f"   - Tổng mục tiêu TB: {top_products['tong_ton_kho_muc_tieu'].mean():,.0f} units")
         logger.info(f"   - Sản phẩm có SS < Min Stock: {len(ss_below_min)} (đặt = Min - SS)")
         logger.info(f"   - Công thức Safety Stock: (Nhu cầu max × {lead_time_max}d) - (Nhu cầu TB × {lead_time_avg}d)")
-        logger.info(f"   - Logic đặt hàng: Nếu SS < Min Stock → Đặt = Min - SS, ngược lại MAX(Forecast, Target) - Current")
+        logger.info("   - Logic đặt hàng: Nếu SS < Min Stock → Đặt = Min - SS, ngược lại MAX(Forecast, Target) - Current")
         logger.info(f"   - Sản phẩm HIGH MARGIN (>20%): {top_products['is_high_margin'].sum()}")
         logger.info(f"   - Sản phẩm HIGH VALUE (top 20%): {top_products['is_high_value'].sum()}")
         
-        # 9. Tạo đơn hàng
-        purchase_orders = []
-        for idx, row in top_products.iterrows():
-            # Xác định mức độ ưu tiên
-            if row['luong_can_nhap'] > row['ton_hien_tai'] * 2:
-                uu_tien = '🔴 Cần gấp'
-            elif row['luong_can_nhap'] > 0:
-                uu_tien = '🟡 Cần đủ'
-            else:
-                uu_tien = '🟢 Đủ hàng'
-            
-            # Ghi chú highlight
-            ghi_chu = ''
-            if row['is_high_margin'] and row['is_high_value']:
-                ghi_chu = '⭐ HIGH MARGIN + HIGH VALUE'
-            elif row['is_high_margin']:
-                ghi_chu = '💰 HIGH MARGIN'
-            elif row['is_high_value']:
-                ghi_chu = '💎 HIGH VALUE'
-            
-            purchase_orders.append({
-                'stt': len(purchase_orders) + 1,
-                'ma_hang': row['ma_hang'],
-                'ma_vach': row['ma_vach'],
-                'ten_san_pham': row['ten_hang_day_du'] or row['ten_san_pham'],
-                'luong_can_nhap': round(row['luong_can_nhap']),
-                'ton_kho_toi_uu': round(row['ton_kho_toi_uu']),  # Tồn kho tối ưu
-                'ton_an_toan': round(row['ton_an_toan']),  # Tồn kho an toàn (Safety Stock)
-                'tong_muc_tieu': round(row['tong_ton_kho_muc_tieu']),  # Tổng mục tiêu
-                'ton_nho_nhat': round(row['ton_nho_nhat']),
-                'ton_hien_tai': round(row['ton_hien_tai']),
-                'du_bao_7ngay': round(row['forecast_7d']),
-                'da_ban_4tuan': round(row['da_ban_4tuan']),
-                'doanh_thu_4tuan': round(row['doanh_thu_4tuan']),
-                'margin_pct': round(row['margin_pct'], 1),
-                'uu_tien': uu_tien,
-                'ghi_chu': ghi_chu
-            })
-        
-        # 10. Tạo DataFrame và lưu file
-        po_df = pd.DataFrame(purchase_orders)
-        po_df['stt'] = range(1, len(po_df) + 1)
+        # 10. Tạo đơn hàng và lưu file
+        po_df = format_purchase_orders(top_products, forecast_days=forecast_days)
         
         if output_path is None:
             output_dir = '/app/output' if os.path.exists('/app/output') else os.getcwd()
@@ -3275,118 +3701,101 @@ class SalesForecaster:
     def generate_purchase_order_excel(self, forecasts: pd.DataFrame = None, 
                                        top_n: int = 50,
                                        output_path: str = None,
-                                       forecast_days: int = 14) -> str:
+                                       forecast_days: int = 14,
+                                       full_catalog: bool = False,
+                                       forecast_mode: str = 'recursive') -> str:
         """
         Tạo file Excel (.xlsx) đơn hàng cần đặt - Đơn giản hóa cho ngưởi dùng
         Chỉ gồm 3 cột: Tên sản phẩm, Mã vạch, Số lượng cần nhập
         
+        File được ghi streaming (openpyxl write-only, purchase_order.write_order_workbook),
+        độ rộng cột tính từ độ dài chuỗi theo cột.
+        
         Args:
             forecasts: DataFrame dự báo (nếu None sẽ chạy predict)
-            top_n: Số sản phẩm cần đặt
+            top_n: Số sản phẩm cần đặt (bỏ qua khi full_catalog)
             output_path: Đường dẫn file output
             forecast_days: Số ngày dự báo (mặc định 14 ngày = 2 tuần)
+            full_catalog: Đơn hàng cho toàn bộ catalog - mọi sản phẩm có lượng cần nhập > 0,
+                          sheet tổng hợp + một sheet cho mỗi chi nhánh (lượng cần nhập phân bổ
+                          theo tỷ trọng dự báo của chi nhánh)
+            forecast_mode: Chế độ predict_next_week khi forecasts=None
             
         Returns:
             Đường dẫn file Excel đã tạo
         """
         logger.info("=" * 60)
-        logger.info("📦 TẠO FILE ĐƠN HÀNG EXCEL")
+        logger.info(f"📦 TẠO FILE ĐƠN HÀNG EXCEL{' (TOÀN BỘ CATALOG)' if full_catalog else ''}")
         logger.info("=" * 60)
         
         # Nếu không có forecasts thì chạy dự báo mới
         if forecasts is None or forecasts.empty:
             logger.info("Chưa có dữ liệu dự báo, đang chạy predict_next_week (2 tuần)...")
-            forecasts = self.predict_next_week(use_abc_filter=True, abc_top_n=top_n, forecast_days=forecast_days)
+            forecasts = self.predict_next_week(use_abc_filter=not full_catalog, abc_top_n=top_n,
+                                               forecast_days=forecast_days, forecast_mode=forecast_mode)
         
         if forecasts.empty:
             logger.error("❌ Không có dữ liệu dự báo để tạo đơn hàng")
             return None
         
-        # Lấy danh sách sản phẩm và tổng số lượng cần nhập
-        # Sử dụng suggested_order đã tính thay vì predicted_quantity thô
-        product_list = forecasts.groupby('ma_hang').agg({
-            'suggested_order': 'sum',
-            'ten_san_pham': 'first'
-        }).sort_values('suggested_order', ascending=False).head(top_n)
+        # Tổng số lượng cần nhập theo sản phẩm (suggested_order đã tính thay vì predicted_quantity thô;
+        # forecasts chưa enrichment → query bán tuần qua + tồn kho cho toàn bộ sản phẩm)
+        if 'suggested_order' not in forecasts.columns:
+            forecasts = self._add_order_inputs(forecasts)
+        orders = product_order_quantities(forecasts)
+        if full_catalog:
+            orders = orders[orders['suggested_order'] > 0].reset_index(drop=True)
+            logger.info(f"📊 {len(orders):,}/{forecasts['ma_hang'].nunique():,} sản phẩm cần nhập")
+        else:
+            orders = orders.head(top_n)
         
         # Lấy mã vạch từ PostgreSQL
         try:
             from sqlalchemy import text
-            ma_hang_list = product_list.index.tolist()
-            ma_hang_str = "', '".join(str(m) for m in ma_hang_list)
-            
             with self.pg.get_connection() as conn:
-                query = f"""
+                query = """
                 SELECT ma_hang, ma_vach, ten_hang
                 FROM products
-                WHERE ma_hang IN ('{ma_hang_str}')
+                WHERE ma_hang = ANY(:codes)
                 """
-                product_info = pd.read_sql(text(query), conn)
-                product_info = product_info.set_index('ma_hang')
+                product_info = pd.read_sql(text(query), conn, params={'codes': orders['ma_hang'].tolist()})
         except Exception as e:
             logger.warning(f"⚠️ Không thể lấy mã vạch: {e}")
-            product_info = pd.DataFrame()
-        
-        # Tạo DataFrame đơn giản với 3 cột
-        simple_orders = []
-        for ma_hang, row in product_list.iterrows():
-            ten_sp = row['ten_san_pham'] if pd.notna(row['ten_san_pham']) else ''
-            if not ten_sp and ma_hang in product_info.index:
-                ten_sp = product_info.loc[ma_hang, 'ten_hang']
-            
-            ma_vach = ''
-            if ma_hang in product_info.index:
-                ma_vach = product_info.loc[ma_hang, 'ma_vach'] or ma_hang
-            else:
-                ma_vach = ma_hang
-            
-            simple_orders.append({
-                'Tên sản phẩm': ten_sp,
-                'Mã vạch': ma_vach,
-                'Số lượng cần nhập': int(row['suggested_order'])
-            })
+            product_info = None
         
-        po_df = pd.DataFrame(simple_orders)
+        po_df = excel_order_rows(orders, product_info)
+        
+        def order_sheets():
+            """Sheet tổng hợp, sau đó từng chi nhánh (tạo lần lượt khi writer cần)"""
+            yield EXCEL_SUMMARY_SHEET, po_df
+            if full_catalog and 'chi_nhanh' in forecasts.columns:
+                branch_orders = branch_order_quantities(forecasts, orders)
+                branch_orders = branch_orders[branch_orders['luong_can_nhap'] > 0].merge(
+                    orders[['ma_hang', 'ten_san_pham']], on='ma_hang', how='left')
+                for branch, rows in branch_orders.groupby('chi_nhanh', sort=True):
+                    rows = rows.sort_values('luong_can_nhap', ascending=False, kind='mergesort')
+                    yield branch, excel_order_rows(rows, product_info, quantity_col='luong_can_nhap')
         
         # Tạo đường dẫn output
         if output_path is None:
             output_dir = '/app/output' if os.path.exists('/app/output') else os.getcwd()
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(output_dir, f'don_hang_can_nhap_{timestamp}.xlsx')
+            prefix = 'don_hang_toan_bo' if full_catalog else 'don_hang_can_nhap'
+            output_path = os.path.join(output_dir, f'{prefix}_{timestamp}.xlsx')
         
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
         # Lưu file Excel
+        import time
         try:
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                po_df.to_excel(writer, index=False, sheet_name='Đơn hàng cần nhập')
-                
-                # Format cột
-                workbook = writer.book
-                worksheet = writer.sheets['Đơn hàng cần nhập']
-                
-                # Định dạng header
-                for cell in worksheet[1]:
-                    cell.font = workbook.create_font(bold=True)
-                    cell.fill = workbook.create_fill(patternType='solid', fgColor='4472C4')
-                    cell.font = workbook.create_font(bold=True, color='FFFFFF')
-                
-                # Auto adjust column width
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
+            start = time.perf_counter()
+            n_rows = write_order_workbook(output_path, order_sheets())
             
             logger.info(f"\n✅ Đã tạo file Excel đơn hàng: {output_path}")
             logger.info(f"   - Tổng số sản phẩm: {len(po_df)}")
             logger.info(f"   - Tổng số lượng cần nhập: {po_df['Số lượng cần nhập'].sum():,} units")
+            if full_catalog:
+                logger.info(f"   - {n_rows:,} dòng (tổng hợp + chi nhánh) trong {time.perf_counter() - start:.1f}s")
             
         except Exception as e:
             logger.error(f"❌ Lỗi khi tạo file Excel: {e}")
@@ -3420,13 +3829,8 @@ class SalesForecaster:
         logger.info("📊 TẠO BÁO CÁO DỰ BÁO TOÀN DIỆN")
         logger.info("=" * 70)
         
-        # Load models nếu chưa có
-        if not self.models:
-            for name in ['product_quantity', 'category_trend']:
-                model_path = os.path.join(self.model_dir, f'{name}_model.pkl')
-                if os.path.exists(model_path):
-                    self.models[name] = joblib.load(model_path)
-                    logger.info(f"✅ Loaded model: {name}")
+        # Load các models chưa có trong self.models
+        self._load_models_if_exist(['product_quantity', 'category_trend'])
         
         report = {
             'generated_at': datetime.now().isoformat(),
@@ -3662,7 +4066,7 @@ class SalesForecaster:
                 logger.info("📊 Query doanh số tuần trước cho email report...")
                 try:
                     product_list = forecasts['ma_hang'].unique().tolist()
-                    products_str = "', '".join(str(p) for p in product_list)
+                    product_set = product_set_table(product_list)
                     
                     # Lấy tuần mới nhất có dữ liệu để tính "tuần trước" chính xác
                     current_week_query = """
@@ -3671,7 +4075,7 @@ class SalesForecaster:
                         toYear(MAX(transaction_date)) as current_year
                     FROM retail_dw.fct_regular_sales
                     """
-                    week_result = self.ch.query(current_week_query)
+                    week_result = self.ch.cached_query(current_week_query)
                     if week_result is not None and len(week_result) > 0 and week_result.iloc[0, 0] is not None:
                         current_week = int(week_result.iloc[0, 0])
                         current_year = int(week_result.iloc[0, 1])
@@ -3695,12 +4099,12 @@ class SalesForecaster:
                         SUM(f.quantity_sold) as last_week_sales,
                         SUM(f.gross_revenue) as last_week_revenue
                     FROM retail_dw.fct_regular_sales f
-                    WHERE f.product_code IN ('{products_str}')
+                    WHERE f.product_code IN (SELECT product_code FROM product_set)
                       AND toYear(f.transaction_date) = {last_year}
                       AND toWeek(f.transaction_date, 1) = {last_week}
                     GROUP BY f.product_code
                     """
-                    last_week_df = self.ch.query(last_week_query)
+                    last_week_df = self.ch.query(last_week_query, external_tables=[product_set])
                     
                     if not last_week_df.empty:
                         # Merge vào forecasts
@@ -3738,6 +4142,15 @@ class SalesForecaster:
         return report
 
 
+def _train_shard(model_dir: str, shard: str, df_shard: pd.DataFrame, n_trials: int,
+                 tuning_strategy: str = 'full') -> Tuple[xgb.XGBRegressor, Dict]:
+    """Worker process: train Model 1 cho một shard (study lưu ở model_dir/shards/<shard>)"""
+    forecaster = SalesForecaster(model_dir=os.path.join(model_dir, 'shards', shard), enable_email=False)
+    model = forecaster.train_model_optuna(df_shard, 'daily_quantity', n_trials=n_trials,
+                                          metric_type='mdape', tuning_strategy=tuning_strategy)
+    return model, forecaster.metrics.get('daily_quantity', {})
+
+
 if __name__ == '__main__':
     import argparse
     
@@ -3756,6 +4169,24 @@ if __name__ == '__main__':
                        help='Số ngày dữ liệu mới tối thiểu để train lại')
     parser.add_argument('--deep', action='store_true',
                        help='Deep training mode: 150 trials, full features (chậm hơn nhưng chính xác hơn)')
+    parser.add_argument('--forecast-mode', choices=list(FORECAST_MODES), default='recursive',
+                       help='recursive (mặc định) hoặc direct multi-horizon cho Model 1')
+    parser.add_argument('--feature-store', action='store_true',
+                       help='Dùng feature store (Parquet) - chỉ tính lại features của partitions mới')
+    parser.add_argument('--tuning-workers', type=int, default=int(os.getenv('TUNING_WORKERS', '1')),
+                       help='Số processes chạy Optuna trials song song (mặc định: 1)')
+    parser.add_argument('--warm-start', action='store_true',
+                       help='Khởi tạo Optuna từ top params của study lần trước, giảm trials khi dữ liệu ít drift')
+    parser.add_argument('--tuning-strategy', choices=list(TUNING_STRATEGIES), default='full',
+                       help='full (mặc định) hoặc hyperband - successive halving trên tập con dữ liệu')
+    parser.add_argument('--shard-by', choices=list(SHARD_COLUMNS), default=None,
+                       help='Train Model 1 theo segment (abc_class hoặc nhom_hang_cap_1) song song')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Cho phép cập nhật incremental Model 1 (continued training) khi ít ngày mới và drift nhỏ')
+    parser.add_argument('--streaming', action='store_true',
+                       help='Out-of-core training: features materialize theo chunk, Model 1 train trên external memory')
+    parser.add_argument('--chunk-days', type=int, default=EXTERNAL_MEMORY_CHUNK_DAYS,
+                       help='Số ngày mỗi chunk cho --streaming (mặc định: EXTERNAL_MEMORY_CHUNK_DAYS hoặc 30)')
     
     args = parser.parse_args()
     
@@ -3770,18 +4201,39 @@ if __name__ == '__main__':
             logger.info("🔬 DEEP TRAINING MODE: 150 trials, extended features")
         else:
             n_trials = args.trials
-            
-        metrics = forecaster.train_all_models(
-            n_trials=n_trials,
-            days=args.days,
-            send_email=True
-        )
+        
+        # Incremental: continued training Model 1 khi ít ngày mới, fallback full retrain
+        metrics = None
+        if args.incremental and not args.force_train:
+            retrain_mode, reason = forecaster.should_retrain(args.min_new_days, allow_incremental=True)
+            logger.info(f"🔎 Retrain mode: {retrain_mode} - {reason}")
+            if retrain_mode == 'incremental':
+                metrics = forecaster.update_models_incremental(use_feature_store=args.feature_store)
+            elif retrain_mode == 'skip':
+                metrics = {}
+        
+        if metrics is None and args.streaming:
+            metrics = forecaster.train_all_models_streaming(
+                n_trials=n_trials, days=args.days, send_email=True, chunk_days=args.chunk_days)
+        if metrics is None:
+            metrics = forecaster.train_all_models(
+                n_trials=n_trials,
+                days=args.days,
+                send_email=True,
+                forecast_mode=args.forecast_mode,
+                use_feature_store=args.feature_store,
+                tuning_workers=args.tuning_workers,
+                warm_start=args.warm_start,
+                tuning_strategy=args.tuning_strategy,
+                shard_by=args.shard_by
+            )
         logger.info(f"✅ Training completed with metrics: {list(metrics.keys())}")
     
     if args.mode in ['predict', 'all']:
         logger.info("🔮 Mode: PREDICTION")
         # Dự báo Top 50 sản phẩm cần nhập (theo doanh thu lịch sử)
-        forecasts = forecaster.predict_next_week(use_abc_filter=True, abc_top_n=50, forecast_days=14)
+        forecasts = forecaster.predict_next_week(use_abc_filter=True, abc_top_n=50, forecast_days=14,
+                                                 forecast_mode=args.forecast_mode)
         if len(forecasts) > 0:
             forecaster.save_forecasts(forecasts, send_email=True)
             logger.info(f"✅ Generated and saved {len(forecasts)} forecasts")
@@ -0,0 +1,6 @@
+"""Cấu hình pytest: modules ml_pipeline import lẫn nhau theo tên (giống WORKDIR trong Docker image)"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ml_pipeline'))
@@ -0,0 +1,124 @@
+"""
+Tương đương giữa SeriesFeatureState (feature_state.py) và
+SalesForecaster.create_features(prediction_mode=True) cho dòng dự báo.
+"""
+
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from encoders import CategoricalEncoders
+from feature_state import SeriesFeatureState
+from xgboost_forecast import SalesForecaster
+
+MAX_REL_DIFF = 1e-6
+END_DATE = pd.Timestamp('2026-01-31')
+
+
+@pytest.fixture(scope='module')
+def create_features():
+    # create_features không dùng kết nối DB → không cần khởi tạo connectors
+    forecaster = SalesForecaster.__new__(SalesForecaster)
+    forecaster.encoders = CategoricalEncoders()
+    return forecaster.create_features
+
+
+def _series(ma_hang: str, quantity: Sequence[float], dates=None, chi_nhanh: str = 'CN0',
+            seed: int = 0) -> pd.DataFrame:
+    """Lịch sử một series; mặc định các ngày liên tiếp kết thúc ở END_DATE"""
+    rng = np.random.default_rng(seed)
+    quantity = np.asarray(quantity, dtype=float)
+    if dates is None:
+        dates = pd.date_range(end=END_DATE, periods=len(quantity), freq='D')
+    return pd.DataFrame({
+        'ngay': dates, 'chi_nhanh': chi_nhanh, 'ma_hang': ma_hang,
+        'nhom_hang_cap_1': 'N1', 'nhom_hang_cap_2': 'N2',
+        'daily_quantity': quantity, 'daily_revenue': quantity * rng.uniform(9000, 11000, len(quantity)),
+        'seasonal_factor': 1.0, 'is_peak_day': 0,
+    })
+
+
+def _max_rel_diffs(create_features, history_df: pd.DataFrame,
+                   pushed_values: Sequence[float] = (3.0, 0.0, 5.5, 1.0, 12.0)) -> Dict[str, float]:
+    """
+    Chênh lệch lớn nhất (chia cho max(1, |giá trị|) vì create_features lưu lag/rolling
+    ở float32) giữa features của state và create_features, trước và sau mỗi giá trị push.
+    """
+    history_df = history_df.sort_values(['chi_nhanh', 'ma_hang', 'ngay']).reset_index(drop=True)
+    steps = list(pushed_values) + [0.0]
+    days = pd.date_range(pd.Timestamp(history_df['ngay'].max()) + pd.Timedelta(days=1),
+                         periods=len(steps), freq='D')
+
+    groups = list(history_df.groupby(['chi_nhanh', 'ma_hang'], sort=False))
+    lengths = np.array([len(g) for _, g in groups])
+    quantity = np.zeros((len(groups), lengths.max() + len(steps)))
+    revenue = np.zeros_like(quantity)
+    for i, (_, g) in enumerate(groups):
+        quantity[i, :len(g)] = g['daily_quantity'].to_numpy(dtype=np.float64)
+        revenue[i, :len(g)] = g['daily_revenue'].to_numpy(dtype=np.float64)
+    state = SeriesFeatureState.from_history(quantity, revenue, lengths)
+
+    diffs: Dict[str, float] = {}
+    frames = [g.copy() for _, g in groups]
+    for day, value in zip(days, steps):
+        emitted = {}
+        for lag in state.lags:
+            emitted[f'lag_{lag}_quantity'] = state.lag(lag, 'quantity')
+            emitted[f'lag_{lag}_revenue'] = state.lag(lag, 'revenue')
+        for w in state.spans:
+            for stat, arr in state.rolling(w).items():
+                emitted[f'rolling_{stat}_{w}_quantity'] = arr
+            emitted[f'ema_{w}_quantity'] = state.ema_value(w)
+        emitted['quantity_growth'] = state.quantity_growth()
+        emitted['price_change'] = state.price_change()
+
+        for i, frame in enumerate(frames):
+            current = frame.iloc[[-1]].copy()
+            current['ngay'] = day
+            current['daily_quantity'] = 0
+            current['daily_revenue'] = 0
+            expected = create_features(pd.concat([frame, current], ignore_index=True),
+                                       prediction_mode=True).iloc[-1]
+            for name, arr in emitted.items():
+                exp = float(expected[name]) if name in expected.index else 0.0
+                diffs[name] = max(diffs.get(name, 0.0), abs(exp - float(arr[i])) / max(1.0, abs(exp)))
+            frames[i] = pd.concat([frame, current.assign(daily_quantity=value)], ignore_index=True)
+        state.push(np.full(len(groups), value), revenue=0.0)
+    return diffs
+
+
+def _gapped_dates(n_days: int, seed: int = 0) -> pd.DatetimeIndex:
+    """n_days ngày chọn ngẫu nhiên trong 2 * n_days ngày (lịch sử có ngày bị thiếu)"""
+    dates = pd.date_range(end=END_DATE, periods=2 * n_days, freq='D')
+    rng = np.random.default_rng(seed)
+    return dates[np.sort(rng.choice(len(dates), size=n_days, replace=False))]
+
+
+HISTORIES = {
+    'long_45': lambda: _series('SP01', np.random.default_rng(1).poisson(4, 45)),
+    'exactly_30': lambda: _series('SP02', np.random.default_rng(2).poisson(4, 30)),
+    'shorter_than_30': lambda: _series('SP03', np.random.default_rng(3).poisson(4, 20)),
+    'very_short': lambda: _series('SP04', [2.0, 5.0, 1.0]),
+    'single_row': lambda: _series('SP05', [7.0]),
+    'all_zero': lambda: _series('SP06', np.zeros(25)),
+    'gapped_history': lambda: _series('SP07', np.random.default_rng(7).poisson(4, 35), dates=_gapped_dates(35)),
+}
+
+
+@pytest.mark.parametrize('name', sorted(HISTORIES))
+def test_single_series_matches_create_features(create_features, name):
+    diffs = _max_rel_diffs(create_features, HISTORIES[name]())
+    worst = max(diffs, key=diffs.get)
+    assert diffs[worst] < MAX_REL_DIFF, f"{name}: {worst} lệch {diffs[worst]:.3e}"
+
+
+def test_batch_of_mixed_lengths_matches_create_features(create_features):
+    # Nhiều series độ dài khác nhau trong cùng state (padding + offsets theo series)
+    history = pd.concat([
+        build().assign(chi_nhanh=f'CN{i % 2}') for i, build in enumerate(HISTORIES.values())
+    ], ignore_index=True)
+    diffs = _max_rel_diffs(create_features, history)
+    worst = max(diffs, key=diffs.get)
+    assert diffs[worst] < MAX_REL_DIFF, f"{worst} lệch {diffs[worst]:.3e}"